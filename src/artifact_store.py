@@ -0,0 +1,149 @@
+from dataclasses import dataclass
+from pathlib import Path
+import atexit
+import os
+import threading
+import cache_gc
+import profiling
+
+
+"""
+Where the probe (and final chunk) encodes are written
+- in anonymous memory (memfd, or files in a tmpfs root) while within the RAM budget
+- on disk (`intermediatefiles`) once the budget is full
+- the path of an artifact never changes --> the bytes the metric read are the same bytes
+  the concat uses (a winning probe is never encoded again)
+
+A memfd is opened by the subprocesses (ffmpeg) through `/proc/<pid>/fd/<fd>` of this process
+"""
+
+DEFAULT_MEMORY_BUDGET_BYTES = 1024**3
+INITIAL_SIZE_ESTIMATE_BYTES = 64 * 1024**2  # (until an artifact has been written)
+
+
+@dataclass()
+class artifact:
+    name: str
+    path: Path
+    in_memory: bool
+    memfd: int | None = None
+
+
+class ArtifactStore:
+    def __init__(
+        self,
+        disk_directory: Path,
+        memory_budget_bytes: int = DEFAULT_MEMORY_BUDGET_BYTES,
+        memory_root: Path | None = None,  # (None --> memfd, if the OS has it)
+    ) -> None:
+        self.disk_directory: Path = disk_directory
+        self.memory_budget_bytes: int = memory_budget_bytes
+        self.memory_root: Path | None = memory_root
+        self.artifacts: dict[str, artifact] = {}
+        self.largest_artifact: int = INITIAL_SIZE_ESTIMATE_BYTES
+        self.lock: threading.Lock = threading.Lock()
+
+    def _size(self, stored: artifact) -> int:
+        try:
+            if stored.memfd is not None:
+                return os.fstat(stored.memfd).st_size
+            return stored.path.stat().st_size
+        except OSError:
+            return 0
+
+    def memory_used(self) -> int:
+        with self.lock:
+            return self._memory_used()
+
+    def _memory_used(self) -> int:
+        sizes = [self._size(x) for x in self.artifacts.values() if x.in_memory]
+        self.largest_artifact = max([self.largest_artifact, *sizes])
+        return sum(sizes)
+
+    def _allocate_in_memory(self, name: str) -> artifact | None:
+        # (artifacts that are still being written count as the largest one so far)
+        reserved = sum(
+            self._size(x) or self.largest_artifact
+            for x in self.artifacts.values()
+            if x.in_memory
+        )
+        _ = self._memory_used()
+        if reserved + self.largest_artifact > self.memory_budget_bytes:
+            return None
+        if self.memory_root is not None:
+            self.memory_root.mkdir(parents=True, exist_ok=True)
+            return artifact(name, self.memory_root / name, in_memory=True)
+        if not hasattr(os, "memfd_create"):
+            return None
+        memfd = os.memfd_create(name)
+        return artifact(
+            name, Path(f"/proc/{os.getpid()}/fd/{memfd}"), in_memory=True, memfd=memfd
+        )
+
+    def path(self, name: str) -> Path:
+        """
+        The path to write (and later read) the artifact `name` at
+        """
+        with self.lock:
+            if (stored := self.artifacts.get(name)) is None:
+                if (stored := self._allocate_in_memory(name)) is not None:
+                    profiling.count("artifacts in memory")
+                else:
+                    profiling.count("artifacts on disk")
+                    self.disk_directory.mkdir(parents=True, exist_ok=True)
+                    stored = artifact(name, self.disk_directory / name, in_memory=False)
+                self.artifacts[name] = stored
+            return stored.path
+
+    def _find(self, path: Path) -> artifact | None:
+        return next((x for x in self.artifacts.values() if x.path == path), None)
+
+    def exists(self, path: Path) -> bool:
+        with self.lock:
+            stored = self._find(path)
+        if stored is None:
+            # (a memfd path from a previous run may point at something else entirely)
+            return not path.is_relative_to("/proc") and path.exists()
+        if stored.memfd is not None:
+            return self._size(stored) > 0
+        return path.exists()
+
+    def remove(self, path: Path) -> None:
+        with self.lock:
+            stored = self._find(path)
+            if stored is not None:
+                del self.artifacts[stored.name]
+        if stored is not None and stored.memfd is not None:
+            os.close(stored.memfd)
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # (garbage collected, or never written)
+            pass
+
+    def close(self) -> None:
+        for stored in list(self.artifacts.values()):
+            if stored.in_memory:
+                self.remove(stored.path)
+
+
+_store: ArtifactStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_artifact_store() -> ArtifactStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ArtifactStore(cache_gc.INTERMEDIATE_FILES_DIRECTORY)
+            _ = atexit.register(_store.close)
+        return _store
+
+
+def set_artifact_store(store: ArtifactStore) -> None:
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+        _store = store
+        _ = atexit.register(store.close)
@@ -0,0 +1,244 @@
+from dataclasses import dataclass
+from pathlib import Path
+import os
+import sqlite3
+import threading
+import time
+
+
+"""
+Where `file_cache.cache` stores its (pickled) data
+- every entry is identified by a relative path: `<sub_directory>/<cache_name>`
+- `SQLiteBackend` (default) --> one file for the whole cache
+- `PickleFileBackend` --> the old layout, one `*.pickle` file per entry
+"""
+
+
+type CacheBackend = SQLiteBackend | PickleFileBackend
+
+
+@dataclass()
+class cacheentry:
+    cache_path: Path
+    prefix_name: str
+    size: int
+    last_modified: float
+
+
+def atomic_write(filename: Path, file_data: bytes) -> None:
+    """
+    Written to a temporary file first and then renamed
+    --> a crash can't leave a truncated file behind
+    """
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    temporary_filename = filename.with_name(
+        f".{filename.name}.{os.getpid()}-{threading.get_ident()}.tmp"
+    )
+    try:
+        with temporary_filename.open("wb") as f:
+            _ = f.write(file_data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_filename, filename)
+    except BaseException:
+        temporary_filename.unlink(missing_ok=True)
+        raise
+
+
+class PickleFileBackend:
+    NAME = "pickle files"
+
+    def __init__(self, cache_directory: Path) -> None:
+        self.cache_directory: Path = cache_directory
+
+    def load(self, cache_path: Path) -> bytes | None:
+        try:
+            return (self.cache_directory / cache_path).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def store(self, cache_path: Path, prefix_name: str, file_data: bytes) -> None:
+        atomic_write(self.cache_directory / cache_path, file_data)
+
+    def delete(self, cache_path: Path) -> None:
+        os.remove(self.cache_directory / cache_path)
+
+    def flush(self) -> None:
+        pass  # (every write is already on disk)
+
+    def entries(self) -> list[cacheentry]:
+        return [
+            cacheentry(
+                x.relative_to(self.cache_directory),
+                x.name.split("cache-")[0],
+                (stat := x.stat()).st_size,
+                stat.st_mtime,
+            )
+            for x in self.cache_directory.rglob("*cache-*")
+            if x.is_file() and not x.name.startswith(".")
+        ]
+
+
+class SQLiteBackend:
+    """
+    All of the entries in a single SQLite database
+    - writes are committed in batches: every `commit_every` writes, and at most
+      `commit_interval` seconds after a write (a timer, also when no other write follows)
+    - an uncommitted batch lost in a crash only means those results are recalculated
+    """
+
+    NAME = "sqlite"
+
+    def __init__(
+        self,
+        database_filename: Path,
+        commit_every: int = 64,
+        commit_interval: float = 5.0,
+        import_pickle_files_from: Path | None = None,
+    ) -> None:
+        self.database_filename: Path = database_filename
+        self.commit_every: int = commit_every
+        self.commit_interval: float = commit_interval
+
+        self.lock: threading.Lock = threading.Lock()
+        self.uncommitted_writes: int = 0
+        self.last_commit: float = time.monotonic()
+        self.commit_timer: threading.Timer | None = None
+
+        database_filename.parent.mkdir(parents=True, exist_ok=True)
+        is_new_database = not database_filename.is_file()
+
+        # (shared between the scene worker threads --> guarded by `self.lock`)
+        self.connection: sqlite3.Connection = sqlite3.connect(
+            database_filename, check_same_thread=False, isolation_level=None
+        )
+        _ = self.connection.execute("PRAGMA journal_mode=WAL")
+        _ = self.connection.execute("PRAGMA synchronous=NORMAL")
+        _ = self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                sub_directory TEXT NOT NULL,
+                cache_name TEXT NOT NULL,
+                prefix_name TEXT NOT NULL,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_modified REAL NOT NULL,
+                PRIMARY KEY (cache_name, sub_directory)
+            );
+            CREATE INDEX IF NOT EXISTS cache_prefix_name ON cache (prefix_name);
+            CREATE INDEX IF NOT EXISTS cache_sub_directory ON cache (sub_directory);
+        """)
+
+        if is_new_database and import_pickle_files_from is not None:
+            imported = self.import_pickle_files(import_pickle_files_from)
+            if imported:
+                print(f"imported {imported} pickle files into {database_filename}")
+
+    @staticmethod
+    def _split(cache_path: Path) -> tuple[str, str]:
+        return (cache_path.parent.as_posix(), cache_path.name)
+
+    def _begin_if_needed(self) -> None:
+        if not self.connection.in_transaction:
+            _ = self.connection.execute("BEGIN")
+
+    def _commit_if_due(self) -> None:
+        if (
+            self.uncommitted_writes >= self.commit_every
+            or time.monotonic() - self.last_commit >= self.commit_interval
+        ):
+            self._commit()
+        elif self.commit_timer is None:
+            self.commit_timer = threading.Timer(self.commit_interval, self._timed_commit)
+            self.commit_timer.daemon = True
+            self.commit_timer.start()
+
+    def _timed_commit(self) -> None:
+        with self.lock:
+            self.commit_timer = None
+            self._commit()
+
+    def _commit(self) -> None:
+        if self.connection.in_transaction:
+            _ = self.connection.execute("COMMIT")
+        self.uncommitted_writes = 0
+        self.last_commit = time.monotonic()
+
+    def load(self, cache_path: Path) -> bytes | None:
+        sub_directory, cache_name = self._split(cache_path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM cache WHERE cache_name = ? AND sub_directory = ?",
+                (cache_name, sub_directory),
+            ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def store(self, cache_path: Path, prefix_name: str, file_data: bytes) -> None:
+        sub_directory, cache_name = self._split(cache_path)
+        with self.lock:
+            self._begin_if_needed()
+            _ = self.connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    sub_directory,
+                    cache_name,
+                    prefix_name,
+                    file_data,
+                    len(file_data),
+                    time.time(),
+                ),
+            )
+            self.uncommitted_writes += 1
+            self._commit_if_due()
+
+    def delete(self, cache_path: Path) -> None:
+        sub_directory, cache_name = self._split(cache_path)
+        with self.lock:
+            self._begin_if_needed()
+            _ = self.connection.execute(
+                "DELETE FROM cache WHERE cache_name = ? AND sub_directory = ?",
+                (cache_name, sub_directory),
+            )
+            self.uncommitted_writes += 1
+            self._commit_if_due()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._commit()
+
+    def entries(self) -> list[cacheentry]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT sub_directory, cache_name, prefix_name, size, last_modified FROM cache"
+            ).fetchall()
+        return [cacheentry(Path(x[0]) / x[1], x[2], x[3], x[4]) for x in rows]
+
+    def import_pickle_files(
+        self, cache_directory: Path, delete_afterwards: bool = True
+    ) -> int:
+        """
+        Migration from the `PickleFileBackend` layout, each file under its same cache path
+        (the files are removed once committed)
+        - entries keyed before `file_cache.fingerprint` are imported too, they just never
+          get a hit
+        """
+        old_backend = PickleFileBackend(cache_directory)
+        imported_files: list[Path] = []
+
+        for entry in old_backend.entries():
+            if entry.cache_path.suffix != ".pickle":
+                continue
+            file_data = old_backend.load(entry.cache_path)
+            if file_data is None:
+                continue
+            self.store(entry.cache_path, entry.prefix_name, file_data)
+            imported_files.append(entry.cache_path)
+
+        self.flush()
+
+        if delete_afterwards:
+            for cache_path in imported_files:
+                try:
+                    old_backend.delete(cache_path)
+                except FileNotFoundError:
+                    pass
+        return len(imported_files)
@@ -0,0 +1,249 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from collections import defaultdict
+import argparse
+import hashlib
+import os
+import platform
+import re
+import threading
+import time
+import file_cache
+
+
+"""
+Garbage collector for the rendered files in `temporary_cache_dir` (eg the probe and final
+chunk encodes in `intermediatefiles`, the lossless scenes in `prerender`)
+- keeps the files under a byte quota, deleting the least recently used first
+- files that are still needed (eg for the final concat) are pinned and never deleted
+- a pin is a file in `temporary_cache_dir/pins/<host>-<pid>` --> seen by every process (eg
+  `python cache_gc.py gc` while a job is running), the pins of a process that died are removed
+
+usage: python cache_gc.py stats
+       python cache_gc.py gc --quota 20G
+"""
+
+INTERMEDIATE_FILES_DIRECTORY = file_cache.CACHE_DIRECTORY / "intermediatefiles"
+PRERENDER_DIRECTORY = file_cache.CACHE_DIRECTORY / "prerender"  # (lossless scenes)
+
+# the sub_directories holding rendered files (not the cache database)
+GARBAGE_COLLECTED_DIRECTORIES: list[Path] = [
+    INTERMEDIATE_FILES_DIRECTORY,
+    PRERENDER_DIRECTORY,
+]
+
+# (not garbage collected: one directory of pins per process)
+PIN_DIRECTORY = file_cache.CACHE_DIRECTORY / "pins"
+
+SHA256_IN_FILENAME = re.compile(r"\b[0-9a-f]{64}\b")
+
+_lock = threading.Lock()
+_quota_bytes: int | None = None
+
+
+@dataclass()
+class renderedfile:
+    path: Path
+    size: int
+    last_access: float
+
+
+@dataclass()
+class gcresult:
+    deleted_files: int = 0
+    freed_bytes: int = 0
+    remaining_bytes: int = 0
+    pinned_bytes: int = 0
+
+
+@dataclass()
+class cachestats:
+    bytes_per_sub_directory: dict[str, int] = field(default_factory=dict)
+    bytes_per_input_sha: dict[str, int] = field(default_factory=dict)
+    pinned_files: int = 0
+
+
+def set_quota(quota_bytes: int | None) -> None:
+    global _quota_bytes
+    _quota_bytes = quota_bytes
+
+
+def _pin_directory_of_process(pid: int | None = None) -> Path:
+    return PIN_DIRECTORY / f"{platform.node()}-{pid if pid is not None else os.getpid()}"
+
+
+def _pin_filename(path: Path) -> Path:
+    # (the pinned path is the content, the name only has to be unique)
+    return _pin_directory_of_process() / hashlib.sha256(
+        str(path.resolve()).encode()
+    ).hexdigest()
+
+
+def pin(path: Path) -> None:
+    with _lock:
+        pin_filename = _pin_filename(path)
+        pin_filename.parent.mkdir(parents=True, exist_ok=True)
+        _ = pin_filename.write_text(str(path.resolve()))
+
+
+def unpin(path: Path) -> None:
+    with _lock:
+        try:
+            os.remove(_pin_filename(path))
+        except FileNotFoundError:
+            pass
+
+
+def _process_is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # (alive, of another user)
+        return True
+    return True
+
+
+def pinned_files() -> set[Path]:
+    """
+    Pinned by any process (the pins of the processes of this host that died are removed)
+    """
+    pinned: set[Path] = set()
+    if not PIN_DIRECTORY.is_dir():
+        return pinned
+    for directory in PIN_DIRECTORY.iterdir():
+        host, _, pid = directory.name.rpartition("-")
+        if host == platform.node() and pid.isdigit() and not _process_is_alive(int(pid)):
+            for pin_filename in directory.glob("*"):
+                try:
+                    os.remove(pin_filename)
+                except FileNotFoundError:
+                    pass
+            try:
+                directory.rmdir()
+            except OSError:  # (eg pinned again meanwhile, after a pid reuse)
+                pass
+            continue
+        for pin_filename in directory.glob("*"):
+            try:
+                pinned.add(Path(pin_filename.read_text()))
+            except FileNotFoundError:  # (unpinned meanwhile)
+                continue
+    return pinned
+
+
+def touch(path: Path) -> None:
+    """
+    Marks the file as used (the modification time is used for the LRU order)
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def rendered_files() -> list[renderedfile]:
+    files: list[renderedfile] = []
+    for directory in GARBAGE_COLLECTED_DIRECTORIES:
+        if not directory.is_dir():
+            continue
+        for path in directory.rglob("*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # (deleted by another worker)
+                continue
+            if path.is_file():
+                files.append(renderedfile(path, stat.st_size, stat.st_mtime))
+    return files
+
+
+def collect(quota_bytes: int) -> gcresult:
+    """
+    Deletes the least recently used (unpinned) files until the total size is under the quota
+    """
+    with _lock:
+        result = gcresult()
+        files = sorted(rendered_files(), key=lambda x: x.last_access)
+        total_bytes = sum(x.size for x in files)
+        pinned = pinned_files()
+
+        for file in files:
+            if file.path.resolve() in pinned:
+                result.pinned_bytes += file.size
+                continue
+            if total_bytes <= quota_bytes:
+                continue
+            try:
+                os.remove(file.path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= file.size
+            result.deleted_files += 1
+            result.freed_bytes += file.size
+
+        result.remaining_bytes = total_bytes
+        if total_bytes > quota_bytes:
+            print(
+                f"WARNING: rendered files use {total_bytes} bytes (quota {quota_bytes}), {result.pinned_bytes} bytes are pinned"
+            )
+        return result
+
+
+def enforce_quota() -> gcresult | None:
+    """
+    Called before rendering new files (does nothing if no quota is set)
+    """
+    if _quota_bytes is None:
+        return None
+    return collect(_quota_bytes)
+
+
+def stats() -> cachestats:
+    result = cachestats()
+    bytes_per_sub_directory: defaultdict[str, int] = defaultdict(int)
+    bytes_per_input_sha: defaultdict[str, int] = defaultdict(int)
+
+    for file in rendered_files():
+        sub_directory = file.path.relative_to(file_cache.CACHE_DIRECTORY).parts[0]
+        bytes_per_sub_directory[sub_directory] += file.size
+        if (sha := SHA256_IN_FILENAME.search(file.path.name)) is not None:
+            bytes_per_input_sha[sha.group()] += file.size
+
+    for entry in file_cache.get_cache_backend().entries():
+        bytes_per_sub_directory[f"{entry.cache_path.parent} (cache)"] += entry.size
+
+    result.bytes_per_sub_directory = dict(bytes_per_sub_directory)
+    result.bytes_per_input_sha = dict(bytes_per_input_sha)
+    result.pinned_files = len(pinned_files())
+    return result
+
+
+def parse_size(text: str) -> int:
+    units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)i?B?\s*", text.upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}")
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
+def main() -> None:
+    from rich import print
+
+    parser = argparse.ArgumentParser(description="temporary_cache_dir garbage collector")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    _ = subparsers.add_parser("stats", help="space used per sub_directory and input")
+    gc_parser = subparsers.add_parser("gc", help="delete files until under the quota")
+    _ = gc_parser.add_argument("--quota", type=parse_size, required=True)
+    arguments = parser.parse_args()
+
+    match arguments.command:
+        case "stats":
+            print(stats())
+        case "gc":
+            start_time = time.perf_counter()
+            print(collect(arguments.quota))
+            print(f"took {time.perf_counter() - start_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from typing import Iterator
+import os
+import threading
+import profiling
+import task_scheduler
+
+
+"""
+Splits the cores of the host between the subprocesses that run at the same time (the
+scene tasks each start their own encoder and libvmaf --> else 8 cores run ~30 threads)
+- every encode/score takes a lease of the budget while it runs, its thread count is given to
+  the subprocess (SVT-AV1 `lp`, x265 `pools`, x264 `threads`, libvmaf `n_threads`)
+- a subprocess can't change its thread count once started --> re-balanced at every start:
+  the cores not leased are split between this one and the scheduler's other running tasks
+  that don't have a lease yet (eg all of them at the start, only a few at the end)
+- an encode piped into libvmaf splits its lease between the two (`split_encode_and_score`)
+"""
+
+MINIMUM_THREADS = 1
+ENCODER_SHARE = 0.75  # (of the lease, when the encode is scored in the same pass)
+
+
+class CoreBudget:
+    def __init__(self, total_cores: int | None = None) -> None:
+        self.total_cores: int = max(
+            MINIMUM_THREADS, total_cores if total_cores is not None else os.cpu_count() or 1
+        )
+        self.leased: dict[int, int] = {}  # (lease --> threads)
+        self.next_lease: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def _threads_for_new_lease(self) -> int:
+        # (with `self.lock` held)
+        scheduler = task_scheduler.get_scheduler()
+        expected = max(
+            len(self.leased) + 1, scheduler.busy_slots() if scheduler is not None else 0
+        )
+        free_cores = self.total_cores - sum(self.leased.values())
+        return max(MINIMUM_THREADS, free_cores // (expected - len(self.leased)))
+
+    @contextmanager
+    def lease(self) -> Iterator[int]:
+        """
+        The threads for the subprocess(es) run within
+        """
+        with self.lock:
+            lease, self.next_lease = self.next_lease, self.next_lease + 1
+            threads = self._threads_for_new_lease()
+            self.leased[lease] = threads
+        profiling.count("core budget: leases")
+        profiling.count("core budget: threads leased", threads)
+        try:
+            yield threads
+        finally:
+            with self.lock:
+                del self.leased[lease]
+
+    def in_use(self) -> int:
+        with self.lock:
+            return sum(self.leased.values())
+
+
+def split_encode_and_score(threads: int) -> tuple[int, int]:
+    """
+    (encoder threads, libvmaf threads) of a lease
+    """
+    if threads <= MINIMUM_THREADS:
+        return (MINIMUM_THREADS, MINIMUM_THREADS)
+    encoder_threads = min(threads - 1, max(MINIMUM_THREADS, round(threads * ENCODER_SHARE)))
+    return (encoder_threads, threads - encoder_threads)
+
+
+def split_encoders(threads: int, number_of_encoders: int) -> int:
+    """
+    Threads of each encoder of the same ffmpeg (eg the multiple CRF encode)
+    """
+    return max(MINIMUM_THREADS, threads // max(number_of_encoders, 1))
+
+
+_core_budget: CoreBudget = CoreBudget()
+
+
+def get_core_budget() -> CoreBudget:
+    return _core_budget
+
+
+def set_core_budget(core_budget: CoreBudget) -> None:
+    global _core_budget
+    _core_budget = core_budget
@@ -0,0 +1,164 @@
+from array import array
+from dataclasses import dataclass
+import math
+import threading
+import ffmpeg
+import media_catalog
+import process_graph
+import profiling
+import videodata
+
+
+"""
+Predicts a narrow starting bracket for a scene's CRF search, from the scenes already done
+- complexity of a scene: the packet sizes of the source in its range (one ffprobe of the
+  whole input, kept in the media catalog) --> bits per pixel, and how much they vary
+- prediction: the finished scenes weighted by how similar their complexity is (and more for
+  the scenes right next to it)
+- the bracket is only a starting point: `crf_search.search` widens it to the whole range if
+  the target turns out to be outside of it
+"""
+
+MINIMUM_OBSERVATIONS = 3  # (before that --> no prediction, the whole range)
+MINIMUM_HALF_WIDTH = 3  # (in CRF)
+SPREAD_MULTIPLIER = 2.0  # (half width = this * the weighted standard deviation of the CRFs)
+ADJACENT_SCENE_WEIGHT = 3.0
+
+
+@dataclass(frozen=True)
+class scenefeatures:
+    bits_per_pixel: float
+    size_variation: float  # (coefficient of variation of the packet sizes)
+
+    def distance(self, other: "scenefeatures") -> float:
+        return math.hypot(
+            math.log2(max(self.bits_per_pixel, 1e-6))
+            - math.log2(max(other.bits_per_pixel, 1e-6)),
+            self.size_variation - other.size_variation,
+        )
+
+
+@dataclass(frozen=True)
+class observation:
+    start_frame: int
+    end_frame: int
+    features: scenefeatures
+    crf: int
+    score: float
+
+
+def _probe_packet_sizes(video_data: videodata.RawVideoData) -> array:
+    output = process_graph.run(
+        process_graph.Stage(
+            "ffprobe packet sizes",
+            [
+                "ffprobe",
+                "-v", "quiet",
+                "-select_streams", "v:0",
+                "-show_entries", "packet=size",
+                "-of", "csv=p=0",
+                str(video_data.raw_input_filename),
+            ],
+        ),
+        capture_stdout=True,
+    ).stdout
+    # (decode order, which doesn't matter for the statistics of a range)
+    return array("I", (int(x) for x in output.split() if x.strip().isdigit()))
+
+
+def packet_sizes(video_data: videodata.RawVideoData) -> array:
+    return media_catalog.get_or_calculate(
+        video_data.sha256_of_input,
+        "packet sizes",
+        lambda: _probe_packet_sizes(video_data),
+    )
+
+
+def range_packet_sizes(
+    video_data: videodata.RawVideoData, start_frame: int, end_frame: int
+) -> array:
+    """
+    `start_frame`/`end_frame` of `video_data.input_filename` (eg the vapoursynth output)
+    """
+    sizes = packet_sizes(video_data)
+    total_frames = ffmpeg.get_video_metadata(
+        video_data, video_data.input_filename
+    ).total_frames
+    if not sizes or total_frames <= 0:
+        return array("I")
+
+    scale = len(sizes) / total_frames
+    return sizes[
+        int(start_frame * scale) : max(int(end_frame * scale), int(start_frame * scale) + 1)
+    ]
+
+
+def scene_features(
+    video_data: videodata.RawVideoData, start_frame: int, end_frame: int
+) -> scenefeatures | None:
+    scene_sizes = range_packet_sizes(video_data, start_frame, end_frame)
+    if not scene_sizes:
+        return None
+    metadata = ffmpeg.get_video_metadata(video_data, video_data.raw_input_filename)
+
+    mean = sum(scene_sizes) / len(scene_sizes)
+    deviation = math.sqrt(sum((x - mean) ** 2 for x in scene_sizes) / len(scene_sizes))
+    return scenefeatures(
+        bits_per_pixel=mean * 8 / max(metadata.width * metadata.height, 1),
+        size_variation=deviation / mean if mean > 0 else 0.0,
+    )
+
+
+class CRFPredictor:
+    def __init__(self, crf_range: range) -> None:
+        self.crf_range: range = crf_range
+        self.observations: list[observation] = []
+        self.lock: threading.Lock = threading.Lock()
+
+    def add(
+        self,
+        start_frame: int,
+        end_frame: int,
+        features: scenefeatures | None,
+        crf: int,
+        score: float,
+    ) -> None:
+        if features is None:
+            return
+        with self.lock:
+            self.observations.append(
+                observation(start_frame, end_frame, features, crf, score)
+            )
+
+    def predict(
+        self, start_frame: int, end_frame: int, features: scenefeatures | None
+    ) -> tuple[int, int] | None:
+        """
+        (lowest CRF, highest CRF) to start the search with, None --> the whole range
+        """
+        with self.lock:
+            observations = list(self.observations)
+        if features is None or len(observations) < MINIMUM_OBSERVATIONS:
+            return None
+
+        def weight(x: observation) -> float:
+            is_adjacent = x.end_frame == start_frame or x.start_frame == end_frame
+            return (ADJACENT_SCENE_WEIGHT if is_adjacent else 1.0) / (
+                features.distance(x.features) + 0.05
+            )
+
+        weights = [weight(x) for x in observations]
+        total_weight = sum(weights)
+        mean = sum(w * x.crf for w, x in zip(weights, observations)) / total_weight
+        deviation = math.sqrt(
+            sum(w * (x.crf - mean) ** 2 for w, x in zip(weights, observations))
+            / total_weight
+        )
+
+        half_width = max(MINIMUM_HALF_WIDTH, math.ceil(SPREAD_MULTIPLIER * deviation))
+        bracket = (
+            max(min(self.crf_range), math.floor(mean - half_width)),
+            min(max(self.crf_range), math.ceil(mean + half_width)),
+        )
+        profiling.count("crf prediction: bracket predicted")
+        return bracket
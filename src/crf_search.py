@@ -0,0 +1,343 @@
+from dataclasses import dataclass, field, replace
+from typing import Callable
+import math
+
+
+"""
+Strategies for the search of the CRF that gives the target heuristic score
+ASSUMPTION (same as the bisection always had): a bigger CRF --> a lower (worse) score
+
+- every strategy only picks the next CRF(s) to probe, `search` does the rest
+- a CRF is only ever probed inside of the bracket of the scores seen so far, and never
+  twice --> every strategy finishes
+- a probe may only return a `scorebound` (eg stopped early): its side of the target is
+  known, its score is only an estimate --> never a match
+- speculation: the CRFs the strategy would probe next for either outcome of the current
+  round, so they can be probed already (eg in idle worker slots)
+"""
+
+SPECULATION_MARGIN = 1.0  # (the made up score of an outcome, this far from the target)
+
+
+@dataclass(frozen=True)
+class scorebound:
+    estimate: float
+    lower: float
+    upper: float
+
+
+@dataclass()
+class searchstate:
+    crf_range: range
+    target_score: float
+    score_range: range
+    bracket: tuple[int, int]  # (where the unprobed bounds start, eg a predicted window)
+    scores: dict[int, float] = field(default_factory=dict)  # (estimates of the bounds)
+    bounds: dict[int, scorebound] = field(default_factory=dict)
+    rounds: int = 0
+    bracket_widths: list[int] = field(default_factory=list)
+
+    @property
+    def lower(self) -> int:
+        # biggest CRF that is still above the target (better quality)
+        return max(
+            (x for x, score in self.scores.items() if score > self.target_score),
+            default=self.bracket[0],
+        )
+
+    @property
+    def upper(self) -> int:
+        # smallest CRF that is below the target
+        return min(
+            (x for x, score in self.scores.items() if score < self.target_score),
+            default=self.bracket[1],
+        )
+
+    def candidates(self) -> list[int]:
+        return [
+            x
+            for x in range(max(self.lower, min(self.crf_range)), self.upper + 1)
+            if x not in self.scores and x in self.crf_range
+        ]
+
+    def snap(self, crf: float) -> int | None:
+        """
+        The closest CRF that can still be probed
+        """
+        return min(self.candidates(), key=lambda x: abs(x - crf), default=None)
+
+    def is_match(self, tolerance: float) -> bool:
+        return any(
+            abs(score - self.target_score) <= tolerance
+            for x, score in self.scores.items()
+            if x not in self.bounds
+        )
+
+    def bracket_missed(self) -> bool:
+        """
+        The target is outside of the bracket (every score was on one side of it)
+        """
+        full_range = (min(self.crf_range), max(self.crf_range))
+        return (
+            self.bracket[0] > full_range[0]
+            and not any(x > self.target_score for x in self.scores.values())
+        ) or (
+            self.bracket[1] < full_range[1]
+            and not any(x < self.target_score for x in self.scores.values())
+        )
+
+
+@dataclass()
+class Bisection:
+    NAME = "bisection"
+
+    def next_crfs(self, state: searchstate) -> list[int]:
+        crf = state.snap((state.lower + state.upper) // 2)
+        return [] if crf is None else [crf]
+
+
+@dataclass()
+class KAry:
+    """
+    `probes_per_round` CRFs evenly spaced inside of the bracket per round
+    (encoded together from a single decode, see `run_ffmpeg_command_multiple_crf`)
+    """
+
+    probes_per_round: int = 3
+    NAME = "k-ary"
+
+    def next_crfs(self, state: searchstate) -> list[int]:
+        crfs: list[int] = []
+        for i in range(self.probes_per_round):
+            crf = state.snap(
+                state.lower
+                + (state.upper - state.lower) * (i + 1) // (self.probes_per_round + 1)
+            )
+            if crf is not None and crf not in crfs:
+                crfs.append(crf)
+        return crfs
+
+
+def _bisection_is_due(state: searchstate) -> bool:
+    # (safeguard) the bracket didn't halve in the last two rounds
+    widths = state.bracket_widths
+    return len(widths) >= 3 and all(widths[-i] * 2 > widths[-i - 1] for i in (1, 2))
+
+
+def _illinois_weights(state: searchstate) -> tuple[float, float]:
+    """
+    (of the lower end, of the upper end) --> the end that stayed put for another round has
+    its distance to the target halved, else false position keeps moving only one end
+    """
+    weights = [1.0, 1.0]
+    previous_side: int | None = None
+    for score in state.scores.values():  # (in the order probed)
+        if score == state.target_score:
+            continue
+        side = 0 if score > state.target_score else 1
+        weights[side] = 1.0
+        if side == previous_side:
+            weights[1 - side] /= 2
+        previous_side = side
+    return (weights[0], weights[1])
+
+
+@dataclass()
+class RegulaFalsi:
+    """
+    False position between the ends of the bracket, with the Illinois modification
+    (an end not probed yet counts as the best/worst score of `score_range`)
+    """
+
+    initial_crf: int | None = None  # (None --> the middle of the range)
+    # (the step stays this fraction of the bracket away from its ends: the flat tails of the
+    # score curve would else pull it to an end, one CRF at a time)
+    margin: float = 0.25
+    NAME = "regula falsi"
+
+    def next_crfs(self, state: searchstate) -> list[int]:
+        if not state.scores:
+            crf = state.snap(
+                self.initial_crf
+                if self.initial_crf is not None
+                else (state.lower + state.upper) // 2
+            )
+            return [] if crf is None else [crf]
+
+        lower_weight, upper_weight = _illinois_weights(state)
+        lower_distance = lower_weight * (
+            state.scores.get(state.lower, max(state.score_range)) - state.target_score
+        )
+        upper_distance = upper_weight * (
+            state.scores.get(state.upper, min(state.score_range)) - state.target_score
+        )
+        # (eg a target at an end of `score_range`)
+        if lower_distance <= 0 or upper_distance >= 0:
+            return Bisection().next_crfs(state)
+
+        fraction = lower_distance / (lower_distance - upper_distance)
+        fraction = min(max(fraction, self.margin), 1 - self.margin)
+        next_crf = state.snap(state.lower + (state.upper - state.lower) * fraction)
+        return [] if next_crf is None else [next_crf]
+
+
+@dataclass()
+class LogisticFit:
+    """
+    score = MAX / (1 + exp((crf - midpoint) / width)), fitted to every score so far
+    (linear least squares on the logit), solved for the target score
+    """
+
+    initial_crf: int | None = None  # (None --> the middle of the range)
+    initial_width: float = 8.0  # (in CRF, until there are two scores)
+    NAME = "logistic fit"
+
+    def _logit(self, score: float, maximum: float) -> float:
+        score = min(max(score, maximum * 0.005), maximum * 0.995)
+        return math.log(maximum / score - 1)
+
+    def next_crfs(self, state: searchstate) -> list[int]:
+        if not state.scores:
+            crf = state.snap(
+                self.initial_crf
+                if self.initial_crf is not None
+                else (state.lower + state.upper) // 2
+            )
+            return [] if crf is None else [crf]
+
+        if _bisection_is_due(state):
+            return Bisection().next_crfs(state)
+
+        maximum = float(max(state.score_range))
+        points = [(x, self._logit(y, maximum)) for x, y in state.scores.items()]
+
+        if len(points) == 1:
+            width = self.initial_width
+            midpoint = points[0][0] - width * points[0][1]
+        else:
+            mean_crf = sum(x for x, _ in points) / len(points)
+            mean_logit = sum(y for _, y in points) / len(points)
+            covariance = sum((x - mean_crf) * (y - mean_logit) for x, y in points)
+            variance = sum((x - mean_crf) ** 2 for x, _ in points)
+            if covariance <= 0 or variance == 0:  # (not monotonic, eg noise)
+                return Bisection().next_crfs(state)
+            width = variance / covariance
+            midpoint = mean_crf - width * mean_logit
+
+        next_crf = state.snap(
+            midpoint + width * self._logit(state.target_score, maximum)
+        )
+        return [] if next_crf is None else [next_crf]
+
+
+type SearchStrategy = Bisection | KAry | RegulaFalsi | LogisticFit
+
+
+def _outcomes(state: searchstate, crfs: list[int]) -> list[searchstate]:
+    # (monotonic --> the target is either between two of the CRFs, or outside of them all)
+    crfs = sorted(crfs)
+    outcomes: list[searchstate] = []
+    for i in range(len(crfs) + 1):
+        made_up: dict[int, scorebound] = {}
+        for j, x in enumerate(crfs):  # (the first `i` above the target, the rest below)
+            score = state.target_score + (
+                SPECULATION_MARGIN if j < i else -SPECULATION_MARGIN
+            )
+            made_up[x] = scorebound(score, score, score)
+        outcomes.append(
+            replace(
+                state,
+                scores=state.scores | {x: y.estimate for x, y in made_up.items()},
+                bounds=state.bounds | made_up,
+                bracket_widths=list(state.bracket_widths),
+            )
+        )
+    return outcomes
+
+
+def speculative_crfs(
+    strategy: "SearchStrategy", state: searchstate, crfs: list[int], limit: int
+) -> list[int]:
+    """
+    Up to `limit` CRFs that may be probed after `crfs`, the next round's first
+    """
+    speculated: list[int] = []
+    frontier = [(state, crfs)]
+    while frontier and len(speculated) < limit:
+        next_frontier: list[tuple[searchstate, list[int]]] = []
+        for frontier_state, frontier_crfs in frontier:
+            for outcome in _outcomes(frontier_state, frontier_crfs):
+                next_crfs = strategy.next_crfs(outcome)
+                speculated.extend(
+                    x for x in next_crfs if x not in speculated and x not in crfs
+                )
+                if next_crfs:
+                    next_frontier.append((outcome, next_crfs))
+        frontier = next_frontier
+    return speculated[:limit]
+
+
+@dataclass()
+class searchresult:
+    crf: int
+    score: float
+    probes_used: int
+    rounds: int
+    scores: dict[int, float]
+    bracket_missed: bool = False
+    bounds: dict[int, scorebound] = field(default_factory=dict)
+
+
+def search(
+    strategy: SearchStrategy,
+    crf_range: range,
+    target_score: float,
+    score_range: range,
+    # (the CRFs of one round --> scores)
+    probe: Callable[[list[int]], dict[int, float | scorebound]],
+    tolerance: float = 0.0,  # (a score this close to the target ends the search)
+    initial_bracket: tuple[int, int] | None = None,  # (None --> the whole `crf_range`)
+    # (the CRFs of the round, the CRFs to probe in the background) --> the ones that are in
+    # neither anymore are cancelled
+    speculate: Callable[[list[int], list[int]], None] | None = None,
+    speculative_slots: Callable[[], int] = lambda: 0,
+) -> searchresult:
+    full_range = (min(crf_range), max(crf_range))
+    state = searchstate(
+        crf_range, target_score, score_range, initial_bracket or full_range
+    )
+    bracket_missed = False
+
+    while True:
+        while not state.is_match(tolerance) and (crfs := strategy.next_crfs(state)):
+            if speculate is not None:
+                speculate(
+                    crfs, speculative_crfs(strategy, state, crfs, speculative_slots())
+                )
+            for crf, score in probe(crfs).items():
+                if isinstance(score, scorebound):
+                    state.bounds[crf] = score
+                    score = score.estimate
+                state.scores[crf] = score
+            state.rounds += 1
+            state.bracket_widths.append(state.upper - state.lower)
+
+        if state.is_match(tolerance) or not state.bracket_missed():
+            break
+        # (the scores so far are kept, they still narrow down the wide range)
+        bracket_missed = True
+        state.bracket = full_range
+        state.bracket_widths.clear()
+
+    if speculate is not None:
+        speculate([], [])
+    crf, score = min(state.scores.items(), key=lambda x: abs(x[1] - target_score))
+    return searchresult(
+        crf,
+        score,
+        len(state.scores),
+        state.rounds,
+        state.scores,
+        bracket_missed,
+        state.bounds,
+    )
@@ -0,0 +1,266 @@
+from dataclasses import dataclass, asdict
+from pathlib import Path
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import ffmpeg
+import file_cache
+import process_graph
+
+
+"""
+How fast each codec/preset encodes on this host, at each thread count
+- short synthetic clips (ffmpeg's `testsrc2` and `mandelbrot`, rendered losslessly first -->
+  only the encoder is measured) encoded at every preset and thread count
+- per point of the curve: the fps, the CPU seconds per frame, and the efficiency (the speedup
+  over 1 thread, divided by the threads)
+- stored per host in `temporary_cache_dir/encoder profiles` --> the task costs of the
+  scheduler are then in predicted seconds (instead of frames), and the ETA of the queue
+
+usage: python encoder_calibration.py
+       python encoder_calibration.py --codecs SVTAV1 --size 1920x1080 --frames 120
+"""
+
+PROFILE_DIRECTORY = file_cache.CACHE_DIRECTORY / "encoder profiles"
+
+CALIBRATION_SOURCES = ["testsrc2", "mandelbrot"]  # (an easy and a hard source)
+CALIBRATION_FRAMES = 60
+CALIBRATION_SIZE = (1280, 720)
+CALIBRATION_CRF = 30
+CALIBRATION_PRESETS: dict[str, list[int | str]] = {
+    "SVTAV1": [4, 6, 8, 10, 12],
+    "H264": ["veryfast", "medium", "slower"],
+    "H265": ["veryfast", "medium", "slower"],
+}
+CODECS: dict[str, type] = {
+    "SVTAV1": ffmpeg.SVTAV1,
+    "H264": ffmpeg.H264,
+    "H265": ffmpeg.H265,
+}
+
+
+@dataclass()
+class curvepoint:
+    threads: int
+    fps: float
+    cpu_seconds_per_frame: float
+    efficiency: float  # (fps / (threads * the fps at 1 thread))
+
+
+@dataclass()
+class EncoderProfile:
+    host: str
+    cpu_count: int
+    pixels: int  # (of the calibration clips)
+    created: float
+    # codec NAME --> preset --> the curve (ascending threads)
+    curves: dict[str, dict[str, list[curvepoint]]]
+
+    def curve(self, codec: ffmpeg.VideoCodec) -> list[curvepoint] | None:
+        return self.curves.get(codec.NAME, {}).get(str(getattr(codec, "preset", None)))
+
+    def fps(self, codec: ffmpeg.VideoCodec, threads: int, pixels: int) -> float | None:
+        """
+        Interpolated between the thread counts measured, scaled to `pixels` per frame
+        (None --> this codec/preset isn't calibrated)
+        """
+        if not (curve := self.curve(codec)):
+            return None
+        below = [x for x in curve if x.threads <= threads] or curve[:1]
+        above = [x for x in curve if x.threads >= threads] or curve[-1:]
+        lower, upper = below[-1], above[0]
+        if upper.threads == lower.threads:
+            fps = lower.fps
+        else:
+            fps = lower.fps + (upper.fps - lower.fps) * (threads - lower.threads) / (
+                upper.threads - lower.threads
+            )
+        return fps * self.pixels / max(pixels, 1)
+
+    def efficiency(self, codec: ffmpeg.VideoCodec, threads: int) -> float | None:
+        if not (curve := self.curve(codec)):
+            return None
+        return min(curve, key=lambda x: abs(x.threads - threads)).efficiency
+
+    def save(self, filename: Path) -> None:
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        _ = filename.write_text(json.dumps(asdict(self), indent=2))
+
+    @classmethod
+    def load(cls, filename: Path) -> "EncoderProfile":
+        data = json.loads(filename.read_text())
+        data["curves"] = {
+            codec: {
+                preset: [curvepoint(**x) for x in curve] for preset, curve in presets.items()
+            }
+            for codec, presets in data["curves"].items()
+        }
+        return cls(**data)
+
+
+def profile_filename(host: str | None = None) -> Path:
+    return PROFILE_DIRECTORY / f"{host if host is not None else platform.node()}.json"
+
+
+_profile: EncoderProfile | None = None
+_profile_loaded = False
+
+
+def get_profile() -> EncoderProfile | None:
+    """
+    The profile of this host (None --> not calibrated yet)
+    """
+    global _profile, _profile_loaded
+    if not _profile_loaded:
+        _profile_loaded = True
+        if profile_filename().exists():
+            _profile = EncoderProfile.load(profile_filename())
+    return _profile
+
+
+def set_profile(profile: EncoderProfile | None) -> None:
+    global _profile, _profile_loaded
+    _profile, _profile_loaded = profile, True
+
+
+def seconds_per_frame(
+    codec: ffmpeg.VideoCodec, pixels: int, threads: int
+) -> float | None:
+    if (profile := get_profile()) is None:
+        return None
+    fps = profile.fps(codec, threads, pixels)
+    return 1 / fps if fps else None
+
+
+def _render_source(
+    source: str, size: tuple[int, int], frames: int, directory: Path
+) -> Path:
+    # (lossless, at the codecs' default bitdepth --> decoding it costs next to nothing)
+    filename = directory / f"{source}.nut"
+    _ = process_graph.run(
+        process_graph.Stage(
+            "calibration source",
+            [
+                "ffmpeg",
+                "-hide_banner", "-loglevel", "error",
+                "-f", "lavfi",
+                "-i", f"{source}=size={size[0]}x{size[1]}:rate=30",
+                "-frames:v", str(frames),
+                "-pix_fmt", "yuv420p10le",
+                "-c:v", "rawvideo",
+                "-y", str(filename),
+            ],
+        )
+    )
+    return filename
+
+
+def measure(
+    codec: ffmpeg.VideoCodec, threads: int, clips: list[Path], frames: int
+) -> tuple[float, float]:
+    """
+    (fps, CPU seconds per frame) over all of `clips`
+    """
+    wall_seconds, cpu_seconds = 0.0, 0.0
+    for clip in clips:
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_time = time.perf_counter()
+        _ = process_graph.run(
+            process_graph.Stage(
+                "calibration encode",
+                [
+                    "ffmpeg",
+                    "-hide_banner", "-loglevel", "error",
+                    "-i", str(clip),
+                    *codec.to_subprocess_command(CALIBRATION_CRF, threads),
+                    "-an",
+                    "-f", "null", "-",
+                ],
+            )
+        )
+        wall_seconds += time.perf_counter() - start_time
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_seconds += (after.ru_utime - before.ru_utime) + (
+            after.ru_stime - before.ru_stime
+        )
+    total_frames = frames * len(clips)
+    return (total_frames / wall_seconds, cpu_seconds / total_frames)
+
+
+def calibration_threads(max_threads: int) -> list[int]:
+    """
+    1, 2, 4 ... and `max_threads` itself
+    """
+    return sorted({*(2**x for x in range(max_threads.bit_length())), max_threads})
+
+
+def calibrate(
+    codec_names: list[str],
+    size: tuple[int, int] = CALIBRATION_SIZE,
+    frames: int = CALIBRATION_FRAMES,
+    max_threads: int | None = None,
+) -> EncoderProfile:
+    max_threads = max_threads if max_threads is not None else os.cpu_count() or 1
+    curves: dict[str, dict[str, list[curvepoint]]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        clips = [
+            _render_source(x, size, frames, Path(directory)) for x in CALIBRATION_SOURCES
+        ]
+        for codec_name in codec_names:
+            curves[codec_name] = {}
+            for preset in CALIBRATION_PRESETS[codec_name]:
+                codec = CODECS[codec_name](preset=preset)
+                curve: list[curvepoint] = []
+                for threads in calibration_threads(max_threads):
+                    fps, cpu_seconds_per_frame = measure(codec, threads, clips, frames)
+                    curve.append(
+                        curvepoint(
+                            threads,
+                            fps,
+                            cpu_seconds_per_frame,
+                            fps / (threads * curve[0].fps) if curve else 1.0,
+                        )
+                    )
+                    print(
+                        f"{codec_name} preset {preset}, {threads} threads: {fps:.1f} fps (efficiency {curve[-1].efficiency:.2f})"
+                    )
+                curves[codec_name][str(preset)] = curve
+
+    return EncoderProfile(
+        platform.node(), os.cpu_count() or 1, size[0] * size[1], time.time(), curves
+    )
+
+
+def parse_resolution(text: str) -> tuple[int, int]:
+    width, _, height = text.lower().partition("x")
+    if not (width.isdigit() and height.isdigit()):
+        raise argparse.ArgumentTypeError(f"invalid size: {text} (eg 1280x720)")
+    return (int(width), int(height))
+
+
+def main() -> None:
+    from rich import print
+
+    parser = argparse.ArgumentParser(description="encoder speed calibration of this host")
+    _ = parser.add_argument(
+        "--codecs", nargs="+", choices=list(CODECS), default=list(CODECS)
+    )
+    _ = parser.add_argument("--size", type=parse_resolution, default=CALIBRATION_SIZE)
+    _ = parser.add_argument("--frames", type=int, default=CALIBRATION_FRAMES)
+    _ = parser.add_argument("--max-threads", type=int, default=None)
+    arguments = parser.parse_args()
+
+    start_time = time.perf_counter()
+    profile = calibrate(
+        arguments.codecs, arguments.size, arguments.frames, arguments.max_threads
+    )
+    profile.save(profile_filename())
+    print(f"saved {profile_filename()} (took {time.perf_counter() - start_time:.0f}s)")
+
+
+if __name__ == "__main__":
+    main()
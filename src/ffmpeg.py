@@ -15,6 +15,9 @@ import dataclasses
 import typing
 import json
 import os
+import re
+import shlex
+import threading
 # from rich.traceback import install
 
 # import v2_target_videoCRF
@@ -23,6 +26,11 @@ import os
 import pathlib
 
 import videodata
+import cache_gc
+import core_budget
+import profiling
+import process_graph
+import media_catalog
 # from types import TracebackType
 
 # _ = install(show_locals=True)
@@ -32,11 +40,8 @@ type VideoCodec = SVTAV1 | H264 | H265 | APPLE_HWENC_H265
 # type VideoCodec = SVTAV1 | H264 | H265
 
 """
-there's also "process substitution" in many shells, roughly: `cat input | ffmpeg -i - … - | do_more`
-is the same as `ffmpeg -i <(cat some_file) >(do_more)`,
-but the <(…) or >(…) can be repeated as
-necessary. Upside: no manual creation/cleanup. Downside: unreadable unless you code
-generate… at which point named pipes are also on the table.
+the vspipe | ffmpeg | libvmaf pipelines are run by `process_graph` (Popen pipes + extra fds
+as `pipe:N` instead of the shell's `<(…)` process substitution)
 """
 
 
@@ -97,13 +102,15 @@ class SVTAV1:
     ACCEPTED_CRF_RANGE: range = range(0, 63 + 1, 1)
     NAME = "SVTAV1"
     BETTER_QUALITY = -1
+    # (the default look-ahead distance at most, and a mini-GOP of 5 hierarchical levels)
+    LOOKAHEAD_FRAMES = 120 + 32
 
-    def to_subprocess_command(self, crf: int) -> list[str]:
+    def to_subprocess_command(self, crf: int, threads: int | None = None) -> list[str]:
         command = [
-            "-c:v libsvtav1",
-            f"-preset {self.preset}",
-            f"-pix_fmt {self.bitdepth}",
-            f"-crf {crf}",
+            "-c:v", "libsvtav1",
+            "-preset", str(self.preset),
+            "-pix_fmt", self.bitdepth,
+            "-crf", str(crf),
         ]
 
         svtav1params: list[str] = [f"tune={["subjective", "PSNR"].index(self.tune)}"]
@@ -114,12 +121,23 @@ class SVTAV1:
                 f"film-grain-denoise={int(self.film_grain.film_grain_denoise)}"
             )
 
-        command.append(f"-svtav1-params {':'.join(svtav1params)}")
+        if threads is not None:
+            svtav1params.append(f"lp={threads}")
+
+        command.extend(["-svtav1-params", ":".join(svtav1params)])
 
         return command
 
+    def lookahead_frames(self, threads: int | None = None) -> int:
+        """
+        Frames read before the first encoded frame comes out, at most
+        (+ a picture in flight per thread)
+        """
+        threads = threads if threads is not None else os.cpu_count() or 1
+        return self.LOOKAHEAD_FRAMES + threads
+
     def output_file(self, output_filename: str, crf_value: int) -> str:
-        return f'"{output_filename}"'
+        return output_filename
 
 
 @dataclasses.dataclass()
@@ -127,6 +145,18 @@ class H264:
     ACCEPTED_CRF_RANGE: range = range(0, 51 + 1, 1)
     NAME = "H264"
     BETTER_QUALITY = -1
+    # preset --> rc-lookahead + bframes (the x264 defaults)
+    LOOKAHEAD_FRAMES = {
+        "ultrafast": 0,
+        "superfast": 0 + 3,
+        "veryfast": 10 + 3,
+        "faster": 20 + 3,
+        "fast": 30 + 3,
+        "medium": 40 + 3,
+        "slow": 50 + 3,
+        "slower": 60 + 8,
+        "veryslow": 60 + 8,
+    }
 
     preset: typing.Literal[
         "ultrafast",
@@ -170,24 +200,35 @@ class H264:
         "gray10le",
     ] = "yuv420p10le"
 
-    def to_subprocess_command(self, crf: int) -> list[str]:
+    def to_subprocess_command(self, crf: int, threads: int | None = None) -> list[str]:
         command = [
-            "-c:v libx264",
-            f"-preset {self.preset}",
-            f"-pix_fmt {self.bitdepth}",
-            f"-crf {crf}",
+            "-c:v", "libx264",
+            "-preset", self.preset,
+            "-pix_fmt", self.bitdepth,
+            "-crf", str(crf),
         ]
 
+        if threads is not None:
+            command.extend(["-threads", str(threads)])
+
         if self.tune is not None:
-            command.append(f"-tune {self.tune}")
+            command.extend(["-tune", self.tune])
 
         if self.faststart:
-            command.append("-movflags +faststart")
+            command.extend(["-movflags", "+faststart"])
 
         return command
 
+    def lookahead_frames(self, threads: int | None = None) -> int:
+        """
+        Frames read before the first encoded frame comes out, at most
+        (+ the frame threads and their sync-lookahead, by default 1.5 threads per core)
+        """
+        threads = threads if threads is not None else (os.cpu_count() or 1) * 3 // 2
+        return self.LOOKAHEAD_FRAMES[self.preset] + threads + (threads + 1) // 2
+
     def output_file(self, output_filename: str, crf_value: int) -> str:
-        return f'"{output_filename}"'
+        return output_filename
 
 
 @dataclasses.dataclass()
@@ -195,6 +236,19 @@ class H265:
     ACCEPTED_CRF_RANGE: range = range(0, 51 + 1, 1)
     NAME = "H265"
     BETTER_QUALITY = -1
+    # preset --> rc-lookahead + bframes (the x265 defaults)
+    LOOKAHEAD_FRAMES = {
+        "ultrafast": 5 + 3,
+        "superfast": 10 + 3,
+        "veryfast": 15 + 4,
+        "faster": 15 + 4,
+        "fast": 15 + 4,
+        "medium": 20 + 4,
+        "slow": 25 + 4,
+        "slower": 40 + 8,
+        "veryslow": 40 + 8,
+    }
+    MAXIMUM_FRAME_THREADS = 16
 
     preset: typing.Literal[
         "ultrafast",
@@ -229,18 +283,28 @@ class H265:
         "gray12le",
     ] = "yuv420p10le"
 
-    def to_subprocess_command(self, crf: int) -> list[str]:
+    def to_subprocess_command(self, crf: int, threads: int | None = None) -> list[str]:
         command = [
-            "-c:v libx265",
-            f"-preset {self.preset}",
-            f"-pix_fmt {self.bitdepth}",
-            f"-crf {crf}",
+            "-c:v", "libx265",
+            "-preset", self.preset,
+            "-pix_fmt", self.bitdepth,
+            "-crf", str(crf),
         ]
 
+        if threads is not None:
+            command.extend(["-x265-params", f"pools={threads}"])
+
         return command
 
+    def lookahead_frames(self, threads: int | None = None) -> int:
+        """
+        Frames read before the first encoded frame comes out, at most (+ the frame threads)
+        """
+        threads = threads if threads is not None else os.cpu_count() or 1
+        return self.LOOKAHEAD_FRAMES[self.preset] + min(threads, self.MAXIMUM_FRAME_THREADS)
+
     def output_file(self, output_filename: str, crf_value: int) -> str:
-        return f'"{output_filename}"'
+        return output_filename
 
 
 @dataclasses.dataclass()
@@ -260,21 +324,30 @@ class APPLE_HWENC_H265:  # BUG: Faulty concatenation of video files --> unusable
 
     make_apple_standard: bool = True
 
-    def to_subprocess_command(self, crf: int) -> list[str]:
+    def to_subprocess_command(self, crf: int, threads: int | None = None) -> list[str]:
+        # (hardware encoder --> `threads` doesn't apply)
         command = [
-            "-c:v hevc_videotoolbox",
-            f"-pix_fmt {self.bitdepth}",
-            f"-q:v {-crf}",
-            # f"-q:v {max(self.ACCEPTED_CRF_RANGE) - crf}",
+            "-c:v", "hevc_videotoolbox",
+            "-pix_fmt", self.bitdepth,
+            "-q:v", str(-crf),
+            # "-q:v", str(max(self.ACCEPTED_CRF_RANGE) - crf),
         ]
 
         if self.make_apple_standard:
-            command.append("-tag:v hvc1")
+            command.extend(["-tag:v", "hvc1"])
 
         return command
 
+    def lookahead_frames(self, threads: int | None = None) -> int:
+        return 16  # (the frames the hardware encoder queues, a guess)
+
     def output_file(self, output_filename: str, crf_value: int) -> str:
-        return f'"{output_filename}"'
+        return output_filename
+
+
+FFMS2_INDEX_DIRECTORY = file_cache.CACHE_DIRECTORY / "ffindex"
+
+_index_build_lock = threading.Lock()
 
 
 class accurate_seek:
@@ -285,26 +358,189 @@ class accurate_seek:
         accurate_seek_method: typing.Literal["ffms2", "bs"],
         # video: v2_target_videoCRF.RawVideoData
         extra_commands: str = "",
+        index_filename: pathlib.Path | None = None,  # (shared ffms2 index)
+        prerender_directory: pathlib.Path | None = None,  # (None --> never prerendered)
+        input_fingerprint: str = "",
     ) -> None:
+        self.video_filename_with_extension: str = video_filename_with_extension
+        self.prerender_directory: pathlib.Path | None = prerender_directory
+        self.input_fingerprint: str = input_fingerprint
+        self.prerendered: dict[tuple[int, int], pathlib.Path] = {}
+        self.prerender_locks: dict[tuple[int, int], threading.Lock] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.accurate_seek_method: typing.Literal["ffms2", "bs"] = accurate_seek_method
+        self.index_filename: pathlib.Path | None = (
+            index_filename if accurate_seek_method == "ffms2" else None
+        )
+
+        source_arguments = f'source="{video_filename_with_extension}"'
+        if self.index_filename is not None:
+            source_arguments += f', cachefile="{self.index_filename.resolve()}"'
+
         self.filename_of_vpy = f"{filename_vpy_without_extension.replace('.', '')}.vpy"
         with open(self.filename_of_vpy, "w") as f:
             text = textwrap.dedent(f"""
                 import vapoursynth as vs
                 core = vs.core
-                clip = core.{accurate_seek_method}.Source(source="{video_filename_with_extension}")
+                clip = core.{accurate_seek_method}.Source({source_arguments})
             """)
             text += extra_commands
             text += "\nclip.set_output(0)"
             _ = f.write(text)
 
+        self.script_sha: str = file_cache.calculate_sha(text)
+
+    def stage(
+        self, start_frame: int | None, end_frame: int | None
+    ) -> process_graph.Stage:
+        if (
+            start_frame is not None
+            and end_frame is not None
+            and (prerendered := self._prerendered_stage(start_frame, end_frame))
+            is not None
+        ):
+            return prerendered
+        return self._vspipe_stage(start_frame, end_frame)
+
+    def _vspipe_stage(
+        self, start_frame: int | None, end_frame: int | None
+    ) -> process_graph.Stage:
+        arguments = ["vspipe"]
+        if start_frame is not None and start_frame != 0:
+            arguments.extend(["-s", str(start_frame)])
+        if end_frame is not None:
+            arguments.extend(["-e", str(end_frame - 1)])
+        arguments.extend(["-c", "y4m", self.filename_of_vpy, "-"])
+        return process_graph.Stage("vspipe", arguments)
+
     def command(self, start_frame: int | None, end_frame: int | None) -> str:
-        start = (
-            f"-s {start_frame}"
-            if (start_frame is not None and start_frame != 0)
-            else ""
+        # (only for printing)
+        return str(self.stage(start_frame, end_frame))
+
+    def prerender_filename(self, start_frame: int, end_frame: int) -> pathlib.Path:
+        assert self.prerender_directory is not None
+        return (
+            self.prerender_directory
+            / f"{self.input_fingerprint}-{self.script_sha[:16]}-{start_frame}-{end_frame}.mkv"
+        )
+
+    def _prerendered_stage(
+        self, start_frame: int, end_frame: int
+    ) -> process_graph.Stage | None:
+        """
+        Decode of the lossless prerender that contains the frames (if there is one)
+        """
+        if self.prerender_directory is None:
+            return None
+        with self.lock:
+            # (the exact frames may be on disk from a previous run)
+            candidates = [
+                ((start_frame, end_frame), self.prerender_filename(start_frame, end_frame))
+            ] + [
+                (frames, filename)
+                for frames, filename in self.prerendered.items()
+                if frames[0] <= start_frame and end_frame <= frames[1]
+            ]
+        for (chunk_start, chunk_end), filename in candidates:
+            if not filename.is_file():  # (garbage collected)
+                continue
+            cache_gc.touch(filename)
+            arguments = [
+                "ffmpeg",
+                "-hide_banner", "-loglevel", "error",
+                "-i", str(filename),
+            ]
+            if (chunk_start, chunk_end) != (start_frame, end_frame):
+                arguments.extend(
+                    [
+                        "-vf",
+                        f"trim=start_frame={start_frame - chunk_start}:end_frame={end_frame - chunk_start},setpts=PTS-STARTPTS",
+                    ]
+                )
+            arguments.extend(["-f", "yuv4mpegpipe", "-strict", "-1", "-"])
+            profiling.count("prerender reads")
+            return process_graph.Stage("ffv1 decode", arguments)
+        return None
+
+    def prerender(self, start_frame: int, end_frame: int) -> pathlib.Path | None:
+        """
+        Renders the filtered frames once to a lossless FFV1 file, that every later
+        `stage(...)` inside of the frames reads instead of running the script again
+        """
+        if self.prerender_directory is None:
+            return None
+        filename = self.prerender_filename(start_frame, end_frame)
+        with self.lock:
+            frames_lock = self.prerender_locks.setdefault(
+                (start_frame, end_frame), threading.Lock()
+            )
+
+        with frames_lock:
+            if not filename.is_file():
+                _ = cache_gc.enforce_quota()
+                filename.parent.mkdir(parents=True, exist_ok=True)
+                temporary_filename = filename.with_suffix(".tmp.mkv")
+                _ = process_graph.run(
+                    process_graph.Stage(
+                        "ffv1 encode",
+                        [
+                            "ffmpeg",
+                            "-hide_banner", "-loglevel", "error",
+                            "-i", "-",
+                            "-c:v", "ffv1",
+                            "-level", "3",
+                            "-slices", "16",
+                            "-g", "1",
+                            "-y", str(temporary_filename),
+                        ],
+                        stdin=self._vspipe_stage(start_frame, end_frame),
+                    )
+                )
+                os.replace(temporary_filename, filename)
+            cache_gc.touch(filename)
+
+        with self.lock:
+            self.prerendered[start_frame, end_frame] = filename
+        return filename
+
+    def build_index(self) -> None:
+        """
+        Builds the ffms2 index once (before the workers start), instead of the first
+        vspipe calls racing to build it
+        """
+        if self.index_filename is None:
+            return
+        with _index_build_lock:
+            if self.index_filename.is_file():
+                return
+            self.index_filename.parent.mkdir(parents=True, exist_ok=True)
+            temporary_index = self.index_filename.with_suffix(".ffindex.tmp")
+            print(f"Building ffms2 index of {self.video_filename_with_extension}")
+            _ = process_graph.run(
+                process_graph.Stage(
+                    "ffmsindex",
+                    [
+                        "ffmsindex",
+                        "-f",
+                        self.video_filename_with_extension,
+                        str(temporary_index),
+                    ],
+                ),
+                capture_stdout=True,
+            )
+            os.replace(temporary_index, self.index_filename)
+
+    def measure_startup(self, start_frame: int) -> float:
+        """
+        Time for vspipe to open the script (+ index) and output one frame at `start_frame`
+        """
+        result = process_graph.run(
+            process_graph.Stage(
+                "vspipe startup", self.stage(start_frame, start_frame + 1).arguments
+            ),
+            capture_stdout=True,
         )
-        end = f"-e {end_frame - 1}" if end_frame is not None else ""
-        return f"vspipe {start} {end} -c y4m {self.filename_of_vpy} -"
+        return result.stages[-1].duration
 
     # @override  # INFO: CHECK IF THIS IS GOOD
     @typing.override
@@ -318,11 +554,28 @@ class accurate_seek:
             print(f"WARNING: Unable to delete file: {self.filename_of_vpy}")
 
 
+file_cache.register_fingerprint(
+    accurate_seek, lambda x: f"accurate_seek({x.filename_of_vpy},{x.script_sha})"
+)
+
+
+def _encode_arguments(
+    codec_information: VideoCodec,
+    crf_value: int,
+    keyframe_placement: int | None,
+    threads: int | None = None,  # (of the encoder, None --> its own default)
+) -> list[str]:
+    command = [*codec_information.to_subprocess_command(crf_value, threads), "-an", "-y"]
+    if keyframe_placement is not None:
+        command.extend(["-g", str(keyframe_placement)])
+    return command
+
+
 @file_cache.store_cumulative_time
 def run_ffmpeg_command(
     # video data
     input_file: videodata.RawVideoData,
-    output_file: pathlib.Path | Literal["get bytes data", "get ffmpeg string"],
+    output_file: pathlib.Path | Literal["get bytes data", "get ffmpeg stage"],
     # CRF used
     crf_value: int,
     # compression data
@@ -332,7 +585,8 @@ def run_ffmpeg_command(
     # crop_black_bars: bool,
     keyframe_placement: int | None,
     # input_file_script_seeking: accurate_seek,
-) -> subprocess.CompletedProcess[bytes] | str | None:
+    threads: int | None = None,  # (None --> a lease of the core budget, when run here)
+) -> process_graph.Stage | bytes | None:
     framerate: float = get_video_metadata(
         input_file, input_file.input_filename
     ).frame_rate
@@ -341,43 +595,141 @@ def run_ffmpeg_command(
     assert isinstance(
         input_file.input_filename, accurate_seek
     ), "Can't use 'run_ffmpeg_command' with without full data (must be accurate_seek, not Path)"
-
-    command.append(input_file.input_filename.command(start_frame, end_frame))
+    source_script: accurate_seek = input_file.input_filename
 
     command.extend(
         [
-            "| ffmpeg",
-            "-hide_banner -loglevel error",
-            f"-r {framerate}",
+            "ffmpeg",
+            "-hide_banner", "-loglevel", "error",
+            "-r", str(framerate),
+            "-i", "-",
         ]
     )
 
-    command.append("-i -")
-
-    command.extend(
-        [
-            *codec_information.to_subprocess_command(crf_value),
-            "-an",
-            "-y",
+    def encode_stage_with(threads: int | None) -> process_graph.Stage:
+        encode_command = [
+            *command,
+            *_encode_arguments(
+                codec_information, crf_value, keyframe_placement, threads
+            ),
         ]
-    )
+        if output_file in ("get ffmpeg stage", "get bytes data"):
+            encode_command.extend(["-f", "matroska", "-"])
+        else:
+            encode_command.append(
+                codec_information.output_file(str(output_file), crf_value)
+            )
 
-    if keyframe_placement is not None:
-        command.append(f"-g {keyframe_placement}")
-
-    if output_file == "get ffmpeg string":
-        command.append("-f matroska -")
-        return " ".join(command)
-    elif output_file == "get bytes data":
-        command.append("-f matroska -")
-        return subprocess.run(
-            " ".join(command), shell=True, check=True, capture_output=True
+        return process_graph.Stage(
+            "ffmpeg encode",
+            encode_command,
+            stdin=source_script.stage(start_frame, end_frame),
         )
 
-    command.append(codec_information.output_file(str(output_file), crf_value))
+    if output_file == "get ffmpeg stage":  # (eg to be piped into libvmaf)
+        return encode_stage_with(threads)
 
-    print("FFMPEG COMMAND --> " + " ".join(command))
-    _ = subprocess.run(" ".join(command), shell=True, check=True)
+    with core_budget.get_core_budget().lease() as leased_threads:
+        encode_stage = encode_stage_with(threads if threads is not None else leased_threads)
+        if output_file == "get bytes data":
+            return process_graph.run(encode_stage, capture_stdout=True).stdout
+
+        print(f"FFMPEG COMMAND --> {encode_stage}")
+        _ = process_graph.run(encode_stage)
+
+
+def _tee_muxer_filename(filename: str) -> str:
+    # (the tee muxer splits on "|", and treats "\\" and "'" as escapes)
+    return re.sub(r"([\\'|\[\]])", r"\\\1", filename)
+
+
+def encode_and_pipe_stage(
+    input_file: videodata.RawVideoData,
+    source: process_graph.Upstream,
+    output_file: pathlib.Path | None,
+    crf_value: int,
+    codec_information: VideoCodec,
+    keyframe_placement: int | None,
+    threads: int | None = None,  # (of the encoder, eg `core_budget.split_encode_and_score`)
+) -> process_graph.Stage:
+    """
+    Encode of `source` (the y4m of the section) to stdout as matroska, eg to be piped
+    straight into libvmaf, and also written to `output_file` (tee muxer) if given
+    """
+    framerate: float = get_video_metadata(
+        input_file, input_file.input_filename
+    ).frame_rate
+
+    command: list[str] = [
+        "ffmpeg",
+        "-hide_banner", "-loglevel", "error",
+        "-r", str(framerate),
+        "-i", "-",
+        "-map", "0:v",
+        *_encode_arguments(codec_information, crf_value, keyframe_placement, threads),
+    ]
+    if output_file is None:
+        command.extend(["-f", "matroska", "-"])
+    else:
+        command.extend(
+            [
+                "-f", "tee",
+                f"[f=matroska]{_tee_muxer_filename(codec_information.output_file(str(output_file), crf_value))}|[f=matroska]pipe:1",
+            ]
+        )
+    return process_graph.Stage("ffmpeg encode", command, stdin=source)
+
+
+@file_cache.store_cumulative_time
+def run_ffmpeg_command_multiple_crf(
+    input_file: videodata.RawVideoData,
+    output_files: dict[int, pathlib.Path],  # CRF --> file
+    codec_information: VideoCodec,
+    start_frame: int,
+    end_frame: int,
+    keyframe_placement: int | None,
+) -> None:
+    """
+    One decode (vspipe + the vapoursynth filters) of the section, encoded at every CRF
+    by the same ffmpeg (one output per CRF)
+    """
+    framerate: float = get_video_metadata(
+        input_file, input_file.input_filename
+    ).frame_rate
+
+    assert isinstance(
+        input_file.input_filename, accurate_seek
+    ), "Can't use 'run_ffmpeg_command_multiple_crf' with without full data (must be accurate_seek, not Path)"
+
+    with core_budget.get_core_budget().lease() as threads:
+        command: list[str] = [
+            "ffmpeg",
+            "-hide_banner", "-loglevel", "error",
+            "-r", str(framerate),
+            "-i", "-",
+        ]
+        for crf_value, output_file in output_files.items():
+            command.extend(
+                [
+                    "-map", "0:v",
+                    *_encode_arguments(
+                        codec_information,
+                        crf_value,
+                        keyframe_placement,
+                        core_budget.split_encoders(threads, len(output_files)),
+                    ),
+                    codec_information.output_file(str(output_file), crf_value),
+                ]
+            )
+
+        encode_stage = process_graph.Stage(
+            "ffmpeg encode (multiple CRF)",
+            command,
+            stdin=input_file.input_filename.stage(start_frame, end_frame),
+        )
+        print(f"FFMPEG COMMAND --> {encode_stage}")
+        _ = process_graph.run(encode_stage)
+    profiling.count("decodes saved by multiple CRF encode", len(output_files) - 1)
 
 
 def concatenate_video_files(
@@ -391,14 +743,19 @@ def concatenate_video_files(
     with open("video_list.txt", "w") as file:
         _ = file.write("\n".join(f"file '{x}'" for x in list_of_video_files))
 
-    print(
-        f'RUNNING COMMAND: ffmpeg -f concat -safe 0 -i video_list.txt -c copy -y "{output_filename_with_extension.name}"'
-    )
-    _ = subprocess.run(
-        f'ffmpeg -f concat -safe 0  -i video_list.txt -c copy -y "{output_filename_with_extension.name}"',
-        shell=True,
-        check=True,
+    concat_stage = process_graph.Stage(
+        "ffmpeg concat",
+        [
+            "ffmpeg",
+            "-f", "concat",
+            "-safe", "0",
+            "-i", "video_list.txt",
+            "-c", "copy",
+            "-y", output_filename_with_extension.name,
+        ],
     )
+    print(f"RUNNING COMMAND: {concat_stage}")
+    _ = process_graph.run(concat_stage)
 
     try:
         os.remove("video_list.txt")
@@ -427,16 +784,131 @@ class VideoMetadata:
     # is_HDR: bool
 
 
+@dataclasses.dataclass()
+class StreamInfo:
+    index: int
+    codec_type: str
+    codec_name: str
+    language: str | None
+
+
+# containers where `nb_frames` comes from the index (sample table) --> reliable
+NB_FRAMES_RELIABLE_FORMATS = ("mov", "mp4")
+# codecs where a packet isn't always one frame (packed B-frames, field pictures)
+PACKET_COUNT_UNRELIABLE_CODECS = ("mpeg4", "msmpeg4v3", "mpeg2video", "mpeg1video")
+
+
+def media_catalog_key(
+    video_data: videodata.RawVideoData, video_for_metadata: pathlib.Path | accurate_seek
+) -> str:
+    if isinstance(video_for_metadata, accurate_seek):
+        return f"{video_data.sha256_of_input}-{video_for_metadata.script_sha}"
+    if video_for_metadata == video_data.raw_input_filename:
+        return video_data.sha256_of_input
+    return media_catalog.file_fingerprint(video_for_metadata)
+
+
 # BUG: this function needs porting over (haven't done yet because cyclic import needs fixing)
 @file_cache.store_cumulative_time
-@file_cache.cache(persistent_after_termination=False)
 def get_video_metadata(
     # filename: str,
     # input_file_vapoursynth: accurate_seek | str,
     video_data: videodata.RawVideoData,
     video_for_metadata: pathlib.Path | accurate_seek,
 ) -> VideoMetadata:
-    def make_video_metadata(json_data: dict[str, dict]) -> VideoMetadata:
+    """
+    Served from the (persistent) media catalog --> each input is only probed once
+    """
+    assert isinstance(video_data, videodata.RawVideoData), "video_data is incorrect"
+
+    assert isinstance(video_for_metadata, accurate_seek) or isinstance(
+        video_for_metadata, pathlib.Path
+    ), "INCORRECT INPUT DATA"
+
+    return media_catalog.get_or_calculate(
+        media_catalog_key(video_data, video_for_metadata),
+        "metadata",
+        lambda: _probe_video_metadata(video_data, video_for_metadata),
+    )
+
+
+def get_stream_layout(
+    video_data: videodata.RawVideoData, video_for_metadata: pathlib.Path
+) -> list[StreamInfo]:
+    """
+    Usually stored by the probe of `get_video_metadata`, else (eg its metadata was cataloged
+    before the stream layout was) probed on its own --> never an empty guess
+    """
+    return media_catalog.get_or_calculate(
+        media_catalog_key(video_data, video_for_metadata),
+        "streams",
+        lambda: _stream_layout(_run_ffprobe(["-show_streams", str(video_for_metadata)])),
+    )
+
+
+def contains_audio(video_data: videodata.RawVideoData) -> bool:
+    return any(
+        x.codec_type == "audio"
+        for x in get_stream_layout(video_data, video_data.raw_input_filename)
+    )
+
+
+def _run_ffprobe(arguments: list[str]) -> dict:
+    return json.loads(
+        process_graph.run(
+            process_graph.Stage(
+                "ffprobe",
+                ["ffprobe", "-v", "quiet", "-print_format", "json", *arguments],
+            ),
+            capture_stdout=True,
+        ).stdout
+    )
+
+
+def _stream_layout(json_data: dict) -> list[StreamInfo]:
+    return [
+        StreamInfo(
+            index=int(x["index"]),
+            codec_type=x["codec_type"],
+            codec_name=x.get("codec_name", ""),
+            language=x.get("tags", {}).get("language"),
+        )
+        for x in json_data["streams"]
+    ]
+
+
+def _pix_fmt_from_vapoursynth_format(format_name: str) -> str:
+    # eg YUV420P10 --> yuv420p10le, GRAY8 --> gray
+    if (match := re.fullmatch(r"(YUV4\d\dP|GRAY)(\d+)", format_name)) is None:
+        return format_name.lower()
+    bits = int(match.group(2))
+    return match.group(1).lower() + ("" if bits == 8 else f"{bits}le")
+
+
+def frame_bytes(pix_fmt: str, width: int, height: int) -> int:
+    """
+    Size of one raw frame, eg of the y4m output of vspipe (planar YUV/GBR/gray, anything
+    else --> as big as 4:4:4 at 16 bits)
+    """
+    match = re.fullmatch(r"(yuvj?|gbr|gray)(4\d\d)?p?(\d+)?(le|be)?", pix_fmt)
+    if match is None:
+        return width * height * 3 * 2
+    family, subsampling, bits, _ = match.groups()
+    if family == "gray":
+        samples_per_pixel = 1.0
+    elif family == "gbr" or subsampling is None:
+        samples_per_pixel = 3.0
+    else:  # (J:a:b --> 8 luma and 2 * (a + b) chroma samples per 4x2 pixels)
+        samples_per_pixel = (8 + 2 * (int(subsampling[1]) + int(subsampling[2]))) / 8
+    bytes_per_sample = 1 if bits is None or int(bits) <= 8 else 2
+    return int(width * height * samples_per_pixel * bytes_per_sample)
+
+
+def _probe_video_metadata(
+    video_data: videodata.RawVideoData,
+    video_for_metadata: pathlib.Path | accurate_seek,
+) -> VideoMetadata:
+    def make_video_metadata(json_data: dict[str, dict], total_frames: int) -> VideoMetadata:
         first_stream_with_video: dict[str, str | int] = [
             x for x in json_data["streams"] if x["codec_type"] == "video"
         ][0]
@@ -455,7 +927,7 @@ def get_video_metadata(
             width=int(first_stream_with_video["width"]),
             height=int(first_stream_with_video["height"]),
             frame_rate=float(eval(first_stream_with_video["r_frame_rate"])),
-            total_frames=int(first_stream_with_video["nb_read_frames"]),
+            total_frames=total_frames,
             pix_fmt=first_stream_with_video["pix_fmt"],
             codec=first_stream_with_video["codec_name"],
             start_time=float(json_data["format"]["start_time"]),
@@ -469,36 +941,106 @@ def get_video_metadata(
             # bitrate=int(json_data["format"]["bit_rate"]),
         )
 
-    assert isinstance(video_data, videodata.RawVideoData), "video_data is incorrect"
+    if isinstance(video_for_metadata, accurate_seek):
+        # fast path: vapoursynth knows the output frames without decoding them
+        try:
+            info_text = process_graph.run(
+                process_graph.Stage(
+                    "vspipe --info",
+                    ["vspipe", "--info", video_for_metadata.filename_of_vpy, "-"],
+                ),
+                capture_stdout=True,
+            ).stdout.decode()
+            info = dict(
+                x.split(": ", maxsplit=1) for x in info_text.splitlines() if ": " in x
+            )
+            frame_rate = float(eval(info["FPS"].split()[0]))
+            total_frames = int(info["Frames"])
+            return VideoMetadata(
+                file_name=video_for_metadata.filename_of_vpy,
+                width=int(info["Width"]),
+                height=int(info["Height"]),
+                frame_rate=frame_rate,
+                total_frames=total_frames,
+                pix_fmt=_pix_fmt_from_vapoursynth_format(info["Format Name"]),
+                codec="rawvideo",
+                start_time=0.0,
+                duration=total_frames / frame_rate,
+                contains_audio=False,
+                file_size=0,
+            )
+        except (subprocess.CalledProcessError, KeyError, ValueError) as e:
+            print(f"WARNING: vspipe --info failed ({e}), decoding all frames instead")
+
+        json_data: dict = json.loads(
+            process_graph.run(
+                process_graph.Stage(
+                    "ffprobe",
+                    [
+                        "ffprobe", "-v", "quiet", "-print_format", "json",
+                        "-show_format", "-show_streams", "-count_frames",
+                        "-",
+                    ],
+                    stdin=video_for_metadata.stage(None, None),
+                ),
+                capture_stdout=True,
+            ).stdout
+        )
+        first_stream_with_video = [
+            x for x in json_data["streams"] if x["codec_type"] == "video"
+        ][0]
+        return make_video_metadata(
+            json_data, int(first_stream_with_video["nb_read_frames"])
+        )
 
-    assert isinstance(video_for_metadata, accurate_seek) or isinstance(
-        video_for_metadata, pathlib.Path
-    ), "INCORRECT INPUT DATA"
+    json_data = _run_ffprobe(["-show_format", "-show_streams", str(video_for_metadata)])
 
-    # command = video_data.input_filename
-    if isinstance(video_for_metadata, accurate_seek):
-        command = f"<({video_for_metadata.command(None, None)})"
-    # elif isinstance(command, Path):
-    # elif isinstance(video_for_metadata, pathlib.Path):
-    #     command = f'"{video_for_metadata}"'
-    else:
-        command = f'"{video_for_metadata}"'
-        # command = f'<(cat "{video_for_metadata})"'
+    media_catalog.store(
+        media_catalog_key(video_data, video_for_metadata),
+        "streams",
+        _stream_layout(json_data),
+    )
 
-    data = subprocess.run(
-        f"zsh -c 'ffprobe -v quiet -print_format json -show_format -show_streams -count_frames {command}'",
-        # if isinstance(input_file_vapoursynth, str)
-        # else f"{input_file_vapoursynth.command(None, None)} ffprobe -v quiet -print_format json -show_format -show_streams -count_frames -",
-        check=True,
-        shell=True,
-        capture_output=True,
-    ).stdout.decode()
+    first_stream_with_video = [
+        x for x in json_data["streams"] if x["codec_type"] == "video"
+    ][0]
+    is_progressive = first_stream_with_video.get("field_order", "progressive") in (
+        "progressive",
+        "unknown",
+    )
 
-    json_data: dict = json.loads(data)
-    # print("json data")
-    # print(json_data)
+    # 1. container frame count, 2. packet count (demux only), 3. decode every frame
+    if (
+        any(x in json_data["format"]["format_name"] for x in NB_FRAMES_RELIABLE_FORMATS)
+        and "nb_frames" in first_stream_with_video
+        and is_progressive
+    ):
+        total_frames = int(first_stream_with_video["nb_frames"])
+    elif (
+        is_progressive
+        and first_stream_with_video["codec_name"] not in PACKET_COUNT_UNRELIABLE_CODECS
+    ):
+        packet_data = _run_ffprobe(
+            [
+                "-count_packets",
+                "-select_streams", "v:0",
+                "-show_entries", "stream=nb_read_packets",
+                str(video_for_metadata),
+            ]
+        )
+        total_frames = int(packet_data["streams"][0]["nb_read_packets"])
+    else:
+        frame_data = _run_ffprobe(
+            [
+                "-count_frames",
+                "-select_streams", "v:0",
+                "-show_entries", "stream=nb_read_frames",
+                str(video_for_metadata),
+            ]
+        )
+        total_frames = int(frame_data["streams"][0]["nb_read_frames"])
 
-    return make_video_metadata(json_data)
+    return make_video_metadata(json_data, total_frames)
 
 
 # {
@@ -658,27 +1200,34 @@ def visual_comparison_of_video_with_blend_filter(
     -c:v libx264 -crf 18 -c:a copy output.mkv
     """
     print("RUNNING visual_comparison_of_video_with_blend_filter")
-    ffmpeg_command: list[str] = [
-        source_video_path_vapoursynth.command(None, None),
-        "ffmpeg -hide_banner -loglevel error ",
-    ]
+    ffmpeg_command: list[str] = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
     ffmpeg_command.extend(["-i", encoded_video_path])
     # ffmpeg_command.extend(["-i", source_video_path])
     ffmpeg_command.extend(["-i", "-"])
-    ffmpeg_command.append(
-        "-filter_complex '[0:v]setpts=PTS-STARTPTS[first];[1:v]setpts=PTS-STARTPTS[second];[first][second]blend=all_mode=difference'"
+    ffmpeg_command.extend(
+        [
+            "-filter_complex",
+            "[0:v]setpts=PTS-STARTPTS[first];[1:v]setpts=PTS-STARTPTS[second];[first][second]blend=all_mode=difference",
+        ]
     )
 
-    ffmpeg_command.append(
-        f'-c:v libx264 -y -crf {quality_crf_h264} -an "{output_filename_with_extension}"'
+    ffmpeg_command.extend(
+        [
+            "-c:v", "libx264",
+            "-y",
+            "-crf", str(quality_crf_h264),
+            "-an",
+            output_filename_with_extension,
+        ]
+    )
+    blend_stage = process_graph.Stage(
+        "ffmpeg blend",
+        ffmpeg_command,
+        stdin=source_video_path_vapoursynth.stage(None, None),
     )
     try:
-        print(" ".join(ffmpeg_command))
-        _ = subprocess.run(
-            " ".join(ffmpeg_command),
-            shell=True,
-            check=True,
-        )
+        print(blend_stage)
+        _ = process_graph.run(blend_stage)
     except subprocess.CalledProcessError:
         print("ERROR FAILED TO OUTPUT VISUAL COMPARISON (with blend filter)")
 
@@ -698,15 +1247,26 @@ def combine_audio_and_subtitle_streams_from_another_video(
     # try:
     commands: list[str] = []
     if audio_commands is not None:
-        commands.append(audio_commands)
+        commands.extend(shlex.split(audio_commands))
     if subtitle_commands is not None:
-        commands.append(subtitle_commands)
-
-    _ = subprocess.run(
-        # f"zsh -c 'ffmpeg -i <(cat \"{input_file_name_with_extension}\") -i <(cat \"{output_file_name_with_extension}\") -map 1:v -map 0:a\\? -map 0:s\\? -c:v copy -y {' '.join(commands)} {intermediate_file}'",
-        f"zsh -c 'ffmpeg -i \"{input_file_name_with_extension}\" -i \"{output_file_name_with_extension}\" -map 1:v -map 0:a\\? -map 0:s\\? -c:v copy -y {' '.join(commands)} {intermediate_file}'",
-        shell=True,
-        check=True,
+        commands.extend(shlex.split(subtitle_commands))
+
+    _ = process_graph.run(
+        process_graph.Stage(
+            "ffmpeg mux audio+subtitles",
+            [
+                "ffmpeg",
+                "-i", str(input_file_name_with_extension),
+                "-i", str(output_file_name_with_extension),
+                "-map", "1:v",
+                "-map", "0:a?",
+                "-map", "0:s?",
+                "-c:v", "copy",
+                "-y",
+                *commands,
+                intermediate_file,
+            ],
+        )
     )
 
     os.remove(output_file_name_with_extension)
@@ -1,10 +1,17 @@
 from dataclasses import dataclass
 from pathlib import Path
 import file_cache
+import core_budget
 import ffmpeg
 import os
 import json
+import math
 import subprocess
+import sys
+import tempfile
+import threading
+import process_graph
+import profiling
 # from rich import print
 
 
@@ -18,8 +25,163 @@ _ = install(show_locals=True)
 
 type heuristic = VMAF
 
+
+@dataclass()
+class scoredvideo:
+    score: float  # (pooled, same as `summary_of_overall_video`)
+    throughout: list[float]  # (per frame, same as `throughout_video`)
+    # (lower, upper) --> `score` is only an estimate from the start of the video
+    bound: tuple[float, float] | None = None
+
+
+# streaming probes: one encode, scored window by window (`libvmaf_windows.py`), stopped once
+# the side of the target is settled
+STREAMING_WINDOW_FRAMES = 48
+STREAMING_MINIMUM_WINDOWS = 6  # (neighbouring windows are alike --> not too few samples)
+STREAMING_CONFIDENCE_Z = 2.58  # (99%, two sided)
+STREAMING_MINIMUM_DEVIATION = 0.5  # (of the window means, eg a static scene)
+LIBVMAF_WINDOWS_SCRIPT = Path(__file__).with_name("libvmaf_windows.py")
+
+# (frames libvmaf's ffmpeg queues per input, on top of the encoder's lookahead)
+REFERENCE_LAG_MARGIN_FRAMES = 16
+
 # PROGRAM ASSUMPTION --> Bigger heuristic is better!
 
+
+def _libvmaf_stage(
+    video_data: videodata.RawVideoData,
+    compressed_video: Path | process_graph.Stage,
+    source_start_end_frame: tuple[int | None, int | None],
+    libvmaf_options: str,
+    loglevel: str | None,
+    reference_source: process_graph.Upstream | None = None,
+) -> process_graph.Stage:
+    """
+    ffmpeg -i <distorted> -i <reference> -lavfi libvmaf
+    - the reference (vspipe, or `reference_source`) is piped into stdin
+    - the distorted video is a file, or an encode piped in as an extra fd (`pipe:N`)
+    """
+    frame_rate = ffmpeg.get_video_metadata(
+        video_data, video_data.input_filename
+    ).frame_rate
+
+    ffmpeg_command: list[str] = ["ffmpeg", "-hide_banner"]
+    if loglevel is not None:
+        ffmpeg_command.extend(["-loglevel", loglevel])
+
+    pipe_inputs: list[process_graph.Stage] = []
+    if isinstance(compressed_video, Path):
+        distorted = str(compressed_video)
+    else:
+        pipe_inputs.append(compressed_video)
+        distorted = process_graph.pipe_input(0)
+    ffmpeg_command.extend(["-r", str(frame_rate), "-i", distorted])
+
+    reference_stage = reference_source
+    if reference_stage is not None:
+        reference = "-"
+    elif isinstance(video_data.input_filename, ffmpeg.accurate_seek):
+        reference_stage = video_data.input_filename.stage(*source_start_end_frame)
+        reference = "-"
+    else:
+        reference = str(video_data.input_filename)
+    ffmpeg_command.extend(["-r", str(frame_rate), "-i", reference])
+
+    # https://stackoverflow.com/questions/67598772/right-way-to-use-vmaf-with-ffmpeg
+    ffmpeg_command.extend(
+        [
+            "-an",  # Remove audio
+            "-lavfi",
+            f"[1:v]setpts=PTS-STARTPTS[reference];[0:v]setpts=PTS-STARTPTS[distorted];[distorted][reference]libvmaf={libvmaf_options}",
+            "-f",
+            "null",
+            "-",
+        ]
+    )
+
+    return process_graph.Stage(
+        "libvmaf", ffmpeg_command, stdin=reference_stage, pipe_inputs=pipe_inputs
+    )
+
+
+def _reference_lag_bytes(
+    video_data: videodata.RawVideoData,
+    codec_information: ffmpeg.VideoCodec,
+    encoder_threads: int | None,
+) -> int:
+    """
+    How far libvmaf's reference runs ahead of the encode (teed from the same source): the
+    frames the encoder reads before its first output, in the source's pixel format
+    """
+    metadata = ffmpeg.get_video_metadata(video_data, video_data.input_filename)
+    return (
+        codec_information.lookahead_frames(encoder_threads) + REFERENCE_LAG_MARGIN_FRAMES
+    ) * ffmpeg.frame_bytes(metadata.pix_fmt, metadata.width, metadata.height)
+
+
+def _read_libvmaf_log(log_filename: str) -> list[float]:
+    with open(log_filename, "r") as file:
+        json_of_file: dict[str, list[dict[str, dict[str, int]]]] = json.loads(
+            file.read()
+        )
+        # This type-hint is not fully accurate --> but works for this
+    return [frame["metrics"]["vmaf"] for frame in json_of_file["frames"]]
+
+
+def _run_scored(
+    libvmaf_stage: process_graph.Stage,
+    log_filename: str,
+    cancel_event: threading.Event | None = None,
+) -> scoredvideo:
+    print(f"FFMPEG COMMAND: {libvmaf_stage}")
+    try:
+        ffmpeg_output = process_graph.run(libvmaf_stage, cancel_event=cancel_event).stderr
+        return scoredvideo(
+            score=float(
+                [x for x in ffmpeg_output.splitlines() if "VMAF score" in x][0].split()[-1]
+            ),
+            throughout=_read_libvmaf_log(log_filename),
+        )
+    finally:
+        try:
+            os.remove(log_filename)
+        except FileNotFoundError:
+            pass
+
+
+def _confidence_interval(
+    windows: list[list[float]], total_frames: int
+) -> tuple[float, float] | None:
+    """
+    Of the mean of all `total_frames`, from the windows scored so far (the window means
+    as the samples --> the frames of a window are far from independent)
+    """
+    if len(windows) < STREAMING_MINIMUM_WINDOWS:
+        return None
+    means = [sum(x) / len(x) for x in windows]
+    frames_scored = sum(len(x) for x in windows)
+    mean = sum(x for window in windows for x in window) / frames_scored
+    deviation = max(
+        STREAMING_MINIMUM_DEVIATION,
+        math.sqrt(sum((x - mean) ** 2 for x in means) / (len(means) - 1)),
+    )
+    # (finite population correction --> nothing left to estimate at the end)
+    standard_error = (deviation / math.sqrt(len(means))) * math.sqrt(
+        max(0.0, 1 - frames_scored / total_frames)
+    )
+    return (
+        mean - STREAMING_CONFIDENCE_Z * standard_error,
+        mean + STREAMING_CONFIDENCE_Z * standard_error,
+    )
+
+
+def _log_filename() -> str:
+    # (unique, the scenes are scored in parallel)
+    file_descriptor, log_filename = tempfile.mkstemp(prefix="vmaf-", suffix=".json")
+    os.close(file_descriptor)
+    return log_filename
+
+
 # def video_to_shell_input(input: Path | str) -> str:
 #     if isinstance(input, Path):
 #         return f"cat {}"
@@ -48,180 +210,261 @@ class VMAF:
     def summary_of_overall_video(
         self,
         video_data: videodata.RawVideoData,
-        compressed_video: Path | str,  # | subprocess.CompletedProcess[bytes],
+        compressed_video: Path | process_graph.Stage,  # (stage --> piped, never written)
         source_start_end_frame: tuple[int | None, int | None] = (None, None),
-        threads_to_use: int = 6,
+        threads_to_use: int | None = None,  # (None --> a lease of the core budget)
         subsample: int = 2,  # Calculate per X frames
     ) -> float:
         print("Running FFMPEG COMMAND for vmaf")
 
-        frame_rate = ffmpeg.get_video_metadata(
-            video_data, video_data.input_filename
-        ).frame_rate
-
-        ffmpeg_command: list[str] = []
-
-        if isinstance(video_data.input_filename, ffmpeg.accurate_seek):
-            ffmpeg_command.append(
-                video_data.input_filename.command(*source_start_end_frame)
+        with core_budget.get_core_budget().lease() as leased_threads:
+            libvmaf_stage = _libvmaf_stage(
+                video_data,
+                compressed_video,
+                source_start_end_frame,
+                f"n_threads={threads_to_use or leased_threads}:n_subsample={subsample}",
+                loglevel=None,  # (need to read the output!)
             )
 
-        ffmpeg_command.append(" | ffmpeg")
-
-        ffmpeg_command.append(f"-r {str(frame_rate)}")
-
-        if isinstance(compressed_video, Path):
-            command = f'"{compressed_video}"'
-        else:  # elif isinstance(compressed_video, str):
-            # command = f'<(cat "{compressed_video}")'
-            command = f"<({compressed_video})"
-        # else:  # CompletedProcess[bytes]
-        #     command = "-"
-
-        ffmpeg_command.append(f"-i {command}")
-
-        ffmpeg_command.append(f"-r {str(frame_rate)}")
-
-        # command = (
-        #     f"cat {video_data.input_filename}"
-        #     if isinstance(video_data.input_filename, Path)
-        #     else f"{video_data.input_filename}"
-        # )
-        ffmpeg_command.append("-i -")
-
-        # https://www.bannerbear.com/blog/how-to-trim-a-video-using-ffmpeg/#:~:text=You%20can%20trim%20the%20input%20video%20to%20a%20specific%20duration,the%20beginning%20of%20the%20video.&text=In%20the%20command%20above%2C%20%2Dvf,the%20duration%20to%203%20seconds.
-        # https://stackoverflow.com/questions/67598772/right-way-to-use-vmaf-with-ffmpeg
-
-        # [reference]scale=1920:1080
-        # scale = ""
-        # if resize_input_black_bars:
-        #     scale = crop_black_bars_size(vapoursynth_accurate_seek)
-        #     scale = f"[reference]{scale};"
-
-        ffmpeg_command.extend(
-            [
-                "-hide_banner",  #  -loglevel error --> need to read output!
-                "-an",
-                "-lavfi",
-                f'"[1:v]setpts=PTS-STARTPTS[reference];[0:v]setpts=PTS-STARTPTS[distorted];[distorted][reference]libvmaf=n_threads={threads_to_use}:n_subsample={subsample}"',
-                # f'"libvmaf=n_threads={threads_to_use}:n_subsample={subsample}"',
-                "-f",
-                "null",
-                "-",
-            ]
-        )
-
-        print(f"FFMPEG COMMAND: {' '.join(ffmpeg_command)}")
-        try:
-            output_data = subprocess.run(
-                f"zsh -c '{' '.join(ffmpeg_command)}'",
-                shell=True,
-                check=True,
-                capture_output=True,
-                # stdin=compressed_video.stdout
-                # if isinstance(compressed_video, subprocess.CompletedProcess)
-                # else None,
-            )
-            ffmpeg_output: str = output_data.stderr.decode()
-        except FileNotFoundError as e:
-            print("WARNING: FFMPEG NOT FOUND ON SYSTEM!!")
-            raise e
-        except subprocess.CalledProcessError as e:
-            print("Process failed because did not return a successful return code.")
-            raise e
+            print(f"FFMPEG COMMAND: {libvmaf_stage}")
+            try:
+                ffmpeg_output = process_graph.run(libvmaf_stage).stderr
+            except FileNotFoundError as e:
+                print("WARNING: FFMPEG NOT FOUND ON SYSTEM!!")
+                raise e
+            except subprocess.CalledProcessError as e:
+                print("Process failed because did not return a successful return code.")
+                raise e
 
         return float(
             [x for x in ffmpeg_output.splitlines() if "VMAF score" in x][0].split()[-1]
         )
 
-    # @file_cache.cache()
     @file_cache.store_cumulative_time
-    def throughout_video(
+    def summary_of_encode(
         self,
         video_data: videodata.RawVideoData,
-        compressed_video: Path | str,
-        source_start_end_frame: tuple[int | None, int | None] = (None, None),
-        threads_to_use: int = 6,
+        output_file: Path | None,
+        crf_value: int,
+        codec_information: ffmpeg.VideoCodec,
+        source_start_end_frame: tuple[int, int],
+        keyframe_placement: int | None,
+        threads_to_use: int | None = None,  # (of libvmaf, None --> its share of a lease)
         subsample: int = 1,
-    ) -> list[float]:
-        print("Running FFMPEG COMMAND for vmaf")
-
-        frame_rate = ffmpeg.get_video_metadata(
-            video_data, video_data.input_filename
-        ).frame_rate
-
-        ffmpeg_command: list[str] = []
-
-        if isinstance(video_data.input_filename, ffmpeg.accurate_seek):
-            ffmpeg_command.append(
-                video_data.input_filename.command(*source_start_end_frame)
+        cancel_event: threading.Event | None = None,
+    ) -> scoredvideo:
+        """
+        Encodes the section and scores it in one pass: the source is decoded once, and
+        teed to both the encoder and the libvmaf reference
+        (the encode is piped straight into libvmaf, and written to `output_file` if given)
+        """
+        assert isinstance(
+            video_data.input_filename, ffmpeg.accurate_seek
+        ), "summary_of_encode needs accurate_seek (not Path)"
+
+        with core_budget.get_core_budget().lease() as leased_threads:
+            encoder_threads, libvmaf_threads = core_budget.split_encode_and_score(
+                leased_threads
+            )
+            source = process_graph.Tee(
+                video_data.input_filename.stage(*source_start_end_frame),
+                2,
+                [
+                    process_graph.DEFAULT_TEE_BUFFER_BYTES,
+                    _reference_lag_bytes(video_data, codec_information, encoder_threads),
+                ],
+            )
+            encode_stage = ffmpeg.encode_and_pipe_stage(
+                video_data,
+                source.branch(0),
+                output_file,
+                crf_value,
+                codec_information,
+                keyframe_placement,
+                encoder_threads,
+            )
+            log_filename = _log_filename()
+            return _run_scored(
+                _libvmaf_stage(
+                    video_data,
+                    encode_stage,
+                    source_start_end_frame,
+                    f"n_threads={threads_to_use or libvmaf_threads}:n_subsample={subsample}:log_fmt=json:log_path={log_filename}",
+                    loglevel=None,  # (need to read the output!)
+                    reference_source=source.branch(1),
+                ),
+                log_filename,
+                cancel_event,
             )
 
-        ffmpeg_command.append(" | ffmpeg")
-
-        ffmpeg_command.append(f"-r {str(frame_rate)}")
+    @file_cache.store_cumulative_time
+    def streaming_summary_of_encode(
+        self,
+        video_data: videodata.RawVideoData,
+        crf_value: int,
+        codec_information: ffmpeg.VideoCodec,
+        source_start_end_frame: tuple[int, int],
+        keyframe_placement: int | None,
+        threads_to_use: int | None = None,  # (of libvmaf, None --> its share of a lease)
+        window_frames: int = STREAMING_WINDOW_FRAMES,
+        cancel_event: threading.Event | None = None,
+        target_score: float | None = None,  # (None --> `self.target_score`)
+    ) -> scoredvideo:
+        """
+        `summary_of_encode` (never written to a file) as one continuous encode, its frames
+        scored window by window as they come out of the encoder --> the graph is stopped as
+        soon as the confidence interval of the score is entirely above/below `target_score`
+        (`scoredvideo.bound`, the score is the estimate so far)
+        vspipe --> tee --> ffmpeg encode --> ffmpeg decode (y4m) --> libvmaf_windows.py
+                       `-------------------- the reference -------------^
+        """
+        assert isinstance(
+            video_data.input_filename, ffmpeg.accurate_seek
+        ), "streaming_summary_of_encode needs accurate_seek (not Path)"
+        target_score = self.target_score if target_score is None else target_score
+        start_frame, end_frame = source_start_end_frame
+        total_frames = end_frame - start_frame
+
+        with core_budget.get_core_budget().lease() as leased_threads:
+            encoder_threads, libvmaf_threads = core_budget.split_encode_and_score(
+                leased_threads
+            )
+            source = process_graph.Tee(
+                video_data.input_filename.stage(start_frame, end_frame),
+                2,
+                [
+                    process_graph.DEFAULT_TEE_BUFFER_BYTES,
+                    _reference_lag_bytes(video_data, codec_information, encoder_threads),
+                ],
+            )
+            encode_stage = ffmpeg.encode_and_pipe_stage(
+                video_data,
+                source.branch(0),
+                None,
+                crf_value,
+                codec_information,
+                keyframe_placement,
+                encoder_threads,
+            )
+            decode_stage = process_graph.Stage(
+                "ffmpeg decode",
+                [
+                    "ffmpeg",
+                    "-hide_banner", "-loglevel", "error",
+                    "-i", "-",
+                    "-f", "yuv4mpegpipe", "-strict", "-1",
+                    "-",
+                ],
+                stdin=encode_stage,
+            )
+            windows_stage = process_graph.Stage(
+                "libvmaf windows",
+                [
+                    sys.executable,
+                    str(LIBVMAF_WINDOWS_SCRIPT),
+                    "--window", str(window_frames),
+                    "--libvmaf-options", f"n_threads={threads_to_use or libvmaf_threads}",
+                    process_graph.pipe_input(0),
+                ],
+                stdin=decode_stage,
+                pipe_inputs=[source.branch(1)],
+            )
 
-        # command = (
-        #     f'cat "{compressed_video}"'
-        #     if isinstance(compressed_video, Path)
-        #     else f"{compressed_video}"
-        # )
-        # ffmpeg_command.append(f"-i <({command})")
-        if isinstance(compressed_video, Path):
-            command = f'"{compressed_video}"'
-        else:  # elif isinstance(compressed_video, str):
-            command = f"<({compressed_video})"
+            throughout: list[float] = []
+            bound: list[tuple[float, float]] = []  # (set once --> the graph is stopped)
+
+            def on_score(line: bytes) -> None:
+                if not line.endswith(b"\n"):  # (cut off by `graph.stop()`)
+                    return
+                throughout.append(float(line))
+                if bound or len(throughout) % window_frames != 0:
+                    return
+                if len(throughout) < total_frames and (
+                    interval := _confidence_interval(
+                        [
+                            throughout[x : x + window_frames]
+                            for x in range(0, len(throughout), window_frames)
+                        ],
+                        total_frames,
+                    )
+                ) is not None and not (interval[0] <= target_score <= interval[1]):
+                    bound.append(interval)
+                    graph.stop()
+
+            graph = process_graph.ProcessGraph(
+                windows_stage, cancel_event=cancel_event, on_stdout_line=on_score
+            )
+            print(f"FFMPEG COMMAND: {windows_stage}")
+            _ = graph.run()
 
-        ffmpeg_command.append(f"-i {command}")
+        if bound:
+            # (the scores read before the graph was killed, past the settled windows too)
+            profiling.count("streaming probes: stopped early")
+            profiling.count("streaming probes: frames skipped", total_frames - len(throughout))
+            return scoredvideo(sum(throughout) / len(throughout), throughout, bound[0])
+        return scoredvideo(sum(throughout) / len(throughout), throughout)
 
-        ffmpeg_command.append(f"-r {str(frame_rate)}")
+    @file_cache.store_cumulative_time
+    def scored_video(
+        self,
+        video_data: videodata.RawVideoData,
+        compressed_video: Path | process_graph.Stage,
+        source_start_end_frame: tuple[int | None, int | None] = (None, None),
+        threads_to_use: int | None = None,  # (None --> a lease of the core budget)
+        subsample: int = 1,
+    ) -> scoredvideo:
+        """
+        `summary_of_overall_video` and `throughout_video` from the same libvmaf pass
+        """
+        log_filename = _log_filename()
+        with core_budget.get_core_budget().lease() as leased_threads:
+            return _run_scored(
+                _libvmaf_stage(
+                    video_data,
+                    compressed_video,
+                    source_start_end_frame,
+                    f"n_threads={threads_to_use or leased_threads}:n_subsample={subsample}:log_fmt=json:log_path={log_filename}",
+                    loglevel=None,
+                ),
+                log_filename,
+            )
 
-        # command = (
-        #     f"cat {video_data.input_filename}"
-        #     if isinstance(video_data.input_filename, Path)
-        #     else f"{video_data.input_filename}"
-        # )
-        ffmpeg_command.append("-i -")
+    # @file_cache.cache()
+    @file_cache.store_cumulative_time
+    def throughout_video(
+        self,
+        video_data: videodata.RawVideoData,
+        compressed_video: Path | process_graph.Stage,
+        source_start_end_frame: tuple[int | None, int | None] = (None, None),
+        threads_to_use: int | None = None,  # (None --> a lease of the core budget)
+        subsample: int = 1,
+    ) -> list[float]:
+        print("Running FFMPEG COMMAND for vmaf")
 
         LOG_FILE_NAME = f"log-{source_start_end_frame}.json".replace(" ", "").replace(
             ",", ""
         )
 
-        ffmpeg_command.extend(
-            [
-                "-hide_banner -loglevel error",
-                "-an",  # Remove audio
-                "-lavfi",
-                f'"[1:v]setpts=PTS-STARTPTS[reference];[0:v]setpts=PTS-STARTPTS[distorted];[distorted][reference]libvmaf=n_threads={threads_to_use}:n_subsample={subsample}:log_fmt=json:log_path={LOG_FILE_NAME}"',
-                # f'"libvmaf=n_threads={threads_to_use}:n_subsample={subsample}:log_fmt=json:log_path=log.json"',
-                "-f",
-                "null",
-                "-",
-            ]
-        )
-
-        try:
-            print(f"RUNNNING COMMAND: {" ".join(ffmpeg_command)}")
-            _ = subprocess.run(
-                f"zsh -c '{' '.join(ffmpeg_command)}'", shell=True, check=True
+        with core_budget.get_core_budget().lease() as leased_threads:
+            libvmaf_stage = _libvmaf_stage(
+                video_data,
+                compressed_video,
+                source_start_end_frame,
+                f"n_threads={threads_to_use or leased_threads}:n_subsample={subsample}:log_fmt=json:log_path={LOG_FILE_NAME}",
+                loglevel="error",
             )
-        except FileNotFoundError as e:
-            print("WARNING: FFMPEG NOT FOUND ON SYSTEM!!")
-            raise e
-        except subprocess.CalledProcessError as e:
-            print("Process failed because did not return a successful return code.")
-            raise e
-
-        with open(LOG_FILE_NAME, "r") as file:
-            json_of_file: dict[str, list[dict[str, dict[str, int]]]] = json.loads(
-                file.read()
-            )
-            # This type-hint is not fully accurate --> but works for this
-
-            vmaf_data: list[float] = []
 
-            for frame in json_of_file["frames"]:
-                vmaf_data.append(frame["metrics"]["vmaf"])
+            try:
+                print(f"RUNNNING COMMAND: {libvmaf_stage}")
+                _ = process_graph.run(libvmaf_stage)
+            except FileNotFoundError as e:
+                print("WARNING: FFMPEG NOT FOUND ON SYSTEM!!")
+                raise e
+            except subprocess.CalledProcessError as e:
+                print("Process failed because did not return a successful return code.")
+                raise e
+
+        vmaf_data = _read_libvmaf_log(LOG_FILE_NAME)
 
         # print(f"{vmaf_data=}")
         try:
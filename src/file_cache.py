@@ -1,14 +1,18 @@
 from dataclasses import dataclass
 from typing import Any, TypeVar, Callable, cast
+from types import CodeType
+import dataclasses
 import functools
-import os
+import threading
 import pickle
 import inspect
 from hashlib import sha256
 from pathlib import Path
-import time
-from collections import defaultdict
-# import atexit
+from collections import defaultdict, OrderedDict
+import atexit
+import weakref
+import cache_backends
+import profiling
 # from tempfile import TemporaryFile
 
 
@@ -25,11 +29,45 @@ CACHE_DIRECTORY = Path.cwd() / "temporary_cache_dir"
 
 @dataclass()
 class data:
-    cache_filename: Path
+    cache_filename: Path  # (relative to the cache backend)
     cache_data: Any
     delete_afterwards: bool
 
 
+_cache_backend: cache_backends.CacheBackend | None = None
+_cache_backend_lock = threading.Lock()
+
+# (cached function --> whether its arguments are a cache hit, for `is_cached`)
+# (weak --> the cached closures of a scene, eg its probes, aren't kept alive)
+_cache_lookups: weakref.WeakKeyDictionary[Callable[..., Any], Callable[..., bool]] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_cache_backend() -> cache_backends.CacheBackend:
+    """
+    Created on first use (the default is the SQLite store in CACHE_DIRECTORY)
+    """
+    global _cache_backend
+    with _cache_backend_lock:
+        if _cache_backend is None:
+            _cache_backend = cache_backends.SQLiteBackend(
+                CACHE_DIRECTORY / "cache.sqlite3",
+                import_pickle_files_from=CACHE_DIRECTORY,
+            )
+            _ = atexit.register(_cache_backend.flush)
+        return _cache_backend
+
+
+def set_cache_backend(backend: cache_backends.CacheBackend) -> None:
+    global _cache_backend
+    with _cache_backend_lock:
+        if _cache_backend is not None:
+            _cache_backend.flush()
+        _cache_backend = backend
+        _ = atexit.register(backend.flush)
+
+
 # pyright: reportAny=false
 # pyright: reportUnknownParameterType=false
 # pyright: reportMissingParameterType=false
@@ -38,7 +76,158 @@ class data:
 # pyright: reportMissingTypeArgument=false
 
 
-cache_data: list[data] = []
+@dataclass
+class cachestatistics:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class MemoryCache:
+    """
+    In-process tier in front of the cache files (dict-indexed, LRU eviction)
+    - evicted entries are still found on disk afterwards
+    - sizes are estimates (size of the pickled data)
+    """
+
+    def __init__(self, byte_budget: int) -> None:
+        self.byte_budget: int = byte_budget
+        self.entries: OrderedDict[str, tuple[data, int]] = OrderedDict()
+        self.bytes_used: int = 0
+        self.statistics: cachestatistics = cachestatistics()
+        # kept separately --> evicted entries must still be cleaned up
+        self.files_to_delete_afterwards: set[Path] = set()
+        # (the scene workers all use the same cache)
+        self.lock: threading.Lock = threading.Lock()
+        self.keys_in_flight: dict[str, threading.Lock] = {}
+
+    def get(self, key: str) -> data | None:
+        with self.lock:
+            if (entry := self.entries.get(key)) is None:
+                return None
+            self.entries.move_to_end(key)
+            self.statistics.memory_hits += 1
+            return entry[0]
+
+    def add(self, key: str, value: data, size_estimate: int) -> None:
+        with self.lock:
+            if value.delete_afterwards:
+                self.files_to_delete_afterwards.add(value.cache_filename)
+
+            if key in self.entries:
+                self.bytes_used -= self.entries.pop(key)[1]
+            if size_estimate > self.byte_budget:
+                return  # (only on disk)
+
+            self.entries[key] = (value, size_estimate)
+            self.bytes_used += size_estimate
+            self._evict(self.byte_budget)
+
+    def evict(self, byte_budget: int) -> None:
+        with self.lock:
+            self._evict(byte_budget)
+
+    def _evict(self, byte_budget: int) -> None:
+        while self.bytes_used > byte_budget and self.entries:
+            _, (_, size_estimate) = self.entries.popitem(last=False)
+            self.bytes_used -= size_estimate
+            self.statistics.evictions += 1
+
+    def key_lock(self, key: str) -> threading.Lock:
+        """
+        Single-flight: concurrent callers of the same key wait for one computation
+        (the locks are never removed, they are tiny compared to the cached data)
+        """
+        with self.lock:
+            return self.keys_in_flight.setdefault(key, threading.Lock())
+
+
+MEMORY_CACHE_BUDGET_BYTES: int = 256 * 1024 * 1024
+
+cache_data = MemoryCache(MEMORY_CACHE_BUDGET_BYTES)
+
+
+def set_memory_cache_budget(byte_budget: int) -> None:
+    cache_data.byte_budget = byte_budget
+    cache_data.evict(byte_budget)
+
+
+# per-type fingerprint hooks --> modules register their own types (eg RawVideoData)
+# so this module doesn't need to import them (would be a cyclic import)
+fingerprint_hooks: dict[type, Callable[[Any], str]] = {}
+
+
+def register_fingerprint(
+    type_to_fingerprint: type, fingerprint_function: Callable[[Any], str]
+) -> None:
+    """
+    The fingerprint must only contain the data that changes the result of the function
+    (eg `sha256_of_input` instead of the whole file)
+    """
+    fingerprint_hooks[type_to_fingerprint] = fingerprint_function
+    _fingerprint_hook_of_type.cache_clear()
+
+
+@functools.cache
+def _fingerprint_hook_of_type(value_type: type) -> Callable[[Any], str] | None:
+    for parent_type in value_type.__mro__:
+        if (hook := fingerprint_hooks.get(parent_type)) is not None:
+            return hook
+    return None
+
+
+@functools.cache
+def _dataclass_field_names(value_type: type) -> tuple[str, ...]:
+    return tuple(x.name for x in dataclasses.fields(value_type))
+
+
+def fingerprint(value: Any) -> str:
+    """
+    Stable, field-level text representation of `value` used for the cache keys
+    """
+    if (hook := _fingerprint_hook_of_type(type(value))) is not None:
+        return hook(value)
+
+    if value is None or isinstance(value, (str, int, float, bool, bytes, range)):
+        return repr(value)
+    if isinstance(value, Path):
+        return f"Path({value})"
+    if isinstance(value, (list, tuple)):
+        return f"[{','.join(fingerprint(x) for x in value)}]"
+    if isinstance(value, dict):
+        return f"{{{','.join(f'{fingerprint(k)}:{fingerprint(v)}' for k, v in value.items())}}}"
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        fields = ",".join(
+            f"{x}={fingerprint(getattr(value, x))}"
+            for x in _dataclass_field_names(type(value))
+        )
+        return f"{type(value).__qualname__}({fields})"
+
+    return str(value)  # (same as the old behaviour)
+
+
+@functools.cache
+def _source_sha(function_code: CodeType) -> str:
+    # keyed by the code object --> nested functions (re-decorated per call) are only read once
+    try:
+        return calculate_sha(inspect.getsource(function_code))
+    except OSError:  # no source available (eg interactive session)
+        return calculate_sha(function_code.co_qualname)
+
+
+def cache_key(
+    source_sha: str,
+    args: tuple[Any, ...],
+    kwargs: dict[str, Any],
+    extra_info_in_shahash: str = "",
+) -> str:
+    return calculate_sha(
+        source_sha
+        + fingerprint(args)
+        + fingerprint(dict(sorted(kwargs.items())))
+        + extra_info_in_shahash
+    )
 
 
 def cache(
@@ -47,102 +236,178 @@ def cache(
     persistent_after_termination: bool = False,
     sub_directory: Path | None = None,
     extra_info_in_shahash: str = "",
+    still_valid: Callable[[Any], bool] | None = None,
+    arguments_not_in_key: tuple[str, ...] = (),
 ):
+    """
+    `still_valid` --> for results that refer to files outside of the cache (that may have
+    been deleted since), a result that isn't valid anymore is calculated again
+    `arguments_not_in_key` --> hints that only change how the result is found (eg a search's
+    starting point), not what it is: a result found with other hints is a hit too
+    """
+
+    def is_valid(matching_data: data | None) -> bool:
+        return matching_data is not None and (
+            still_valid is None or still_valid(matching_data.cache_data)
+        )
+
     def file_cache_decorator(annotated_function: TCallable) -> TCallable:
+        # computed once (when decorating) instead of reading the source file every call
+        source_sha = _source_sha(annotated_function.__code__)
+        signature = inspect.signature(annotated_function)
+
+        def names(args: tuple[Any, ...], kwargs: dict[str, Any]) -> tuple[str, str]:
+            if arguments_not_in_key:
+                bound = signature.bind(*args, **kwargs)
+                for name in arguments_not_in_key:
+                    _ = bound.arguments.pop(name, None)
+                args, kwargs = bound.args, bound.kwargs
+            function_signature_unique = cache_key(
+                source_sha, args, kwargs, extra_info_in_shahash
+            )
+            cache_name = f"{prefix_name}cache-{function_signature_unique}.{extension}"
+            return cache_name, f"{sub_directory}/{cache_name}"
+
+        def lookup(*args, **kwargs) -> bool:
+            cache_name, memory_key = names(args, kwargs)
+            if is_valid(cache_data.get(memory_key)):
+                return True
+            stored_data = get_cache_backend().load(
+                (sub_directory if sub_directory is not None else Path()) / cache_name
+            )
+            try:
+                return stored_data is not None and is_valid(pickle.loads(stored_data))
+            except (EOFError, pickle.UnpicklingError, AttributeError):
+                return False
+
         @functools.wraps(annotated_function)
         def wrapper(*args, **kwargs):
-            global cache_data
-            function_signature_unique = calculate_sha(
-                inspect.getsource(annotated_function)
-                + "".join(str(x) for x in args)
-                + "".join(f"{x[0]}{x[1]}" for x in kwargs.items())
-                + extra_info_in_shahash
-            )
+            # print(">FINDING IN CACHE...")
+            cache_name, memory_key = names(args, kwargs)
+
+            if is_valid(matching_data := cache_data.get(memory_key)):
+                profiling.count(f"cache memory hit: {annotated_function.__name__}")
+                return matching_data.cache_data
+
+            with cache_data.key_lock(memory_key):
+                # another worker may have calculated it while waiting
+                if is_valid(matching_data := cache_data.get(memory_key)):
+                    profiling.count(f"cache memory hit: {annotated_function.__name__}")
+                    return matching_data.cache_data
+                return _load_or_calculate(
+                    memory_key,
+                    # (only built for misses of the in-memory data, pathlib is slow)
+                    (sub_directory if sub_directory is not None else Path())
+                    / cache_name,
+                    prefix_name,
+                    annotated_function.__name__,
+                    lambda: annotated_function(*args, **kwargs),
+                    persistent_after_termination,
+                    still_valid,
+                )
 
-            # function_signature_unique2 = calculate_sha(
-            #     inspect.getsource(annotated_function)
-            #     + "".join(str(x) for x in args)
-            #     + "".join(f"{x[0]}{x[1]}" for x in kwargs.items())
-            # )
+        _cache_lookups[wrapper] = lookup
+        return cast(TCallable, wrapper)
 
-            # assert (
-            #     function_signature_unique == function_signature_unique2
-            # ), "sha issues!!"
+    return file_cache_decorator
 
-            # print(">FINDING IN CACHE...")
-            # cache_filename = f"{CACHE_DIRECTORY}/{prefix_name}cache-{function_signature_unique}.{extension}"
-            cache_filename = (
-                CACHE_DIRECTORY
-                / (sub_directory if sub_directory is not None else Path())
-                / f"{prefix_name}cache-{function_signature_unique}.{extension}"
-            )
 
-            if not os.path.exists(cache_filename.parent):
-                try:
-                    os.makedirs(cache_filename.parent)
-                except FileExistsError:
-                    # actually did get this error, I'm guessing by multithreading
-                    print("File already exists")
-
-            if matching_data := [
-                x for x in cache_data if x.cache_filename.name == cache_filename.name
-            ]:
-                return matching_data[0].cache_data
-
-            # if os.path.exists(cache_filename):
-            if cache_filename.is_file():
-                with cache_filename.open("rb") as f:
-                    recieved_value_data = pickle.load(f)
-                    # cache_data.append(recieved_value_data)
-                    cache_data.append(
-                        data(
-                            cache_filename,
-                            recieved_value_data,
-                            delete_afterwards=not persistent_after_termination,
-                        )
-                    )
-                    return recieved_value_data.cache_data
-
-            # if sub_directory is not None:
-            #     print(
-            #         cache_filename,
-            #         inspect.getsource(annotated_function)
-            #         + "".join(str(x) for x in args)
-            #         + "".join(f"{x[0]}{x[1]}" for x in kwargs.items()),
-            #     )
-            #     _ = input(">>RENDERING INSTEAD OF CACHE")
-
-            recieved_value = annotated_function(*args, **kwargs)
-
-            cache_data.append(
-                recieved_value_data := data(
-                    cache_filename, recieved_value, not persistent_after_termination
-                )
+def is_cached(cached_function: Callable[..., Any], *args, **kwargs) -> bool:
+    """
+    Whether `cached_function(*args, **kwargs)` would be a cache hit (without calculating it)
+    eg to batch the misses together
+    """
+    # (through the decorators on top of `cache`, eg `store_cumulative_time`)
+    function = inspect.unwrap(cached_function, stop=lambda x: x in _cache_lookups)
+    return _cache_lookups[function](*args, **kwargs)
+
+
+def _load_or_calculate(
+    memory_key: str,
+    cache_filename: Path,
+    prefix_name: str,
+    function_name: str,
+    calculate_value: Callable[[], Any],
+    persistent_after_termination: bool,
+    still_valid: Callable[[Any], bool] | None,
+) -> Any:
+    backend = get_cache_backend()
+
+    if (stored_data := backend.load(cache_filename)) is not None:
+        try:
+            recieved_value_data = pickle.loads(stored_data)
+            if still_valid is not None and not still_valid(
+                recieved_value_data.cache_data
+            ):
+                raise LookupError("no longer valid")
+            # cache_data.append(recieved_value_data)
+            cache_data.add(
+                memory_key,
+                data(
+                    cache_filename,
+                    recieved_value_data.cache_data,
+                    delete_afterwards=not persistent_after_termination,
+                ),
+                size_estimate=len(stored_data),
             )
+            with cache_data.lock:
+                cache_data.statistics.disk_hits += 1
+            profiling.count(f"cache disk hit: {function_name}")
+            return recieved_value_data.cache_data
+        except (EOFError, pickle.UnpicklingError, AttributeError, LookupError) as e:
+            # (from before writes were atomic, or a class that has changed)
+            print(f"WARNING: ignoring unreadable cache entry {cache_filename}: {e}")
+
+    with cache_data.lock:
+        cache_data.statistics.misses += 1
+    profiling.count(f"cache miss: {function_name}")
+
+    recieved_value = calculate_value()
+
+    recieved_value_data = data(
+        cache_filename, recieved_value, not persistent_after_termination
+    )
+    pickled_data = pickle.dumps(recieved_value_data)
+    cache_data.add(memory_key, recieved_value_data, len(pickled_data))
 
-            cache_filename.parent.mkdir(parents=True, exist_ok=True)
-            with cache_filename.open("wb") as f:
-                pickle.dump(recieved_value_data, f)
-            # with open(str(cache_filename), "wb") as f:
-            #     pickle.dump(recieved_value, f)
+    backend.store(cache_filename, prefix_name, pickled_data)
 
-            print("written to cache")
-            # _ = os.system("tree") # (debugging)
+    print("written to cache")
+    # _ = os.system("tree") # (debugging)
 
-            return recieved_value
+    return recieved_value
 
-        return cast(TCallable, wrapper)
 
-    return file_cache_decorator
+def migrate_pickle_files() -> int:
+    """
+    Imports the old one-file-per-entry cache into the SQLite store
+    (done automatically when the database is first created)
+    """
+    backend = get_cache_backend()
+    if not isinstance(backend, cache_backends.SQLiteBackend):
+        return 0
+    return backend.import_pickle_files(CACHE_DIRECTORY)
 
 
 def cache_cleanup():
     print("cleaning up cache files at the end")
-    for file in (x for x in cache_data if x.delete_afterwards):
+    backend = get_cache_backend()
+    for filename in cache_data.files_to_delete_afterwards:
         try:
-            os.remove(file.cache_filename)
+            backend.delete(filename)
         except Exception as e:
             print(f"ERROR REMOVING CACHE FILE: {e}")
+    cache_data.files_to_delete_afterwards.clear()
+    backend.flush()
+
+
+def print_cache_statistics():
+    from rich import print
+
+    print(cache_data.statistics)
+    print(
+        f"in-memory cache: {len(cache_data.entries)} entries, {cache_data.bytes_used} / {cache_data.byte_budget} bytes"
+    )
 
 
 # def recording_timer(annotated_function: TCallable) -> TCallable:
@@ -270,53 +535,31 @@ def cache_cleanup():
 #
 
 
-@dataclass
-class timedata:
-    total_time: float
-    number_of_calls: int
-
-
-# time_of_functions: defaultdict[str, float] = defaultdict()
-time_of_functions: dict[str, timedata] = {}
-
-
 def store_cumulative_time(annotated_function: TCallable) -> TCallable:
+    """
+    Records every call as a `profiling.span` (latency histogram, thread + scene, nesting)
+    """
+
     @functools.wraps(annotated_function)
     def wrapper(*args, **kwargs):
-        global time_of_functions
-
-        start_time = time.perf_counter()
-        recieved_value = annotated_function(*args, **kwargs)
-        elapsed_time = time.perf_counter() - start_time
-
-        # time_of_functions.append(timedata(annotated_function.__name__, elapsed_time))
-        try:
-            time_of_functions[annotated_function.__name__] = timedata(
-                time_of_functions[annotated_function.__name__].total_time
-                + elapsed_time,
-                time_of_functions[annotated_function.__name__].number_of_calls + 1,
-            )
-        except KeyError:
-            time_of_functions[annotated_function.__name__] = timedata(elapsed_time, 1)
-
-        return recieved_value
+        with profiling.span(annotated_function.__name__):
+            return annotated_function(*args, **kwargs)
 
     return cast(TCallable, wrapper)
 
 
 def print_times_of_functions():
-    from rich import print
-
-    time_of_functions_list = sorted(
-        time_of_functions.items(), key=lambda x: x[1].total_time, reverse=True
-    )
-
-    print(time_of_functions_list)
+    profiling.print_summary()
 
 
 if __name__ == "__main__":
+    import sys
     import time
 
+    if sys.argv[1:] == ["migrate"]:
+        print(f"imported {migrate_pickle_files()} pickle files")
+        sys.exit()
+
     @cache()
     def get_result(delay: int) -> str:
         time.sleep(delay)
@@ -0,0 +1,181 @@
+from typing import IO, Iterator
+import argparse
+import json
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+
+
+"""
+The per-frame VMAF scores of a y4m stream while it is still being encoded
+(libvmaf only writes its scores once its input ends --> it is run on consecutive windows)
+- the distorted y4m on stdin, the reference y4m on another fd, read in step
+- prints one score per line (in frame order) as soon as each window is scored
+- every window also gets the frame before and after it (not printed): the motion feature
+  compares neighbouring frames, so the scores are the same as of one libvmaf run
+- a stage of `ffmpeg_heuristics.VMAF.streaming_summary_of_encode`: the frames of one
+  continuous encode, stopped as soon as the score is settled
+
+usage: ... | python libvmaf_windows.py --window 48 --libvmaf-options n_threads=4 pipe:3
+"""
+
+DEFAULT_WINDOW_FRAMES = 48
+
+type frame = tuple[bytes, bytes]  # (distorted, reference), with their FRAME lines
+
+
+def y4m_frame_bytes(header: bytes) -> int:
+    """
+    Size of the picture data of a frame (after its FRAME line), from the stream header
+    eg YUV4MPEG2 W1920 H1080 F24:1 Ip A1:1 C420p10
+    """
+    parameters = {x[:1]: x[1:] for x in header.decode().split()[1:]}
+    width, height = int(parameters["W"]), int(parameters["H"])
+    colorspace = parameters.get("C", "420jpeg")
+    if match := re.fullmatch(r"mono(\d+)?", colorspace):
+        samples_per_pixel, bits = 1.0, int(match.group(1) or 8)
+    elif colorspace == "444alpha":
+        samples_per_pixel, bits = 4.0, 8
+    elif match := re.match(r"(4)(\d)(\d)(?:p(\d+))?", colorspace):
+        # (J:a:b --> 2 * J luma and 2 * (a + b) chroma samples per Jx2 pixels)
+        j, a, b = (int(x) for x in match.group(1, 2, 3))
+        samples_per_pixel, bits = (2 * j + 2 * (a + b)) / (2 * j), int(match.group(4) or 8)
+    else:
+        raise ValueError(f"unknown y4m colorspace: {colorspace}")
+    return int(width * height * samples_per_pixel * (1 if bits <= 8 else 2))
+
+
+def _read_frame(stream: IO[bytes], picture_bytes: int) -> bytes | None:
+    if not (frame_line := stream.readline()):
+        return None
+    picture = stream.read(picture_bytes)
+    if len(picture) < picture_bytes:  # (cut off, eg the encode was stopped)
+        return None
+    return frame_line + picture
+
+
+def _read_frames(
+    distorted: IO[bytes], reference: IO[bytes], headers: tuple[bytes, bytes]
+) -> Iterator[frame]:
+    distorted_bytes, reference_bytes = (y4m_frame_bytes(x) for x in headers)
+    while (distorted_frame := _read_frame(distorted, distorted_bytes)) is not None and (
+        reference_frame := _read_frame(reference, reference_bytes)
+    ) is not None:
+        yield (distorted_frame, reference_frame)
+
+
+def _write(frames: "queue.Queue[bytes | None]", write_fd: int) -> None:
+    with open(write_fd, "wb", buffering=0) as f:
+        while (data := frames.get()) is not None:
+            view = memoryview(data)
+            while view:
+                view = view[f.write(view) :]
+
+
+class WindowScorer:
+    """
+    One libvmaf run: the frames are written as they are read (never a whole window in
+    memory), the scores are read from its log once the input ends
+    """
+
+    def __init__(self, headers: tuple[bytes, bytes], libvmaf_options: str) -> None:
+        distorted_read, distorted_write = os.pipe()
+        reference_read, reference_write = os.pipe()
+        # (the log through a pipe --> nothing is left behind if this process is killed)
+        self.log_read, log_write = os.pipe()
+        self.process: subprocess.Popen[bytes] = subprocess.Popen(
+            [
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-f", "yuv4mpegpipe", "-i", f"pipe:{distorted_read}",
+                "-f", "yuv4mpegpipe", "-i", f"pipe:{reference_read}",
+                "-an",
+                "-lavfi",
+                f"[1:v]setpts=PTS-STARTPTS[reference];[0:v]setpts=PTS-STARTPTS[distorted];[distorted][reference]libvmaf={libvmaf_options}:log_fmt=json:log_path=/dev/fd/{log_write}",
+                "-f", "null", "-",
+            ],
+            stdin=subprocess.DEVNULL,
+            pass_fds=(distorted_read, reference_read, log_write),
+        )
+        for fd in (distorted_read, reference_read, log_write):
+            os.close(fd)
+
+        # (a thread per input --> ffmpeg may read them in any order)
+        self.queues: list[queue.Queue[bytes | None]] = [queue.Queue(2), queue.Queue(2)]
+        self.threads: list[threading.Thread] = [
+            threading.Thread(target=_write, args=(x, fd), daemon=True)
+            for x, fd in zip(self.queues, (distorted_write, reference_write))
+        ]
+        for thread in self.threads:
+            thread.start()
+        for x, header in zip(self.queues, headers):
+            x.put(header)
+
+    def add(self, frame_pair: frame) -> None:
+        for x, data in zip(self.queues, frame_pair):
+            x.put(data)
+
+    def scores(self) -> list[float]:
+        for x in self.queues:
+            x.put(None)
+        for thread in self.threads:
+            thread.join()
+        with open(self.log_read, "rb") as f:
+            log = f.read()
+        if (returncode := self.process.wait()) != 0:
+            raise subprocess.CalledProcessError(returncode, self.process.args)
+        return [x["metrics"]["vmaf"] for x in json.loads(log)["frames"]]
+
+
+def stream_scores(
+    distorted: IO[bytes],
+    reference: IO[bytes],
+    window_frames: int,
+    libvmaf_options: str,
+) -> Iterator[float]:
+    headers = (distorted.readline(), reference.readline())
+    frames = _read_frames(distorted, reference, headers)
+    previous: frame | None = None  # (the last frame of the window before)
+    next_frame = next(frames, None)
+    while next_frame is not None:
+        scorer = WindowScorer(headers, libvmaf_options)
+        first = 0 if previous is None else 1  # (the context frames aren't printed)
+        if previous is not None:
+            scorer.add(previous)
+        window_length = 0
+        while next_frame is not None and window_length < window_frames:
+            scorer.add(next_frame)
+            previous, window_length = next_frame, window_length + 1
+            next_frame = next(frames, None)
+        if next_frame is not None:
+            scorer.add(next_frame)
+
+        yield from scorer.scores()[first : first + window_length]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="per-frame VMAF of a y4m stream, window by window"
+    )
+    _ = parser.add_argument("reference", help="pipe:<fd> or a filename (y4m)")
+    _ = parser.add_argument("--window", type=int, default=DEFAULT_WINDOW_FRAMES)
+    _ = parser.add_argument("--libvmaf-options", default="n_threads=1")
+    arguments = parser.parse_args()
+
+    reference_name: str = arguments.reference
+    reference = (
+        open(int(reference_name.removeprefix("pipe:")), "rb")
+        if reference_name.startswith("pipe:")
+        else open(reference_name, "rb")
+    )
+    with reference:
+        for score in stream_scores(
+            sys.stdin.buffer, reference, max(1, arguments.window), arguments.libvmaf_options
+        ):
+            print(score, flush=True)
+
+
+if __name__ == "__main__":
+    main()
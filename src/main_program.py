@@ -4,6 +4,7 @@ import ffmpeg
 import v2_target_videoCRF
 import ffmpeg_heuristics
 import file_cache
+import profiling
 import videodata
 
 # Vapoursynth scripts: https://www.l33tmeatwad.com/vapoursynth101/using-filters-functions#h.p_WmOexl9b_-mc
@@ -56,6 +57,9 @@ if __name__ == "__main__":
     main()
     file_cache.cache_cleanup()
     file_cache.print_times_of_functions()
+    file_cache.print_cache_statistics()
+    profiling.export_json(Path("profile.json"))
+    profiling.export_chrome_trace(Path("profile-trace.json"))  # (chrome://tracing)
     elapsed_time = time.perf_counter() - start_time
 
     print(f"\n\nOverall elapsed time: {elapsed_time}")
@@ -0,0 +1,81 @@
+from pathlib import Path
+from typing import Any, Callable, TypeVar
+import pickle
+import re
+import threading
+import file_cache
+import profiling
+
+
+"""
+Persistent catalog of what is known about a media file, so it is only probed once (ever)
+- keyed by the input fingerprint (+ the hash of the vapoursynth script, if used)
+- every key has "facets": eg the metadata, the stream layout, the black bar crop
+- stored in the `file_cache` backend (sub_directory `media_catalog`), never deleted at exit
+"""
+
+T = TypeVar("T")
+
+CATALOG_SUB_DIRECTORY = Path("media_catalog")
+
+_lock = threading.Lock()
+_memory: dict[tuple[str, str], Any] = {}
+_key_locks: dict[tuple[str, str], threading.Lock] = {}
+
+
+def file_fingerprint(filename: Path) -> str:
+    """
+    For files that aren't the input (eg the output): path + size + modification time
+    """
+    stat = filename.stat()
+    return file_cache.calculate_sha(
+        f"{filename.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    )
+
+
+def _catalog_path(key: str, facet: str) -> Path:
+    facet_filename = re.sub(r"[^\w.-]+", "_", facet)
+    return CATALOG_SUB_DIRECTORY / f"{key}-{facet_filename}.pickle"
+
+
+def lookup(key: str, facet: str) -> Any | None:
+    with _lock:
+        if (key, facet) in _memory:
+            return _memory[key, facet]
+
+    if (stored_data := file_cache.get_cache_backend().load(_catalog_path(key, facet))) is None:
+        return None
+    try:
+        value = pickle.loads(stored_data)
+    except (EOFError, pickle.UnpicklingError, AttributeError) as e:
+        print(f"WARNING: ignoring unreadable media catalog entry {key} ({facet}): {e}")
+        return None
+
+    with _lock:
+        _memory[key, facet] = value
+    return value
+
+
+def store(key: str, facet: str, value: Any) -> None:
+    with _lock:
+        _memory[key, facet] = value
+    file_cache.get_cache_backend().store(
+        _catalog_path(key, facet), "media_catalog", pickle.dumps(value)
+    )
+
+
+def get_or_calculate(key: str, facet: str, calculate_value: Callable[[], T]) -> T:
+    if (value := lookup(key, facet)) is not None:
+        profiling.count(f"media catalog hit: {facet}")
+        return value
+
+    with _lock:
+        key_lock = _key_locks.setdefault((key, facet), threading.Lock())
+
+    with key_lock:  # (only probed once, even by concurrent workers)
+        if (value := lookup(key, facet)) is not None:
+            return value
+        profiling.count(f"media catalog miss: {facet}")
+        value = calculate_value()
+        store(key, facet, value)
+        return value
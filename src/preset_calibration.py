@@ -0,0 +1,75 @@
+import dataclasses
+import statistics
+import threading
+import ffmpeg
+import profiling
+import task_scheduler
+
+
+"""
+The CRF search probes at a fast preset (eg SVT-AV1 preset 12, x264 veryfast), the final
+encode is at the codec's own (slow) preset
+- the same CRF scores differently at the two presets --> score offset (slow - fast), learnt
+  from a few calibration scenes (searched at the slow preset as usual, plus one fast probe
+  at the CRF found), then from every final encode (its verification score)
+- the fast search looks for `target - offset`
+- at most `calibration_scenes` calibrate at once: the scenes started meanwhile wait for the
+  first offset (their worker slot is free meanwhile)
+"""
+
+DEFAULT_CALIBRATION_SCENES = 3
+
+
+def probe_codec(
+    codec: ffmpeg.VideoCodec, preset: int | str | None
+) -> ffmpeg.VideoCodec | None:
+    """
+    `codec` at the probe preset (None --> no fast probes)
+    """
+    if preset is None or not hasattr(codec, "preset"):  # (eg APPLE_HWENC_H265)
+        return None
+    return dataclasses.replace(codec, preset=preset)
+
+
+class PresetCalibration:
+    def __init__(self, calibration_scenes: int = DEFAULT_CALIBRATION_SCENES) -> None:
+        self.calibration_scenes: int = calibration_scenes
+        self.calibrations_started: int = 0
+        self.calibrations_finished: int = 0
+        self.offsets: list[float] = []
+        self.lock: threading.Lock = threading.Lock()
+        self.changed: threading.Event = threading.Event()  # (replaced at every `add`)
+
+    def score_offset(self) -> float | None:
+        """
+        The offset to search a scene with, None --> the scene is a calibration scene
+        (waits for the first offset if the calibration scenes are all still running)
+        """
+        while True:
+            with self.lock:
+                if self.offsets:
+                    profiling.count("preset calibration: fast probe scene")
+                    return statistics.median(self.offsets)
+                # (more only if the calibrations so far all finished without an offset)
+                if (
+                    self.calibrations_started < self.calibration_scenes
+                    or self.calibrations_finished == self.calibrations_started
+                ):
+                    self.calibrations_started += 1
+                    profiling.count("preset calibration: calibration scene")
+                    return None
+                changed = self.changed
+            profiling.count("preset calibration: waited for the first offset")
+            task_scheduler.wait_event(changed)
+
+    def add(self, offset: float | None, calibration_scene: bool) -> None:
+        """
+        Every scene once done (or failed, without an offset)
+        """
+        with self.lock:
+            if calibration_scene:
+                self.calibrations_finished += 1
+            if offset is not None:
+                self.offsets.append(offset)
+            self.changed.set()
+            self.changed = threading.Event()
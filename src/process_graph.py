@@ -0,0 +1,436 @@
+from dataclasses import dataclass, field
+from typing import IO, Callable
+import os
+import queue
+import subprocess
+import threading
+import time
+import profiling
+
+
+"""
+Runs graphs of processes connected directly with pipes (no shell, no `zsh -c '<(...)'`)
+eg: vspipe --> ffmpeg encode --> libvmaf <-- vspipe
+
+- a `Stage` reads its stdin from another stage, and extra inputs from more stages
+  (the extra inputs are passed as file descriptors, `pipe_input(i)` in the arguments
+  is replaced by `pipe:<fd>` for ffmpeg)
+- every stage gets its own return code, stderr and timing (profiling span)
+- the whole graph can be cancelled (every process is killed), or stopped once the caller has
+  seen enough of the output (`on_stdout_line` --> the lines of the final stage as they come)
+- `Tee` --> one stage's output read by several stages (eg the vspipe output is both encoded
+  and the libvmaf reference)
+"""
+
+
+def pipe_input(index: int) -> str:
+    """
+    Placeholder in `Stage.arguments` for the extra input `Stage.pipe_inputs[index]`
+    """
+    return f"{{pipe input {index}}}"
+
+
+TEE_CHUNK_BYTES = 1 << 20
+DEFAULT_TEE_BUFFER_BYTES = 8 << 20  # (per branch)
+
+
+@dataclass(eq=False)
+class Tee:
+    """
+    The output of `source` copied to `number_of_branches` readers (`branch(i)`)
+    - every branch has its own queue and writer thread, bounded by `buffer_bytes`: once a
+      branch's queue is full, `source` is read no faster than its slowest reader
+    - a branch whose reader waits for the others (eg libvmaf's reference, while the
+      encoder fills its lookahead) needs `buffer_bytes` >= that lag, else deadlock
+      (only the lag is actually held, the bound isn't allocated)
+    """
+
+    source: "Stage"
+    number_of_branches: int = 2
+    buffer_bytes: int | list[int] = DEFAULT_TEE_BUFFER_BYTES  # (per branch, or for all)
+
+    def branch(self, index: int) -> "TeeBranch":
+        assert 0 <= index < self.number_of_branches
+        return TeeBranch(self, index)
+
+    def branch_buffer_bytes(self) -> list[int]:
+        if isinstance(self.buffer_bytes, int):
+            return [self.buffer_bytes] * self.number_of_branches
+        assert len(self.buffer_bytes) == self.number_of_branches
+        return self.buffer_bytes
+
+
+@dataclass(eq=False)
+class TeeBranch:
+    tee: Tee
+    index: int
+
+    def stages(self) -> list["Stage"]:
+        return self.tee.source.stages()
+
+    def pipeline_name(self) -> str:
+        return f"{self.tee.source.pipeline_name()} | tee"
+
+    def __str__(self) -> str:
+        return f"{self.tee.source} | tee"
+
+
+type Upstream = Stage | TeeBranch
+
+
+@dataclass()
+class Stage:
+    name: str  # (also the name of the profiling span)
+    arguments: list[str]
+    stdin: "Upstream | None" = None
+    pipe_inputs: list["Upstream"] = field(default_factory=list)
+
+    def stages(self) -> list["Stage"]:
+        upstream = [self.stdin] if self.stdin is not None else []
+        stages = [y for x in (*upstream, *self.pipe_inputs) for y in x.stages()]
+        # (a tee's source is only run once)
+        return [x for i, x in enumerate(stages) if all(x is not y for y in stages[:i])] + [
+            self
+        ]
+
+    def pipeline_name(self) -> str:
+        # eg "vspipe | ffmpeg encode"
+        if self.stdin is None:
+            return self.name
+        return f"{self.stdin.pipeline_name()} | {self.name}"
+
+    def __str__(self) -> str:
+        # (only for printing, eg "vspipe ... | ffmpeg ...")
+        text = " ".join(self.arguments)
+        if self.stdin is not None:
+            text = f"{self.stdin} | {text}"
+        for i, pipe_input_stage in enumerate(self.pipe_inputs):
+            text = text.replace(pipe_input(i), f"<({pipe_input_stage})")
+        return text
+
+
+@dataclass()
+class stageresult:
+    name: str
+    arguments: list[str]
+    returncode: int
+    stderr: bytes
+    duration: float
+
+
+@dataclass()
+class graphresult:
+    stdout: bytes
+    stages: list[stageresult]
+
+    @property
+    def stderr(self) -> str:
+        """
+        stderr of the final stage (eg the ffmpeg output)
+        """
+        return self.stages[-1].stderr.decode(errors="replace")
+
+    def stage(self, name: str) -> stageresult:
+        return [x for x in self.stages if x.name == name][0]
+
+
+class GraphCancelled(Exception):
+    pass
+
+
+class StageFailed(subprocess.CalledProcessError):
+    """
+    (subclass of CalledProcessError --> existing error handling still works)
+    """
+
+    def __init__(self, stage: stageresult) -> None:
+        super().__init__(stage.returncode, stage.arguments, stderr=stage.stderr)
+        self.stage: stageresult = stage
+
+    def __str__(self) -> str:
+        return (
+            f"stage '{self.stage.name}' failed ({self.returncode}): "
+            + self.stage.stderr.decode(errors="replace")[-2000:]
+        )
+
+
+@dataclass()
+class _runningstage:
+    stage: Stage
+    arguments: list[str]
+    process: subprocess.Popen[bytes]
+    start_time: float
+    stderr_chunks: list[bytes]
+    stderr_thread: threading.Thread
+    end_time: float | None = None
+
+
+def _drain(stream: IO[bytes], chunks: list[bytes]) -> None:
+    while chunk := stream.read(65536):
+        chunks.append(chunk)
+    stream.close()
+
+
+def _drain_lines(
+    stream: IO[bytes], chunks: list[bytes], on_line: Callable[[bytes], None]
+) -> None:
+    for line in stream:  # (as soon as each line is written)
+        chunks.append(line)
+        on_line(line)
+    stream.close()
+
+
+class _runningtee:
+    def __init__(self, source_stdout: IO[bytes], buffer_bytes: list[int]) -> None:
+        self.source_stdout: IO[bytes] = source_stdout
+        self.queues: list[queue.Queue[bytes | None]] = [
+            queue.Queue(maxsize=max(1, -(-x // TEE_CHUNK_BYTES))) for x in buffer_bytes
+        ]
+        self.stopped: threading.Event = threading.Event()  # (cancelled)
+        self.read_ends: list[IO[bytes]] = []
+        self.threads: list[threading.Thread] = [
+            threading.Thread(target=self._pump, daemon=True)
+        ]
+        for branch_queue in self.queues:
+            read_fd, write_fd = os.pipe()
+            self.read_ends.append(open(read_fd, "rb", buffering=0))
+            self.threads.append(
+                threading.Thread(
+                    target=self._write, args=(branch_queue, write_fd), daemon=True
+                )
+            )
+        for thread in self.threads:
+            thread.start()
+
+    def _put(self, branch_queue: "queue.Queue[bytes | None]", item: bytes | None) -> bool:
+        """
+        Blocks while the branch is full (False --> cancelled meanwhile)
+        """
+        while not self.stopped.is_set():
+            try:
+                branch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _pump(self) -> None:
+        while chunk := self.source_stdout.read(TEE_CHUNK_BYTES):
+            if not all(self._put(x, chunk) for x in self.queues):
+                break
+        self.source_stdout.close()
+        for branch_queue in self.queues:
+            _ = self._put(branch_queue, None)
+
+    def _get(self, branch_queue: "queue.Queue[bytes | None]") -> bytes | None:
+        while not self.stopped.is_set():
+            try:
+                return branch_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def _write(self, branch_queue: "queue.Queue[bytes | None]", write_fd: int) -> None:
+        with open(write_fd, "wb", buffering=0) as f:
+            reader_is_alive = True
+            while (chunk := self._get(branch_queue)) is not None:
+                if not reader_is_alive:
+                    continue  # (still emptied, so the other branches aren't blocked)
+                try:
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[f.write(view) :]
+                except (BrokenPipeError, OSError):
+                    reader_is_alive = False
+
+
+class ProcessGraph:
+    def __init__(
+        self,
+        final_stage: Stage,
+        capture_stdout: bool = False,
+        cancel_event: threading.Event | None = None,
+        # (the final stage's stdout is captured too, the callback may `stop()` the graph)
+        on_stdout_line: Callable[[bytes], None] | None = None,
+    ) -> None:
+        self.final_stage: Stage = final_stage
+        self.capture_stdout: bool = capture_stdout or on_stdout_line is not None
+        self.cancel_event: threading.Event = (
+            cancel_event if cancel_event is not None else threading.Event()
+        )
+        self.on_stdout_line: Callable[[bytes], None] | None = on_stdout_line
+        self.stop_event: threading.Event = threading.Event()
+        self.running: list[_runningstage] = []
+        self.tees: dict[int, _runningtee] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def _output_of(self, upstream: Upstream) -> IO[bytes]:
+        if isinstance(upstream, TeeBranch):
+            if id(upstream.tee) not in self.tees:
+                source_stdout = self._launch(upstream.tee.source, subprocess.PIPE).stdout
+                assert source_stdout is not None
+                self.tees[id(upstream.tee)] = _runningtee(
+                    source_stdout, upstream.tee.branch_buffer_bytes()
+                )
+            return self.tees[id(upstream.tee)].read_ends[upstream.index]
+
+        upstream_stdout = self._launch(upstream, subprocess.PIPE).stdout
+        assert upstream_stdout is not None
+        return upstream_stdout
+
+    def _launch(self, stage: Stage, stdout: int | None) -> subprocess.Popen[bytes]:
+        stdin_pipe = None
+        if stage.stdin is not None:
+            stdin_pipe = self._output_of(stage.stdin)
+
+        arguments = list(stage.arguments)
+        extra_pipes: list[IO[bytes]] = []
+        for i, pipe_input_stage in enumerate(stage.pipe_inputs):
+            upstream_stdout = self._output_of(pipe_input_stage)
+            extra_pipes.append(upstream_stdout)
+            arguments = [
+                x.replace(pipe_input(i), f"pipe:{upstream_stdout.fileno()}")
+                for x in arguments
+            ]
+
+        process = subprocess.Popen(
+            arguments,
+            stdin=stdin_pipe if stdin_pipe is not None else subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=subprocess.PIPE,
+            pass_fds=tuple(x.fileno() for x in extra_pipes),
+        )
+
+        # (only the consumer should hold the pipes --> EOF and SIGPIPE work as expected)
+        for pipe in (stdin_pipe, *extra_pipes):
+            if pipe is not None:
+                pipe.close()
+
+        assert process.stderr is not None
+        stderr_chunks: list[bytes] = []
+        stderr_thread = threading.Thread(
+            target=_drain, args=(process.stderr, stderr_chunks), daemon=True
+        )
+        stderr_thread.start()
+
+        with self.lock:
+            self.running.append(
+                _runningstage(
+                    stage, arguments, process, time.perf_counter(), stderr_chunks, stderr_thread
+                )
+            )
+        return process
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+        self._kill()
+
+    def stop(self) -> None:
+        """
+        Every process is killed, but `run` doesn't fail: it returns what was read until then
+        (eg a streaming probe whose score is already settled)
+        """
+        self.stop_event.set()
+        self._kill()
+
+    def _kill(self) -> None:
+        for running_tee in list(self.tees.values()):  # (unblocks a full or empty queue)
+            running_tee.stop()
+        with self.lock:
+            for running_stage in self.running:
+                if running_stage.process.poll() is None:
+                    running_stage.process.kill()
+
+    def run(self, check: bool = True) -> graphresult:
+        if len(self.final_stage.stages()) == 1:  # (the stage's own span is enough)
+            return self._run(check)
+        with profiling.span(self.final_stage.pipeline_name(), "process graph"):
+            return self._run(check)
+
+    def _run(self, check: bool) -> graphresult:
+        final_process = self._launch(
+            self.final_stage, subprocess.PIPE if self.capture_stdout else None
+        )
+
+        stdout_chunks: list[bytes] = []
+        stdout_thread = None
+        if self.capture_stdout:
+            assert final_process.stdout is not None
+            stdout_thread = (
+                threading.Thread(
+                    target=_drain, args=(final_process.stdout, stdout_chunks), daemon=True
+                )
+                if self.on_stdout_line is None
+                else threading.Thread(
+                    target=_drain_lines,
+                    args=(final_process.stdout, stdout_chunks, self.on_stdout_line),
+                    daemon=True,
+                )
+            )
+            stdout_thread.start()
+
+        while any(x.end_time is None for x in self.running):
+            if self.cancel_event.is_set():
+                self.cancel()
+            for running_stage in self.running:
+                if running_stage.end_time is None and running_stage.process.poll() is not None:
+                    running_stage.end_time = time.perf_counter()
+            time.sleep(0.01)
+
+        if stdout_thread is not None:
+            stdout_thread.join()
+        for running_tee in self.tees.values():
+            for thread in running_tee.threads:
+                thread.join()
+
+        results: list[stageresult] = []
+        # (the order they were launched in --> producers first, the final stage last)
+        for running_stage in self.running:
+            running_stage.stderr_thread.join()
+            assert running_stage.end_time is not None
+            profiling.record_span(
+                running_stage.stage.name,
+                "subprocess",
+                running_stage.start_time,
+                running_stage.end_time - running_stage.start_time,
+            )
+            results.append(
+                stageresult(
+                    name=running_stage.stage.name,
+                    arguments=running_stage.arguments,
+                    returncode=running_stage.process.returncode,
+                    stderr=b"".join(running_stage.stderr_chunks),
+                    duration=running_stage.end_time - running_stage.start_time,
+                )
+            )
+
+        if self.cancel_event.is_set():
+            raise GraphCancelled(self.final_stage.name)
+
+        if check and not self.stop_event.is_set():
+            final_result = results[-1]
+            for result in results:
+                # a producer killed by SIGPIPE is fine if the consumer succeeded
+                if result.returncode != 0 and not (
+                    result is not final_result
+                    and result.returncode == -13
+                    and final_result.returncode == 0
+                ):
+                    raise StageFailed(result)
+
+        return graphresult(b"".join(stdout_chunks), results)
+
+
+def run(
+    final_stage: Stage,
+    capture_stdout: bool = False,
+    check: bool = True,
+    cancel_event: threading.Event | None = None,
+    on_stdout_line: Callable[[bytes], None] | None = None,
+) -> graphresult:
+    return ProcessGraph(final_stage, capture_stdout, cancel_event, on_stdout_line).run(
+        check
+    )
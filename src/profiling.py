@@ -0,0 +1,236 @@
+from dataclasses import dataclass, field, asdict
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Iterator
+import json
+import os
+import threading
+import time
+
+
+"""
+Instrumentation of where the (wall) time goes, without attaching a profiler
+- every timed call is a `span` (name + category), spans nest per thread
+- spans are attributed to the thread and the scene that is being worked on
+- counters for things that aren't timed (eg cache hits/misses)
+- export to JSON, and to the Chrome trace-event format (chrome://tracing or ui.perfetto.dev)
+"""
+
+
+@dataclass()
+class spanrecord:
+    name: str
+    category: str
+    thread: str
+    scene: str | None
+    parent: str | None
+    depth: int
+    start: float  # (seconds since the start of the program)
+    duration: float
+
+
+@dataclass()
+class spansummary:
+    name: str
+    number_of_calls: int
+    total_time: float
+    p50: float
+    p95: float
+    max: float
+    time_per_thread: dict[str, float] = field(default_factory=dict)
+    time_per_scene: dict[str, float] = field(default_factory=dict)
+
+
+PROGRAM_START = time.perf_counter()
+
+_lock = threading.Lock()
+_records: list[spanrecord] = []
+_counters: defaultdict[str, int] = defaultdict(int)
+
+# (a new thread starts with an empty context --> the nesting is per thread)
+_span_stack: ContextVar[tuple[str, ...]] = ContextVar("span_stack", default=())
+_current_scene: ContextVar[str | None] = ContextVar("current_scene", default=None)
+
+
+@contextmanager
+def span(name: str, category: str = "function") -> Iterator[None]:
+    stack = _span_stack.get()
+    token = _span_stack.set((*stack, name))
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_time = time.perf_counter() - start_time
+        _span_stack.reset(token)
+        record_span(name, category, start_time, elapsed_time, stack)
+
+
+def record_span(
+    name: str,
+    category: str,
+    start_time: float,
+    elapsed_time: float,
+    parent_stack: tuple[str, ...] | None = None,
+) -> None:
+    """
+    For timings measured elsewhere (eg the lifetime of a subprocess)
+    """
+    if parent_stack is None:
+        parent_stack = _span_stack.get()
+    record = spanrecord(
+        name=name,
+        category=category,
+        thread=threading.current_thread().name,
+        scene=_current_scene.get(),
+        parent=parent_stack[-1] if parent_stack else None,
+        depth=len(parent_stack),
+        start=start_time - PROGRAM_START,
+        duration=elapsed_time,
+    )
+    with _lock:
+        _records.append(record)
+
+
+@contextmanager
+def scene(scene_name: str) -> Iterator[None]:
+    """
+    Everything timed inside is attributed to this scene
+    """
+    token = _current_scene.set(scene_name)
+    try:
+        yield
+    finally:
+        _current_scene.reset(token)
+
+
+def count(counter_name: str, amount: int = 1) -> None:
+    with _lock:
+        _counters[counter_name] += amount
+
+
+def counters() -> dict[str, int]:
+    with _lock:
+        return dict(_counters)
+
+
+def records() -> list[spanrecord]:
+    with _lock:
+        return list(_records)
+
+
+def _percentile(sorted_values: list[float], percentile: float) -> float:
+    # (nearest-rank)
+    index = max(0, min(len(sorted_values) - 1, round(percentile * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summary() -> list[spansummary]:
+    records_by_name: defaultdict[str, list[spanrecord]] = defaultdict(list)
+    for record in records():
+        records_by_name[record.name].append(record)
+
+    summaries: list[spansummary] = []
+    for name, name_records in records_by_name.items():
+        durations = sorted(x.duration for x in name_records)
+        time_per_thread: defaultdict[str, float] = defaultdict(float)
+        time_per_scene: defaultdict[str, float] = defaultdict(float)
+        for record in name_records:
+            time_per_thread[record.thread] += record.duration
+            if record.scene is not None:
+                time_per_scene[record.scene] += record.duration
+
+        summaries.append(
+            spansummary(
+                name=name,
+                number_of_calls=len(durations),
+                total_time=sum(durations),
+                p50=_percentile(durations, 0.5),
+                p95=_percentile(durations, 0.95),
+                max=durations[-1],
+                time_per_thread=dict(time_per_thread),
+                time_per_scene=dict(time_per_scene),
+            )
+        )
+
+    return sorted(summaries, key=lambda x: x.total_time, reverse=True)
+
+
+def export_json(filename: Path) -> None:
+    with filename.open("w") as f:
+        json.dump(
+            {
+                "summary": [asdict(x) for x in summary()],
+                "counters": counters(),
+                "spans": [asdict(x) for x in records()],
+            },
+            f,
+            indent=2,
+        )
+
+
+def export_chrome_trace(filename: Path) -> None:
+    thread_ids: dict[str, int] = {}
+    events: list[dict[str, object]] = []
+
+    for record in records():
+        thread_id = thread_ids.setdefault(record.thread, len(thread_ids))
+        events.append(
+            {
+                "name": record.name,
+                "cat": record.category,
+                "ph": "X",
+                "ts": record.start * 1_000_000,
+                "dur": record.duration * 1_000_000,
+                "pid": os.getpid(),
+                "tid": thread_id,
+                "args": {"scene": record.scene, "parent": record.parent},
+            }
+        )
+
+    events.extend(
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": thread_id,
+            "args": {"name": thread_name},
+        }
+        for thread_name, thread_id in thread_ids.items()
+    )
+
+    end_time = (time.perf_counter() - PROGRAM_START) * 1_000_000
+    events.extend(
+        {
+            "name": counter_name,
+            "ph": "C",
+            "ts": end_time,
+            "pid": os.getpid(),
+            "args": {"count": value},
+        }
+        for counter_name, value in counters().items()
+    )
+
+    with filename.open("w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def print_summary() -> None:
+    from rich import print
+    from rich.table import Table
+
+    table = Table(title="Time of functions")
+    for column in ("name", "calls", "total (s)", "p50 (s)", "p95 (s)", "max (s)"):
+        table.add_column(column)
+    for x in summary():
+        table.add_row(
+            x.name,
+            str(x.number_of_calls),
+            f"{x.total_time:.2f}",
+            f"{x.p50:.3f}",
+            f"{x.p95:.3f}",
+            f"{x.max:.3f}",
+        )
+    print(table)
+    print(counters())
@@ -1,9 +1,9 @@
 from dataclasses import dataclass
 import os
-from pathlib import Path
-import subprocess
+import process_graph
 import file_cache
 import ffmpeg
+import media_catalog
 import videodata
 
 
@@ -53,11 +53,6 @@ def _ensure_scene_length_is_larger_than_minimum_length(
 
 
 @file_cache.store_cumulative_time
-@file_cache.cache(
-    prefix_name="SceneCache-",
-    persistent_after_termination=True,
-    sub_directory=Path("scene_data"),
-)
 def find_scenes(
     # video_path: str,
     video_data: videodata.RawVideoData,
@@ -66,17 +61,59 @@ def find_scenes(
     """
     Function that gets the frames of the different scenes in the video
     - for threshold, 27.0 is default value
+    - the detected scenes are a facet of the input in the media catalog (only the merge of
+      the scenes shorter than `minimum_length_scene_seconds` is redone)
     """
 
+    try:
+        import scenedetect
+
+        _ = scenedetect
+        facet = "scenes (ContentDetector)"
+    # except ModuleNotFoundError:
+    except Exception:
+        # (the scenedetect CLI merges the short scenes itself)
+        facet = f"scenes (detect-adaptive, minimum {minimum_length_scene_seconds}s)"
+
+    detected_scenes: list[SceneData] = media_catalog.get_or_calculate(
+        video_data.sha256_of_input,
+        facet,
+        lambda: _detect_scenes(video_data, minimum_length_scene_seconds),
+    )
+    # (copies, the merge modifies them)
+    scene_data = [SceneData(x.start_frame, x.end_frame) for x in detected_scenes]
+
+    video_metadata = ffmpeg.get_video_metadata(video_data, video_data.input_filename)
+
+    scene_data = _ensure_scene_length_is_larger_than_minimum_length(
+        scene_data, video_metadata.frame_rate, minimum_length_scene_seconds
+    )
+
+    if len(scene_data) == 0:
+        scene_data = [SceneData(start_frame=0, end_frame=video_metadata.total_frames)]
+    return scene_data
+
+
+def _detect_scenes(
+    video_data: videodata.RawVideoData,
+    minimum_length_scene_seconds: float,
+) -> list[SceneData]:
     try:
         import scenedetect as sd
     # except ModuleNotFoundError:
     except Exception:
         CSV_FILENAME = f"{video_data.raw_input_filename.stem}-Scenes.csv"
-        _ = subprocess.run(
-            f"scenedetect --input '{video_data.raw_input_filename.name}' -m {minimum_length_scene_seconds} detect-adaptive list-scenes",
-            shell=True,
-            check=True,
+        _ = process_graph.run(
+            process_graph.Stage(
+                "scenedetect",
+                [
+                    "scenedetect",
+                    "--input", video_data.raw_input_filename.name,
+                    "-m", str(minimum_length_scene_seconds),
+                    "detect-adaptive",
+                    "list-scenes",
+                ],
+            )
         )
 
         with open(CSV_FILENAME, "r") as file:
@@ -105,7 +142,7 @@ def find_scenes(
 
     _ = scene_manager.detect_scenes(video, show_progress=True)
 
-    scene_data = [
+    return [
         SceneData(
             start_frame=x[0].get_frames(),
             end_frame=x[1].get_frames(),
@@ -113,16 +150,6 @@ def find_scenes(
         for x in scene_manager.get_scene_list()
     ]
 
-    video_metadata = ffmpeg.get_video_metadata(video_data, video_data.input_filename)
-
-    scene_data = _ensure_scene_length_is_larger_than_minimum_length(
-        scene_data, video_metadata.frame_rate, minimum_length_scene_seconds
-    )
-
-    if len(scene_data) == 0:
-        scene_data = [SceneData(start_frame=0, end_frame=video_metadata.total_frames)]
-    return scene_data
-
 
 if __name__ == "__main__":
     from itertools import accumulate
@@ -0,0 +1,92 @@
+from typing import Callable
+import threading
+import profiling
+import task_scheduler
+
+
+"""
+Speculative probes in the worker slots that are idle (eg the end of a "largest first" job:
+one or two long scenes still searching, the other workers have nothing left to do)
+- the search hands over the CRFs it may probe next (`crf_search.speculative_crfs`), they are
+  probed as speculative tasks of the `task_scheduler` (only in the slots nothing else wants,
+  preempted as soon as something else does)
+- a speculative probe that isn't one of the possible next CRFs anymore (the other branch of
+  the bisection) is cancelled --> its process graph is killed
+- the results go into the probe cache --> the search picks them up as cache hits
+"""
+
+
+class SpeculativeProber:
+    """
+    The speculative probes of one scene's search
+    `probe(crf, cancel_event)` --> stores its result in the probe cache
+    """
+
+    def __init__(
+        self,
+        scheduler: task_scheduler.TaskScheduler,
+        probe: Callable[[int, threading.Event], None],
+        name: str,  # (of the tasks, eg the scene)
+        cost: float,
+    ) -> None:
+        self.scheduler: task_scheduler.TaskScheduler = scheduler
+        self.probe: Callable[[int, threading.Event], None] = probe
+        self.name: str = name
+        self.cost: float = cost
+        self.in_flight: dict[int, task_scheduler.Task] = {}
+        self.started: set[int] = set()
+        self.lock: threading.Lock = threading.Lock()
+
+    def _task_function(self, crf: int) -> Callable[[threading.Event], None]:
+        def run(cancel_event: threading.Event) -> None:
+            self.probe(crf, cancel_event)
+            profiling.count("speculative probes: finished")
+
+        return run
+
+    def speculate(self, round_crfs: list[int], crfs: list[int]) -> None:
+        """
+        `round_crfs` --> kept if already running (waited for by the search, `wait`)
+        """
+        with self.lock:
+            for crf, task in list(self.in_flight.items()):
+                if task.done():
+                    del self.in_flight[crf]
+                elif crf not in crfs and crf not in round_crfs:
+                    self.scheduler.cancel(task)
+                    del self.in_flight[crf]
+                    profiling.count("speculative probes: cancelled")
+
+            idle = self.scheduler.idle()
+            for crf in crfs:
+                if crf in self.in_flight or crf in self.started:
+                    continue
+                if idle <= 0:
+                    break
+                idle -= 1
+                self.in_flight[crf] = self.scheduler.submit(
+                    task_scheduler.Task(
+                        f"{self.name}: speculative probe CRF {crf}",
+                        self._task_function(crf),
+                        self.cost,
+                        category="speculative probe",
+                        speculative=True,
+                    )
+                )
+                self.started.add(crf)
+                profiling.count("speculative probes: started")
+
+    def is_running(self, crf: int) -> bool:
+        with self.lock:
+            return crf in self.in_flight and not self.in_flight[crf].done()
+
+    def wait(self, crfs: list[int]) -> None:
+        """
+        For the speculative probes of `crfs` that are still running (the caller's slot is
+        free meanwhile), their results are then in the probe cache
+        """
+        with self.lock:
+            tasks = [self.in_flight[x] for x in crfs if x in self.in_flight]
+        if tasks:
+            profiling.count("speculative probes: used", len(tasks))
+            self.scheduler.wait(tasks)
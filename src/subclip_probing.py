@@ -0,0 +1,90 @@
+from dataclasses import dataclass
+import crf_predictor
+import ffmpeg
+import videodata
+
+
+"""
+Probing only a few representative windows of a long scene (instead of the whole scene at
+every CRF of the search), then one full encode at the chosen CRF
+- the windows are picked by complexity (the packet sizes of the source): the candidate
+  windows are ranked, and one is taken at each quantile --> the easy and the hard parts
+- the score of a probe is the frame weighted mean of the scores of its windows
+- confidence: how much the windows agree at the chosen CRF --> too little, and the search is
+  done again on the whole scene
+"""
+
+
+@dataclass()
+class SubclipProbing:
+    window_seconds: float = 4.0
+    number_of_windows: int = 3
+    minimum_scene_seconds: float = 30.0  # (shorter scenes are always probed in full)
+    # (spread of the window scores at the chosen CRF, in heuristic units)
+    maximum_window_disagreement: float = 4.0
+
+
+type framerange = tuple[int, int]
+
+
+def choose_windows(
+    video_data: videodata.RawVideoData,
+    start_frame: int,
+    end_frame: int,
+    policy: SubclipProbing,
+) -> list[framerange] | None:
+    """
+    None --> probe the whole scene
+    """
+    frame_rate = ffmpeg.get_video_metadata(video_data, video_data.input_filename).frame_rate
+    window_frames = max(1, round(policy.window_seconds * frame_rate))
+    scene_frames = end_frame - start_frame
+    if (
+        scene_frames < policy.minimum_scene_seconds * frame_rate
+        or scene_frames < 2 * window_frames * policy.number_of_windows
+    ):
+        return None
+
+    sizes = crf_predictor.range_packet_sizes(video_data, start_frame, end_frame)
+    candidates = [
+        (x, x + window_frames)
+        for x in range(start_frame, end_frame - window_frames + 1, window_frames)
+    ]
+
+    def complexity(window: framerange) -> float:
+        if not sizes:
+            return 0.0
+        scale = len(sizes) / scene_frames
+        window_sizes = sizes[
+            int((window[0] - start_frame) * scale) : max(
+                int((window[1] - start_frame) * scale),
+                int((window[0] - start_frame) * scale) + 1,
+            )
+        ]
+        return sum(window_sizes) / max(len(window_sizes), 1)
+
+    ranked = sorted(candidates, key=complexity)
+    chosen = {
+        ranked[int((i + 0.5) * len(ranked) / policy.number_of_windows)]
+        for i in range(policy.number_of_windows)
+    }
+    return sorted(chosen)
+
+
+def combined_score(window_scores: dict[framerange, float]) -> float:
+    total_frames = sum(end - start for start, end in window_scores)
+    return (
+        sum((end - start) * score for (start, end), score in window_scores.items())
+        / total_frames
+    )
+
+
+def confidence(
+    window_scores: dict[framerange, float], policy: SubclipProbing
+) -> float:
+    """
+    1 --> the windows agree exactly, 0 --> they disagree by `maximum_window_disagreement`
+    (or more)
+    """
+    spread = max(window_scores.values()) - min(window_scores.values())
+    return max(0.0, 1 - spread / policy.maximum_window_disagreement)
@@ -0,0 +1,357 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Literal
+import collections
+import contextvars
+import math
+import threading
+import time
+import process_graph
+import profiling
+
+
+"""
+Runs the work of a job as a graph of tasks (eg the probes, final encodes, concat, audio mux)
+- a task is started once its dependencies are done, and a slot is free (global limit)
+- priority: the predicted remaining critical path (the task's cost + its longest chain of
+  dependents), or shortest first, or first in first out (`scenes_length_sort`)
+- a task that waits for other tasks (eg a scene's search waiting for its probes) gives its
+  slot back until they are done
+- speculative tasks only get the slots nobody else wants, and are cancelled (preempted)
+  as soon as a normal task needs their slot
+- a task runs in a copy of the context it was submitted from (eg the scene and the parent
+  span of `profiling`)
+- `view()` --> the live state of the queue (finished tasks are only counted, `states()`)
+"""
+
+type schedulingpolicy = Literal["critical path", "shortest first", "first in first out"]
+type taskstate = Literal[
+    "blocked", "ready", "running", "waiting", "done", "failed", "cancelled"
+]
+
+POLICY_OF_SCENES_LENGTH_SORT: dict[str, schedulingpolicy] = {
+    "largest first": "critical path",
+    "smallest first": "shortest first",
+    "chronological": "first in first out",
+}
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task:
+    def __init__(
+        self,
+        name: str,
+        function: Callable[[threading.Event], Any],  # (given the task's cancel event)
+        cost: float,  # (eg in frames to encode, only compared with the other tasks)
+        dependencies: list["Task"] | None = None,
+        category: str = "",
+        speculative: bool = False,
+        order: int = 0,  # (first in first out: the smallest first, eg the scene index)
+    ) -> None:
+        self.name: str = name
+        self.function: Callable[[threading.Event], Any] = function
+        self.cost: float = cost
+        self.dependencies: list[Task] = dependencies if dependencies is not None else []
+        self.dependents: list[Task] = []
+        self.category: str = category
+        self.speculative: bool = speculative
+        self.order: int = order
+        self.sequence: int = 0
+        self.state: taskstate = "blocked"
+        self.cancel_event: threading.Event = threading.Event()
+        self.done_event: threading.Event = threading.Event()
+        self.value: Any = None
+        self.exception: BaseException | None = None
+        self.start_time: float | None = None
+        self.context: contextvars.Context | None = None  # (of `submit`)
+        # (its cost + its longest chain of dependents, extended by `submit`)
+        self.longest_path: float = cost
+
+    def critical_path(self) -> float:
+        return self.longest_path
+
+    def done(self) -> bool:
+        return self.done_event.is_set()
+
+    def result(self) -> Any:
+        _ = self.done_event.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+@dataclass()
+class taskview:
+    name: str
+    category: str
+    state: taskstate
+    cost: float
+    critical_path: float
+    running_seconds: float | None
+
+
+class TaskScheduler:
+    def __init__(
+        self,
+        max_concurrency: int,
+        policy: schedulingpolicy = "critical path",
+        # (eg {"scene": 4} --> at most 4 scenes started, running or waiting for probes)
+        category_limits: dict[str, int] | None = None,
+    ) -> None:
+        self.max_concurrency: int = max_concurrency
+        self.policy: schedulingpolicy = policy
+        self.category_limits: dict[str, int] = (
+            category_limits if category_limits is not None else {}
+        )
+        self.tasks: list[Task] = []  # (not finished yet)
+        self.submitted: int = 0
+        self.finished: collections.Counter[taskstate] = collections.Counter()
+        self.running: int = 0
+        self.resuming: int = 0  # (done waiting, waiting for their slot back)
+        self.condition: threading.Condition = threading.Condition()
+        self.current: threading.local = threading.local()
+
+    def submit(self, task: Task) -> Task:
+        task.context = contextvars.copy_context()
+        with self.condition:
+            task.sequence, self.submitted = self.submitted, self.submitted + 1
+            self.tasks.append(task)
+            for dependency in task.dependencies:
+                dependency.dependents.append(task)
+            self._extend_longest_paths(task)
+            self._update_state(task)
+            self._dispatch()
+        return task
+
+    def _extend_longest_paths(self, task: Task) -> None:
+        # (a new dependent --> the paths of its dependencies, and of theirs, can only grow)
+        extended = [task]
+        while extended:
+            dependent = extended.pop()
+            for dependency in dependent.dependencies:
+                if dependency.cost + dependent.longest_path > dependency.longest_path:
+                    dependency.longest_path = dependency.cost + dependent.longest_path
+                    extended.append(dependency)
+
+    def _update_state(self, task: Task) -> None:
+        if task.state != "blocked":
+            return
+        failed = [x for x in task.dependencies if x.state in ("failed", "cancelled")]
+        if failed:
+            self._finish(task, None, TaskCancelled(f"{failed[0].name} didn't finish"))
+        elif all(x.state == "done" for x in task.dependencies):
+            task.state = "ready"
+
+    def _priority(self, task: Task) -> tuple[float, ...]:
+        # (smallest first)
+        match self.policy:
+            case "critical path":
+                return (task.speculative, -task.critical_path(), task.sequence)
+            case "shortest first":
+                return (task.speculative, task.critical_path(), task.sequence)
+            case "first in first out":
+                return (task.speculative, task.order, task.sequence)
+
+    def _open_by_category(self) -> collections.Counter[str]:
+        return collections.Counter(
+            x.category for x in self.tasks if x.state in ("running", "waiting")
+        )
+
+    def _startable(self) -> list[Task]:
+        open_tasks = self._open_by_category()
+        return [
+            x
+            for x in self.tasks
+            if x.state == "ready"
+            and open_tasks[x.category] < self.category_limits.get(x.category, math.inf)
+        ]
+
+    def _dispatch(self) -> None:
+        # (with `self.condition` held)
+        startable = sorted(self._startable(), key=self._priority)
+        if self.resuming:  # (their slot back first, else nothing that waits ever finishes)
+            self.condition.notify_all()
+            return
+
+        if self.running >= self.max_concurrency:
+            # (preempted --> its slot is freed once it stops)
+            running_speculative = [
+                x for x in self.tasks if x.speculative and x.state == "running"
+            ]
+            slots_wanted = len([x for x in startable if not x.speculative]) - len(
+                [x for x in running_speculative if x.cancel_event.is_set()]
+            )
+            for task in [x for x in running_speculative if not x.cancel_event.is_set()][
+                : max(0, slots_wanted)
+            ]:
+                task.cancel_event.set()
+                profiling.count("task scheduler: speculative task preempted")
+
+        open_tasks = self._open_by_category()
+        for task in startable:
+            if self.running >= self.max_concurrency:
+                break
+            if open_tasks[task.category] >= self.category_limits.get(
+                task.category, math.inf
+            ):
+                continue
+            open_tasks[task.category] += 1
+            task.state = "running"
+            task.start_time = time.perf_counter()
+            self.running += 1
+            threading.Thread(target=self._run, args=(task,), daemon=True).start()
+
+    def _run(self, task: Task) -> None:
+        self.current.task = task
+        value, exception = None, None
+        try:
+            if task.cancel_event.is_set():
+                raise TaskCancelled(task.name)
+            if task.context is None:
+                value = task.function(task.cancel_event)
+            else:
+                value = task.context.run(task.function, task.cancel_event)
+        except Exception as e:
+            exception = e
+        with self.condition:
+            self.running -= 1
+            self._finish(task, value, exception)
+            self._dispatch()
+
+    def _finish(self, task: Task, value: Any, exception: BaseException | None) -> None:
+        # (with `self.condition` held)
+        task.value, task.exception = value, exception
+        if exception is None:
+            task.state = "done"
+        elif isinstance(exception, (TaskCancelled, process_graph.GraphCancelled)):
+            task.state = "cancelled"
+        else:
+            task.state = "failed"
+        self.tasks.remove(task)
+        self.finished[task.state] += 1
+        task.done_event.set()
+        self.condition.notify_all()
+        for dependent in task.dependents:
+            self._update_state(dependent)
+
+    def wait(self, tasks: list[Task]) -> None:
+        """
+        Until `tasks` are finished (from inside of a task --> its slot is free meanwhile)
+        """
+
+        def wait_for_tasks() -> None:
+            for task in tasks:
+                _ = task.done_event.wait()
+
+        self._wait_without_slot(wait_for_tasks)
+
+    def wait_event(self, event: threading.Event) -> None:
+        """
+        Until `event` is set (from inside of a task --> its slot is free meanwhile)
+        """
+        self._wait_without_slot(event.wait)
+
+    def _wait_without_slot(self, block: Callable[[], Any]) -> None:
+        current: Task | None = getattr(self.current, "task", None)
+        if current is None:
+            _ = block()
+            return
+
+        with self.condition:
+            current.state = "waiting"
+            self.running -= 1
+            self._dispatch()
+        _ = block()
+        with self.condition:
+            self.resuming += 1
+            while self.running >= self.max_concurrency:
+                _ = self.condition.wait()
+            self.resuming -= 1
+            self.running += 1
+            current.state = "running"
+            self._dispatch()
+
+    def cancel(self, task: Task) -> None:
+        with self.condition:
+            task.cancel_event.set()
+            if task.state in ("blocked", "ready"):
+                self._finish(task, None, TaskCancelled(task.name))
+
+    def idle(self) -> int:
+        """
+        Slots that nothing (but speculative tasks) is ready to use
+        """
+        with self.condition:
+            if any(not x.speculative for x in self._startable()):
+                return 0
+            return max(0, self.max_concurrency - self.running)
+
+    def busy_slots(self) -> int:
+        """
+        The running tasks, and the ready ones about to start (up to the concurrency limit)
+        """
+        with self.condition:
+            return min(
+                self.max_concurrency,
+                self.running + len([x for x in self.tasks if x.state == "ready"]),
+            )
+
+    def states(self) -> collections.Counter[taskstate]:
+        """
+        Number of tasks per state (the finished ones too)
+        """
+        with self.condition:
+            return self.finished + collections.Counter(x.state for x in self.tasks)
+
+    def view(self) -> list[taskview]:
+        """
+        The tasks not finished yet
+        """
+        with self.condition:
+            return [
+                taskview(
+                    x.name,
+                    x.category,
+                    x.state,
+                    x.cost,
+                    x.critical_path(),
+                    time.perf_counter() - x.start_time
+                    if x.start_time is not None and not x.done()
+                    else None,
+                )
+                for x in self.tasks
+            ]
+
+
+_scheduler: TaskScheduler | None = None
+
+
+def get_scheduler() -> TaskScheduler | None:
+    return _scheduler
+
+
+def set_scheduler(scheduler: TaskScheduler | None) -> None:
+    global _scheduler
+    _scheduler = scheduler
+
+
+def wait_event(event: threading.Event) -> None:
+    """
+    (on the scheduler if there is one --> the caller's slot is free while waiting)
+    """
+    if (scheduler := get_scheduler()) is None:
+        _ = event.wait()
+    else:
+        scheduler.wait_event(event)
+
+
+def run_tasks(tasks: list[Task]) -> list[Any]:
+    """
+    On the scheduler if there is one (the caller's slot is free while waiting), else here
+    """
+    if (scheduler := get_scheduler()) is None:
+        return [x.function(x.cancel_event) for x in tasks]
+    scheduler.wait([scheduler.submit(x) for x in tasks])
+    return [x.result() for x in tasks]
@@ -0,0 +1,108 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ffmpeg
+import core_budget
+import task_scheduler
+
+"""
+Throughput (frames per second, over all the jobs) of encode + libvmaf pipelines run at the
+same time, at different splits of the cores
+- before: every encoder at its own default thread count, libvmaf at `n_threads=6`
+- after: `core_budget.CoreBudget` --> the threads of each pipeline from the budget
+(synthetic source: ffmpeg's `testsrc2`, nothing to download)
+"""
+
+SOURCE = "testsrc2=size=1280x720:rate=30"
+FRAMES_PER_JOB = 120
+CRF = 35
+CODECS: list[ffmpeg.VideoCodec] = [
+    ffmpeg.SVTAV1(preset=10),
+    ffmpeg.H265(preset="veryfast"),
+    ffmpeg.H264(preset="medium"),
+]
+
+
+def encode_and_score(
+    codec: ffmpeg.VideoCodec, encoder_threads: int | None, libvmaf_threads: int
+) -> None:
+    source = ["-f", "lavfi", "-i", f"{SOURCE}:duration={FRAMES_PER_JOB / 30}"]
+    encode = subprocess.Popen(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            *source,
+            *codec.to_subprocess_command(CRF, encoder_threads),
+            "-f", "matroska", "-",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    _ = subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-i", "-",
+            *source,
+            "-lavfi", f"[0:v][1:v]libvmaf=n_threads={libvmaf_threads}",
+            "-f", "null", "-",
+        ],
+        stdin=encode.stdout,
+        check=True,
+    )
+    _ = encode.wait()
+
+
+def run_jobs(
+    codec: ffmpeg.VideoCodec, jobs: int, budget: core_budget.CoreBudget | None
+) -> float:
+    """
+    Frames per second of `jobs` pipelines at once (on the task scheduler, like the scenes
+    of a job), twice as many pipelines as slots
+    """
+
+    def job(_) -> None:
+        if budget is None:
+            encode_and_score(codec, None, 6)
+            return
+        with budget.lease() as threads:
+            encode_and_score(codec, *core_budget.split_encode_and_score(threads))
+
+    scheduler = task_scheduler.TaskScheduler(jobs)
+    task_scheduler.set_scheduler(scheduler)
+    if budget is not None:
+        core_budget.set_core_budget(budget)
+    all_submitted = threading.Event()
+    start = scheduler.submit(  # (--> the jobs are all ready at once)
+        task_scheduler.Task("start", lambda _: all_submitted.wait(), 0)
+    )
+    tasks = [
+        scheduler.submit(
+            task_scheduler.Task(f"job {x}", job, FRAMES_PER_JOB, dependencies=[start])
+        )
+        for x in range(2 * jobs)
+    ]
+
+    start_time = time.perf_counter()
+    all_submitted.set()
+    scheduler.wait(tasks)
+    for x in tasks:
+        x.result()
+    task_scheduler.set_scheduler(None)
+    return 2 * jobs * FRAMES_PER_JOB / (time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    cores = os.cpu_count() or 1
+    for codec in CODECS:
+        for jobs in sorted({1, 2, 4, max(1, cores // 2), cores}):
+            unbudgeted = run_jobs(codec, jobs, None)
+            budgeted = run_jobs(codec, jobs, core_budget.CoreBudget(cores))
+            print(
+                f"{codec.NAME}: {jobs} at once on {cores} cores --> "
+                f"before {unbudgeted:.1f} fps, after {budgeted:.1f} fps "
+                f"({cores // jobs} threads each)"
+            )
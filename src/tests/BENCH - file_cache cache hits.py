@@ -0,0 +1,78 @@
+import functools
+import inspect
+import os
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ffmpeg
+import file_cache
+import videodata
+
+"""
+Micro-benchmark of the per-hit cost of `file_cache.cache`
+- before: `inspect.getsource` + `str(args)` on every call (the old key derivation)
+- after: source hashed once when decorating + field-level fingerprint of the args
+"""
+
+NUMBER_OF_CALLS = 2_000
+
+legacy_cache_data: list[file_cache.data] = []
+
+
+def legacy_cache(annotated_function):
+    # the old key derivation + lookup (copied from before the change)
+    @functools.wraps(annotated_function)
+    def wrapper(*args, **kwargs):
+        function_signature_unique = file_cache.calculate_sha(
+            inspect.getsource(annotated_function)
+            + "".join(str(x) for x in args)
+            + "".join(f"{x[0]}{x[1]}" for x in kwargs.items())
+        )
+        cache_filename = file_cache.CACHE_DIRECTORY / f"cache-{function_signature_unique}.pickle"
+        if not os.path.exists(cache_filename.parent):
+            os.makedirs(cache_filename.parent)
+
+        if matching_data := [
+            x for x in legacy_cache_data if x.cache_filename.name == cache_filename.name
+        ]:
+            return matching_data[0].cache_data
+
+        recieved_value = annotated_function(*args, **kwargs)
+        legacy_cache_data.append(file_cache.data(cache_filename, recieved_value, True))
+        return recieved_value
+
+    return wrapper
+
+
+def metadata_like_function(
+    video: videodata.RawVideoData, codec: ffmpeg.VideoCodec, start: int, end: int
+) -> int:
+    return end - start
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        file_cache.CACHE_DIRECTORY = Path(directory)
+        input_file = Path(directory) / "input.mp4"
+        _ = input_file.write_bytes(os.urandom(1024 * 1024))
+
+        video = videodata.RawVideoData(input_file, Path("output.mkv"), None)
+        codec = ffmpeg.SVTAV1(preset=6)
+
+        before = legacy_cache(metadata_like_function)
+        after = file_cache.cache()(metadata_like_function)
+
+        _ = before(video, codec, 0, 100)  # (fill the cache)
+        _ = after(video, codec, 0, 100)
+
+        for name, function in (("before", before), ("after", after)):
+            elapsed = timeit.timeit(
+                lambda: function(video, codec, 0, 100), number=NUMBER_OF_CALLS
+            )
+            print(f"{name}: {elapsed / NUMBER_OF_CALLS * 1_000_000:.1f} µs per cache hit")
+
+        file_cache.cache_cleanup()
@@ -0,0 +1,53 @@
+import math
+import sys
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import crf_search
+
+"""
+Probes needed by the CRF search strategies on smooth (logistic) score curves, the shape
+VMAF has over the CRF
+"""
+
+CRF_RANGE = range(0, 64)
+SCORE_RANGE = range(0, 101)
+
+
+def logistic_curve(midpoint: float, width: float) -> Callable[[float], float]:
+    return lambda crf: 100 / (1 + math.exp((crf - midpoint) / width))
+
+
+def probes_used(
+    strategy: crf_search.SearchStrategy,
+    curve: Callable[[float], float],
+    target_score: float,
+) -> int:
+    result = crf_search.search(
+        strategy,
+        CRF_RANGE,
+        target_score,
+        SCORE_RANGE,
+        lambda crfs: {x: curve(x) for x in crfs},
+    )
+    return result.probes_used
+
+
+def test_regula_falsi_needs_no_more_probes_than_bisection() -> None:
+    for midpoint, width in [(25, 5), (40, 8)]:
+        curve = logistic_curve(midpoint, width)
+        bisection_probes, regula_falsi_probes = 0, 0
+        for target_score in range(80, 99):
+            bisection = probes_used(crf_search.Bisection(), curve, target_score)
+            regula_falsi = probes_used(crf_search.RegulaFalsi(), curve, target_score)
+            assert regula_falsi <= bisection, (midpoint, width, target_score)
+            bisection_probes += bisection
+            regula_falsi_probes += regula_falsi
+        assert regula_falsi_probes < bisection_probes
+
+
+if __name__ == "__main__":
+    test_regula_falsi_needs_no_more_probes_than_bisection()
+    print("ok")
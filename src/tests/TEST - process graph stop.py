@@ -0,0 +1,39 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import process_graph
+
+"""
+A graph stopped from `on_stdout_line` (eg a streaming probe whose score is settled) returns
+the lines read until then, without waiting for the rest or failing
+"""
+
+
+def test_stop_from_stdout_line() -> None:
+    lines: list[bytes] = []
+
+    def on_line(line: bytes) -> None:
+        lines.append(line)
+        if len(lines) == 3:
+            graph.stop()
+
+    graph = process_graph.ProcessGraph(
+        process_graph.Stage(
+            "slow counter",
+            ["sh", "-c", "i=0; while [ $i -lt 100 ]; do echo $i; i=$((i+1)); sleep 0.1; done"],
+        ),
+        on_stdout_line=on_line,
+    )
+    start_time = time.perf_counter()
+    result = graph.run()
+    assert time.perf_counter() - start_time < 5, "wasn't stopped"
+    assert lines[:3] == [b"0\n", b"1\n", b"2\n"], lines
+    assert result.stdout.startswith(b"0\n1\n2\n"), result.stdout
+
+
+if __name__ == "__main__":
+    test_stop_from_stdout_line()
+    print("ok")
@@ -0,0 +1,52 @@
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import profiling
+import task_scheduler
+
+"""
+A span opened inside of a scheduled task keeps the scene and the parent span it was
+submitted from (the task runs on its own thread)
+"""
+
+
+def test_span_inside_task_keeps_scene_and_parent() -> None:
+    scheduler = task_scheduler.TaskScheduler(2)
+
+    def probe(_: threading.Event) -> str:
+        with profiling.span("probe (task scheduler context test)"):
+            return threading.current_thread().name
+
+    with profiling.scene("scene 7"):
+        with profiling.span("identify (task scheduler context test)"):
+            task = scheduler.submit(task_scheduler.Task("probe", probe, 1))
+            scheduler.wait([task])
+    assert task.result() != threading.current_thread().name
+
+    (record,) = [
+        x for x in profiling.records() if x.name == "probe (task scheduler context test)"
+    ]
+    assert record.scene == "scene 7", record
+    assert record.parent == "identify (task scheduler context test)", record
+    assert record.depth == 1, record
+
+
+def test_finished_tasks_are_only_counted() -> None:
+    scheduler = task_scheduler.TaskScheduler(2)
+    first = scheduler.submit(task_scheduler.Task("first", lambda _: 1, 5))
+    second = scheduler.submit(
+        task_scheduler.Task("second", lambda _: 2, 3, dependencies=[first])
+    )
+    assert first.critical_path() == 8
+    scheduler.wait([first, second])
+    assert scheduler.view() == []
+    assert scheduler.states() == {"done": 2}
+
+
+if __name__ == "__main__":
+    test_span_inside_task_keeps_scene_and_parent()
+    test_finished_tasks_are_only_counted()
+    print("ok")
@@ -1,20 +1,33 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from subprocess import CompletedProcess
-from typing import Literal
+from typing import Callable, Literal
 
 # from scenedetect import frame_timecode
+import artifact_store
 import ffmpeg
 import ffmpeg_heuristics
 import graph_generate
+import cache_gc
+import core_budget
+import crf_predictor
+import crf_search
+import encoder_calibration
 import scene_detection
+import speculative_probing
+import subclip_probing
+import task_scheduler
 import file_cache
+import preset_calibration
+import profiling
 import videodata
 
 from rich import print
-from rich.progress import Progress, TimeElapsedColumn, track
-import concurrent.futures
-import os
+from rich.live import Live
+from rich.progress import Progress, TimeElapsedColumn
+from rich.table import Table
+import collections
+import math
+import threading
 import time
 
 from rich.console import Console
@@ -36,14 +49,51 @@ class videoInputData:
     audio_commands: str = "-c:a copy"
     subtitle_commands: str = "-c:s copy"
     multithreading_threads: int = 2
+    # (the cores split between the encoders/libvmaf running at once, None --> all of them)
+    cores_to_use: int | None = None
     scenes_length_sort: Literal["chronological", "largest first", "smallest first"] = (
         "largest first"  # ensures that CPU always being used
     )
     make_comparison_with_blend_filter: bool = False
     render_final_video: bool = False
+    intermediate_files_quota_bytes: int | None = None  # (None = no limit)
+    # probe encodes kept in memory (memfd, or files in `artifact_memory_root` eg a tmpfs)
+    artifact_memory_budget_bytes: int = artifact_store.DEFAULT_MEMORY_BUDGET_BYTES
+    artifact_memory_root: Path | None = None
+    measure_vspipe_startup: bool = False  # (one extra frame decoded per scene)
+    # eg crf_search.LogisticFit(), or crf_search.KAry(3) (a round encoded from one decode)
+    crf_search_strategy: crf_search.SearchStrategy = field(
+        default_factory=crf_search.Bisection
+    )
+    crf_search_tolerance: float = 0.0  # (a score this close to the target is good enough)
+    # start each scene's search from a bracket predicted from the scenes already done
+    predict_crf_bracket: bool = False
+    # probe only a few representative windows of long scenes (None --> always the whole scene)
+    subclip_probing_policy: subclip_probing.SubclipProbing | None = None
+    # probes at a fast preset (eg 12 for SVT-AV1, "veryfast" for x264), None --> the codec's
+    probe_preset: int | str | None = None
+    preset_calibration_scenes: int = preset_calibration.DEFAULT_CALIBRATION_SCENES
+    # probes scored in segments, stopped once they are clearly above/below the target
+    streaming_probes: bool = False
+    # the idle worker slots (eg at the end) probe the next CRFs of the scenes still searching
+    speculative_probes: bool = False
 
 
 def compressing_video(video: videoInputData) -> None:
+    cache_gc.set_quota(video.intermediate_files_quota_bytes)
+    artifact_store.set_artifact_store(
+        artifact_store.ArtifactStore(
+            cache_gc.INTERMEDIATE_FILES_DIRECTORY,
+            video.artifact_memory_budget_bytes,
+            video.artifact_memory_root,
+        )
+    )
+    _ = cache_gc.enforce_quota()  # (leftovers of a crashed run)
+
+    if isinstance(video.videodata.input_filename, ffmpeg.accurate_seek):
+        with rich_console.status("Building ffms2 index"):
+            video.videodata.input_filename.build_index()
+
     with rich_console.status(
         f"Getting metadata of input file ({video.videodata.input_filename})"
     ):
@@ -88,20 +138,89 @@ def compressing_video(video: videoInputData) -> None:
     optimal_crf_list: list[
         tuple[scene_detection.SceneData, compress_video_section_data]
     ] = []
+    scheduler = task_scheduler.TaskScheduler(
+        video.multithreading_threads,
+        task_scheduler.POLICY_OF_SCENES_LENGTH_SORT[video.scenes_length_sort],
+        # (scenes waiting for their probes don't use a slot --> but a thread each)
+        {"scene": 2 * video.multithreading_threads},
+    )
+    task_scheduler.set_scheduler(scheduler)
+    core_budget.set_core_budget(core_budget.CoreBudget(video.cores_to_use))
+    crf_prediction = crf_predictor.CRFPredictor(video.codec.ACCEPTED_CRF_RANGE)
+    probe_codec = preset_calibration.probe_codec(video.codec, video.probe_preset)
+    calibration = preset_calibration.PresetCalibration(video.preset_calibration_scenes)
 
     def compress_video_section_call(
         section: int, video_section: scene_detection.SceneData
     ) -> tuple[int, scene_detection.SceneData, compress_video_section_data]:
-        video_section_data = identify_videosection_optimal_crf(
-            video.videodata,
-            Path("Temp.mkv") if video.render_final_video else None,
-            # temporary_video_file_names(section, video.videodata.input_filename.parent),
-            # input_filename_data,
-            video.codec,
-            video.heuristic,
-            video_section.start_frame,
-            video_section.end_frame,
-        )
+        prerender_filename = None
+        with profiling.scene(f"scene {section}"):
+            if video.measure_vspipe_startup and isinstance(
+                video.videodata.input_filename, ffmpeg.accurate_seek
+            ):
+                _ = video.videodata.input_filename.measure_startup(
+                    video_section.start_frame
+                )
+            if isinstance(video.videodata.input_filename, ffmpeg.accurate_seek):
+                # (does nothing unless `vapoursynth_data.prerender_scenes`)
+                prerender_filename = video.videodata.input_filename.prerender(
+                    video_section.start_frame, video_section.end_frame
+                )
+                if prerender_filename is not None:
+                    cache_gc.pin(prerender_filename)
+            features = (
+                crf_predictor.scene_features(
+                    video.videodata, video_section.start_frame, video_section.end_frame
+                )
+                if video.predict_crf_bracket
+                else None
+            )
+            score_offset = (
+                calibration.score_offset() if probe_codec is not None else None
+            )
+            video_section_data: compress_video_section_data | None = None
+            try:
+                video_section_data = identify_videosection_optimal_crf(
+                    video.videodata,
+                    Path("Temp.mkv") if video.render_final_video else None,
+                    # temporary_video_file_names(section, video.videodata.input_filename.parent),
+                    # input_filename_data,
+                    video.codec,
+                    video.heuristic,
+                    video_section.start_frame,
+                    video_section.end_frame,
+                    video.crf_search_strategy,
+                    video.crf_search_tolerance,
+                    crf_prediction.predict(
+                        video_section.start_frame, video_section.end_frame, features
+                    ),
+                    video.subclip_probing_policy,
+                    probe_codec,
+                    score_offset,
+                    video.streaming_probes,
+                    video.speculative_probes,
+                )
+            finally:
+                if probe_codec is not None:
+                    calibration.add(
+                        video_section_data.preset_score_offset
+                        if video_section_data is not None
+                        else None,
+                        calibration_scene=score_offset is None,
+                    )
+            assert video_section_data is not None
+            crf_prediction.add(
+                video_section.start_frame,
+                video_section.end_frame,
+                features,
+                video_section_data.crf,
+                video_section_data.heuristic,
+            )
+        if prerender_filename is not None:  # (kept for later runs, until collected)
+            cache_gc.unpin(prerender_filename)
+        if video_section_data.filepath_of_final is not None:
+            # (may be from the cache of a previous run) --> needed for the concat
+            cache_gc.pin(video_section_data.filepath_of_final)
 
         # if video.render_final_video:
         #     _ = ffmpeg.run_ffmpeg_command(
@@ -121,27 +240,113 @@ def compressing_video(video: videoInputData) -> None:
 
         return (section, video_section, video_section_data)
 
-    with concurrent.futures.ThreadPoolExecutor(
-        video.multithreading_threads
-    ) as executor:
-        results_future = list(
-            executor.submit(
-                compress_video_section_call,
-                raw_video_scenes.index(scene),
-                scene,
+    scene_tasks = [
+        scheduler.submit(
+            task_scheduler.Task(
+                f"scene {raw_video_scenes.index(scene)}",
+                lambda _, scene=scene: compress_video_section_call(
+                    raw_video_scenes.index(scene), scene
+                ),
+                predicted_remaining_cost(
+                    video.videodata,
+                    scene.end_frame - scene.start_frame,
+                    video.codec,
+                    probe_codec=probe_codec,
+                ),
+                category="scene",
+                order=i,
             )
-            for scene in video_scenes
         )
+        for i, scene in enumerate(video_scenes)
+    ]
+    last_tasks = scene_tasks
+    concat_cost = (
+        CONCAT_COST_PER_FRAME
+        * input_filename_data.total_frames
+        * (encode_seconds_per_frame(video.videodata, video.codec) or 1.0)
+    )
+
+    def concatenate_scenes(_: threading.Event) -> None:
+        filepaths = [x.result()[2].filepath_of_final for x in scene_tasks]
+        clean_filepaths: list[Path] = []  # to fix lsp
+
+        for path in filepaths:
+            assert path is not None
+            clean_filepaths.append(path)
+
+        ffmpeg.concatenate_video_files(
+            clean_filepaths,
+            video.videodata.output_filename,
+        )
+
+        for path in clean_filepaths:
+            cache_gc.unpin(path)
+            try:
+                artifact_store.get_artifact_store().remove(path)
+            except Exception:
+                print(f"Error deleting temp file {path}")
+
+        # for x in range(len(video_scenes)):
+        #     print(temporary_video_file_names(x))
+        #     print(ffmpeg.get_video_metadata(temporary_video_file_names(x)))
+        #     os.remove(temporary_video_file_names(x))
+
+    if video.render_final_video:
+        last_tasks = [
+            scheduler.submit(
+                task_scheduler.Task(
+                    "concat",
+                    concatenate_scenes,
+                    concat_cost,
+                    scene_tasks,
+                    category="concat",
+                )
+            )
+        ]
+        # (from the source's stream layout, the vapoursynth output never has audio)
+        if ffmpeg.contains_audio(video.videodata):
+            mux = ffmpeg.combine_audio_and_subtitle_streams_from_another_video
+            last_tasks = [
+                scheduler.submit(
+                    task_scheduler.Task(
+                        "audio + subtitle mux",
+                        lambda _: mux(
+                            video.videodata.raw_input_filename,
+                            video.videodata.output_filename,
+                            video.audio_commands,
+                            video.subtitle_commands,
+                        ),
+                        concat_cost,
+                        last_tasks,
+                        category="mux",
+                    )
+                )
+            ]
 
-        results = track(
-            (x.result() for x in results_future),
-            total=len(video_scenes),
-            description="Rendering video",
-            update_period=1,
+    costs_in_seconds = encode_seconds_per_frame(video.videodata, video.codec) is not None
+    if not costs_in_seconds:
+        print(
+            f"no encoder profile for {video.codec.NAME} on this host (python encoder_calibration.py) --> no ETA"
         )
+    with Live(
+        queue_table(scheduler, costs_in_seconds),
+        console=rich_console,
+        refresh_per_second=2,
+    ) as live:
+        while not all(x.done() for x in last_tasks):
+            live.update(queue_table(scheduler, costs_in_seconds))
+            time.sleep(0.5)
+        live.update(queue_table(scheduler, costs_in_seconds))
+    task_scheduler.set_scheduler(None)
+
+    results = sorted((x.result() for x in scene_tasks), key=lambda x: x[0])
+    optimal_crf_list = [x[1:] for x in results]
+    for x in last_tasks:  # (eg the concat failed)
+        _ = x.result()
 
-        results = sorted(results)
-        optimal_crf_list = [x[1:] for x in results]
+    print(
+        f"probes used per scene ({video.crf_search_strategy.NAME}): {[x[1].probes_used for x in optimal_crf_list]}"
+    )
 
     # with rich_console.status("Concatenating intermediate files"):
     #     ffmpeg.concatenate_video_files(
@@ -209,41 +414,6 @@ def compressing_video(video: videoInputData) -> None:
                 colour="blue",
             )
 
-    if video.render_final_video:
-        filepaths = [x[1].filepath_of_final for x in optimal_crf_list]
-        clean_filepaths: list[Path] = []  # to fix lsp
-
-        for path in filepaths:
-            assert path is not None
-            clean_filepaths.append(path)
-
-        ffmpeg.concatenate_video_files(
-            clean_filepaths,
-            video.videodata.output_filename,
-        )
-
-        try:
-            _ = [
-                os.remove(temporary_video_file_names(x, Path("temporary_cache_dir")))
-                for x in range(len(raw_video_scenes))
-            ]
-        except Exception:
-            print("Error deleting temp files")
-
-        # for x in range(len(video_scenes)):
-        #     print(temporary_video_file_names(x))
-        #     print(ffmpeg.get_video_metadata(temporary_video_file_names(x)))
-        #     os.remove(temporary_video_file_names(x))
-
-        if input_filename_data.contains_audio:
-            with rich_console.status("Combining audio+subtitles from source video"):
-                ffmpeg.combine_audio_and_subtitle_streams_from_another_video(
-                    video.videodata.raw_input_filename,
-                    video.videodata.output_filename,
-                    video.audio_commands,
-                    video.subtitle_commands,
-                )
-
     # if video.make_comparison_with_blend_filter:
     #     with rich_console.status("Making a visual comparison with blend filter"):
     #         ffmpeg.visual_comparison_of_video_with_blend_filter(
@@ -268,6 +438,100 @@ def compressing_video(video: videoInputData) -> None:
     # print(ffmpeg.get_video_metadata(video.full_output_filename))
 
 
+CONCAT_COST_PER_FRAME = 0.05  # (relative to encoding a frame, for the task priorities)
+
+
+def encode_seconds_per_frame(
+    video_data: videodata.RawVideoData, codec: ffmpeg.VideoCodec
+) -> float | None:
+    """
+    From the encoder profile of this host (`encoder_calibration`), at the threads of one
+    worker slot (None --> not calibrated)
+    """
+    metadata = ffmpeg.get_video_metadata(video_data, video_data.input_filename)
+    scheduler = task_scheduler.get_scheduler()
+    threads = core_budget.get_core_budget().total_cores // (
+        scheduler.max_concurrency if scheduler is not None else 1
+    )
+    return encoder_calibration.seconds_per_frame(
+        codec, metadata.width * metadata.height, max(1, threads)
+    )
+
+
+def predicted_remaining_cost(
+    video_data: videodata.RawVideoData,
+    frames: int,
+    codec: ffmpeg.VideoCodec,
+    rounds_done: int = 0,
+    probe_codec: ffmpeg.VideoCodec | None = None,  # (None --> probed at `codec`)
+) -> float:
+    """
+    The critical path of a scene: the probes of the rounds still to come (bisection) + the
+    final encode, in seconds from the encoder profile (in frames to encode without one)
+    """
+    rounds = math.log2(len(codec.ACCEPTED_CRF_RANGE))
+    probe_seconds = encode_seconds_per_frame(
+        video_data, probe_codec if probe_codec is not None else codec
+    )
+    final_seconds = encode_seconds_per_frame(video_data, codec)
+    if probe_seconds is None or final_seconds is None:
+        probe_seconds, final_seconds = 1.0, 1.0
+    return frames * (max(1.0, rounds - rounds_done) * probe_seconds + final_seconds)
+
+
+def estimated_seconds_left(scheduler: task_scheduler.TaskScheduler) -> float:
+    """
+    The scenes not done yet spread over the worker slots, then the concat and mux (with
+    the task costs in seconds)
+    """
+    remaining: collections.Counter[str] = collections.Counter()
+    for x in scheduler.view():
+        if x.state not in ("done", "failed", "cancelled"):
+            remaining[x.category] += max(0.0, x.cost - (x.running_seconds or 0.0))
+    return (
+        remaining["scene"] / scheduler.max_concurrency
+        + remaining["concat"]
+        + remaining["mux"]
+    )
+
+
+def queue_table(
+    scheduler: task_scheduler.TaskScheduler, costs_in_seconds: bool, rows: int = 15
+) -> Table:
+    """
+    The live view of the task queue
+    """
+    tasks = scheduler.view()
+    states = scheduler.states()
+    budget = core_budget.get_core_budget()
+    caption = ", ".join(f"{y} {x}" for x, y in states.items())
+    caption += f" | cores leased {budget.in_use()}/{budget.total_cores}"
+    if costs_in_seconds:
+        caption += f" | ETA {round(estimated_seconds_left(scheduler))}s"
+    table = Table(title="Rendering video", caption=caption)
+    for column in (
+        "task",
+        "state",
+        f"critical path ({'s' if costs_in_seconds else 'frames'})",
+        "running (s)",
+    ):
+        table.add_column(column)
+    for x in sorted(
+        (x for x in tasks if x.state in ("running", "waiting", "ready", "blocked")),
+        key=lambda x: (
+            ("running", "waiting", "ready", "blocked").index(x.state),
+            -x.critical_path,
+        ),
+    )[:rows]:
+        table.add_row(
+            x.name,
+            x.state,
+            str(round(x.critical_path)),
+            "" if x.running_seconds is None else str(round(x.running_seconds, 1)),
+        )
+    return table
+
+
 def temporary_video_file_names(position: int, filepath_for_render: Path) -> Path:
     # , extension: str = "mkv"
     return filepath_for_render / Path(f"temp-{position}.mkv")
@@ -279,12 +543,21 @@ class compress_video_section_data:
     heuristic: float
     heuristic_throughout: list[float]
     filepath_of_final: None | Path
+    probes_used: int = 0
+    probe_confidence: float = 1.0  # (< 1 --> probed on windows that didn't fully agree)
+    preset_score_offset: float | None = None  # (slow - fast preset score, at this CRF)
 
 
 @file_cache.store_cumulative_time
 @file_cache.cache(
     sub_directory=Path("videosection_crf"),
     persistent_after_termination=False,  # False
+    # (the final file may have been garbage collected since)
+    still_valid=lambda x: x.filepath_of_final is None
+    or artifact_store.get_artifact_store().exists(x.filepath_of_final),
+    # (they change between runs, eg with the scenes done before --> the scene is keyed on
+    # its target and tolerance only, the final encode is verified against them either way)
+    arguments_not_in_key=("initial_bracket", "probe_score_offset"),
 )
 def identify_videosection_optimal_crf(
     video: videodata.RawVideoData,
@@ -293,162 +566,451 @@ def identify_videosection_optimal_crf(
     heuristic: ffmpeg_heuristics.heuristic,
     frame_start: int,
     frame_end_raw: int,
+    search_strategy: crf_search.SearchStrategy | None = None,  # (None --> Bisection)
+    search_tolerance: float = 0.0,
+    initial_bracket: tuple[int, int] | None = None,  # (eg from `crf_predictor`)
+    subclip_policy: subclip_probing.SubclipProbing | None = None,
+    probe_codec: ffmpeg.VideoCodec | None = None,  # (eg a faster preset of `codec`)
+    probe_score_offset: float | None = None,  # (None --> calibrate `probe_codec`)
+    streaming_probes: bool = False,
+    speculative_probes: bool = False,
 ) -> compress_video_section_data:
     """
     This function finds the optimal CRF value for a target quality heuristic
     This does not render the video itself, and is thus a pure function
-    """
-    frame_end = int(
-        min(
-            frame_end_raw,
-            frame_end_raw
-            + round(
-                20 * ffmpeg.get_video_metadata(video, video.input_filename).frame_rate
-            ),
-        ),
-    )
-    bottom_crf_value = min(codec.ACCEPTED_CRF_RANGE)
-    top_crf_value = max(codec.ACCEPTED_CRF_RANGE)
 
-    all_heuristic_crf_values: dict[int, float] = {}
+    The CRFs of a round of the search (eg `crf_search.KAry`) are encoded together
+    from a single decode of the section (when rendering to files)
+
+    With `subclip_policy`, long scenes are searched on a few windows, then encoded in full
+    once (the whole scene is searched instead if the windows disagree)
 
-    def expect_str(data: str | CompletedProcess[bytes] | None) -> str:
-        if isinstance(data, str):
-            return data
-        raise ValueError("Should never be None")
+    With `probe_codec` and `probe_score_offset`, the search probes at `probe_codec`, then
+    the whole scene is encoded once at `codec` (and scored, to verify)
+    Without `probe_score_offset` it is a calibration scene: searched at `codec`, plus one
+    probe at `probe_codec` --> `preset_score_offset`
+
+    With `streaming_probes`, a probe that is clearly above/below the target is stopped early
+    (a bound for the search), and the chosen CRF is encoded once in full
+
+    With `speculative_probes`, the CRFs the search may need next are probed in idle worker
+    slots (`speculative_probing`), and cancelled once they can't be needed anymore
+
+    The probes and the final encode are tasks of the `task_scheduler` (if there is one)
+    """
+    if search_strategy is None:
+        search_strategy = crf_search.Bisection()
+    fast_probes = probe_codec is not None and probe_score_offset is not None
+    search_codec = probe_codec if fast_probes and probe_codec is not None else codec
+    search_target = heuristic.target_score - (
+        probe_score_offset if fast_probes and probe_score_offset is not None else 0.0
+    )
+    windows = (
+        subclip_probing.choose_windows(video, frame_start, frame_end_raw, subclip_policy)
+        if subclip_policy is not None
+        else None
+    )
+    # (crf, start frame, end frame) --> the probe of that range
+    probe_results: dict[tuple[int, int, int], ffmpeg_heuristics.scoredvideo] = {}
 
     all_temp_files: list[Path] = []
+    # (by the multiple CRF encode of the round)
+    prerendered_crfs: set[tuple[int, int, int]] = set()
+    # (thread id --> the cancel event of the speculative probe it runs)
+    cancel_events: dict[int, threading.Event] = {}
+    scene_name = f"scene {frame_start}-{frame_end_raw}"
+    search_rounds = 0  # (for the predicted critical path of the probe tasks)
 
     def temp_vid_filename(
-        crf: int, local_frame_start: int, local_frame_end: int
+        crf: int,
+        local_frame_start: int,
+        local_frame_end: int,
+        local_codec: ffmpeg.VideoCodec = codec,
     ) -> Path:
         assert output_video_name is not None
-        file_path = (
-            Path("temporary_cache_dir")
-            / Path("intermediatefiles")
-            / Path(
-                f"{crf} - {local_frame_start} - {local_frame_end} - {video.sha256_of_input} {output_video_name.name}"
-            )
+        preset_name = "" if local_codec == codec else " (probe preset)"
+        # (in memory while within the budget, else in `intermediatefiles`)
+        file_path = artifact_store.get_artifact_store().path(
+            f"{crf} - {local_frame_start} - {local_frame_end} - {video.sha256_of_input}{preset_name} {output_video_name.name}"
         )
         if file_path not in all_temp_files:
             all_temp_files.append(file_path)
-        if not os.path.exists(file_path.parent):
-            try:
-                os.makedirs(file_path.parent)
-            except FileExistsError:
-                print("dir already exists")
+            cache_gc.pin(file_path)  # (unpinned once this scene is done with it)
+        cache_gc.touch(file_path)
         return file_path
 
     @file_cache.cache(
-        extra_info_in_shahash=f"{video}{codec}{heuristic}{frame_start}{frame_end}",
+        extra_info_in_shahash=file_cache.fingerprint(
+            (video, heuristic, search_target if streaming_probes else None)
+        ),
         persistent_after_termination=True,
     )
-    def _render_for_certain_crf(crf: int) -> float:
-        temporary_ffmpeg_command = ffmpeg.run_ffmpeg_command(
-            video,
-            # "get ffmpeg string",
-            temp_vid_filename(crf, frame_start, frame_end)
-            if isinstance(output_video_name, Path)
-            else "get ffmpeg string",
-            current_crf,
-            codec,
-            frame_start,
-            frame_end,
-            300,
-        )
+    def _render_for_certain_crf(
+        crf: int,
+        local_frame_start: int,
+        local_frame_end: int,
+        local_codec: ffmpeg.VideoCodec,
+    ) -> ffmpeg_heuristics.scoredvideo:
+        _ = cache_gc.enforce_quota()
+        if (
+            local_codec == search_codec
+            and (crf, local_frame_start, local_frame_end) in prerendered_crfs
+        ):
+            probe_result = heuristic.scored_video(
+                video,
+                temp_vid_filename(crf, local_frame_start, local_frame_end, local_codec),
+                source_start_end_frame=(local_frame_start, local_frame_end),
+                subsample=1,
+            )
+        elif streaming_probes:  # (never written, the final chunk is encoded afterwards)
+            probe_result = heuristic.streaming_summary_of_encode(
+                video,
+                crf,
+                local_codec,
+                (local_frame_start, local_frame_end),
+                300,
+                cancel_event=cancel_events.get(threading.get_ident()),
+                target_score=search_target,
+            )
+        else:  # (encoded and scored from a single decode)
+            probe_result = heuristic.summary_of_encode(
+                video,
+                temp_vid_filename(crf, local_frame_start, local_frame_end, local_codec)
+                if isinstance(output_video_name, Path)
+                else None,
+                crf,
+                local_codec,
+                (local_frame_start, local_frame_end),
+                300,
+                subsample=1,
+                cancel_event=cancel_events.get(threading.get_ident()),
+            )
+
+        print(probe_result.score)
+        return probe_result
 
-        if temporary_ffmpeg_command is None:
-            temporary_ffmpeg_command = ""
-        assert (
-            isinstance(temporary_ffmpeg_command, str)
-            # or temporary_ffmpeg_command is None
-        ), "SHOULD BE STR OR NONE"
-
-        current_heuristic = heuristic.summary_of_overall_video(
-            video,
-            temp_vid_filename(crf, frame_start, frame_end)
-            if isinstance(output_video_name, Path)
-            else temporary_ffmpeg_command,
-            source_start_end_frame=(frame_start, frame_end),
-            subsample=1,
+    def search_score(
+        window_results: dict[subclip_probing.framerange, ffmpeg_heuristics.scoredvideo],
+    ) -> float | crf_search.scorebound:
+        estimate = subclip_probing.combined_score(
+            {x: y.score for x, y in window_results.items()}
+        )
+        if all(x.bound is None for x in window_results.values()):
+            return estimate
+        return crf_search.scorebound(
+            estimate,
+            *(
+                subclip_probing.combined_score(
+                    {
+                        x: y.bound[i] if y.bound is not None else y.score
+                        for x, y in window_results.items()
+                    }
+                )
+                for i in (0, 1)
+            ),
         )
 
-        print(current_heuristic)
-        return current_heuristic
+    def probe_task(
+        crf: int, local_frame_start: int, local_frame_end: int
+    ) -> task_scheduler.Task:
+        return task_scheduler.Task(
+            f"{scene_name}: probe CRF {crf} ({local_frame_start}-{local_frame_end})",
+            lambda _: _render_for_certain_crf(
+                crf, local_frame_start, local_frame_end, search_codec
+            ),
+            predicted_remaining_cost(
+                video, frame_end_raw - frame_start, codec, search_rounds, search_codec
+            ),
+            category="probe",
+        )
 
-    while (
-        current_crf := (top_crf_value + bottom_crf_value) // 2
-    ) not in all_heuristic_crf_values.keys():
-        # while os.path.isfile("STOP.txt"):
-        #     time.sleep(1)
+    def probe_round_of(
+        probe_ranges: list[subclip_probing.framerange],
+        prober: speculative_probing.SpeculativeProber | None,
+    ) -> Callable[[list[int]], dict[int, float | crf_search.scorebound]]:
+        def probe_round(
+            current_crfs: list[int],
+        ) -> dict[int, float | crf_search.scorebound]:
+            # while os.path.isfile("STOP.txt"):
+            #     time.sleep(1)
+            nonlocal search_rounds
+            if prober is not None:  # (then in the cache)
+                prober.wait(current_crfs)
+
+            for local_frame_start, local_frame_end in probe_ranges:
+                crfs_to_render = [
+                    x
+                    for x in current_crfs
+                    if not file_cache.is_cached(
+                        _render_for_certain_crf,
+                        x,
+                        local_frame_start,
+                        local_frame_end,
+                        search_codec,
+                    )
+                ]
+                if (
+                    isinstance(output_video_name, Path)
+                    and len(crfs_to_render) > 1
+                    and not streaming_probes
+                ):
+                    _ = cache_gc.enforce_quota()
+                    _ = task_scheduler.run_tasks(
+                        [
+                            task_scheduler.Task(
+                                f"{scene_name}: probe CRFs {crfs_to_render} ({local_frame_start}-{local_frame_end})",
+                                lambda _: ffmpeg.run_ffmpeg_command_multiple_crf(
+                                    video,
+                                    {
+                                        x: temp_vid_filename(
+                                            x,
+                                            local_frame_start,
+                                            local_frame_end,
+                                            search_codec,
+                                        )
+                                        for x in crfs_to_render
+                                    },
+                                    search_codec,
+                                    local_frame_start,
+                                    local_frame_end,
+                                    300,
+                                ),
+                                predicted_remaining_cost(
+                                    video,
+                                    frame_end_raw - frame_start,
+                                    codec,
+                                    search_rounds,
+                                    search_codec,
+                                ),
+                                category="probe",
+                            )
+                        ]
+                    )
+                    prerendered_crfs.update(
+                        (x, local_frame_start, local_frame_end) for x in crfs_to_render
+                    )
+
+                for current_crf, probe_result in zip(
+                    current_crfs,
+                    task_scheduler.run_tasks(
+                        [
+                            probe_task(x, local_frame_start, local_frame_end)
+                            for x in current_crfs
+                        ]
+                    ),
+                ):
+                    probe_results[current_crf, local_frame_start, local_frame_end] = (
+                        probe_result
+                    )
+            search_rounds += 1
+            return {
+                x: search_score({y: probe_results[x, *y] for y in probe_ranges})
+                for x in current_crfs
+            }
+
+        return probe_round
+
+    def run_search(
+        probe_ranges: list[subclip_probing.framerange],
+        bracket: tuple[int, int] | None,
+    ) -> crf_search.searchresult:
+        scheduler = task_scheduler.get_scheduler()
+        if not speculative_probes or scheduler is None:
+            return crf_search.search(
+                search_strategy,
+                codec.ACCEPTED_CRF_RANGE,
+                search_target,
+                heuristic.RANGE,
+                probe_round_of(probe_ranges, None),
+                search_tolerance,
+                bracket,
+            )
 
-        current_heuristic = _render_for_certain_crf(current_crf)
+        def speculative_probe(crf: int, cancel_event: threading.Event) -> None:
+            cancel_events[threading.get_ident()] = cancel_event
+            try:
+                for local_frame_start, local_frame_end in probe_ranges:
+                    _ = _render_for_certain_crf(
+                        crf, local_frame_start, local_frame_end, search_codec
+                    )
+            finally:
+                del cancel_events[threading.get_ident()]
+
+        prober = speculative_probing.SpeculativeProber(
+            scheduler,
+            speculative_probe,
+            scene_name,
+            predicted_remaining_cost(
+                video, frame_end_raw - frame_start, codec, search_rounds, search_codec
+            ),
+        )
+        return crf_search.search(
+            search_strategy,
+            codec.ACCEPTED_CRF_RANGE,
+            search_target,
+            heuristic.RANGE,
+            probe_round_of(probe_ranges, prober),
+            search_tolerance,
+            bracket,
+            lambda round_crfs, crfs: prober.speculate(
+                round_crfs,
+                [
+                    x
+                    for x in crfs
+                    if not all(
+                        file_cache.is_cached(
+                            _render_for_certain_crf, x, *y, search_codec
+                        )
+                        for y in probe_ranges
+                    )
+                ],
+            ),
+            scheduler.idle,
+        )
 
-        all_heuristic_crf_values.update({current_crf: current_heuristic})
+    search_result = run_search(
+        windows if windows is not None else [(frame_start, frame_end_raw)],
+        initial_bracket,
+    )
+    probes_used = search_result.probes_used
+    if initial_bracket is not None:
+        profiling.count(
+            "crf prediction: bracket missed"
+            if search_result.bracket_missed
+            else "crf prediction: bracket hit"
+        )
 
-        # if round(current_heuristic) == heuristic.target_score:
-        if abs(current_heuristic - heuristic.target_score) <= 0:
-            print(f"Exact match (of {heuristic.NAME} heuristic)")
-            break
-        elif current_heuristic > heuristic.target_score:
-            bottom_crf_value = current_crf
-        elif current_heuristic < heuristic.target_score:
-            top_crf_value = current_crf
+    probe_confidence = 1.0
+    if windows is not None:
+        assert subclip_policy is not None
+        probe_confidence = subclip_probing.confidence(
+            {x: probe_results[search_result.crf, *x].score for x in windows},
+            subclip_policy,
+        )
+        print(
+            f"subclip probing: {len(windows)} windows of {frame_start}-{frame_end_raw}, confidence {probe_confidence:.2f}"
+        )
+        if probe_confidence == 0.0:  # (the windows disagree --> probe the whole scene)
+            profiling.count("subclip probing: fallback to the whole scene")
+            windows = None
+            search_result = run_search(
+                [(frame_start, frame_end_raw)],
+                (  # (most likely close to what the windows found)
+                    max(min(codec.ACCEPTED_CRF_RANGE), search_result.crf - 4),
+                    min(max(codec.ACCEPTED_CRF_RANGE), search_result.crf + 4),
+                ),
+            )
+            probes_used += search_result.probes_used
+        else:
+            profiling.count("subclip probing: windows trusted")
 
-        # _ = input()
+    closest_value = (search_result.crf, search_result.score)
+    print(
+        f"{search_strategy.NAME}: CRF {search_result.crf} ({heuristic.NAME} {search_result.score}) after {probes_used} probes"
+    )
+    profiling.count("crf search probes", probes_used)
 
-    closest_value = min(
-        all_heuristic_crf_values.items(),
-        key=lambda x: abs(x[1] - heuristic.target_score),
+    final_filepath = (
+        temp_vid_filename(closest_value[0], frame_start, frame_end_raw)
+        if output_video_name is not None
+        else None
+    )
+    final_encode_cost = (frame_end_raw - frame_start) * (
+        encode_seconds_per_frame(video, codec) or 1.0
     )
 
-    if (
-        output_video_name is not None
-        and not temp_vid_filename(closest_value[0], frame_start, frame_end_raw).exists()
-    ):  # in case of accidental deletion when restarting
-        _ = ffmpeg.run_ffmpeg_command(
-            video,
-            temp_vid_filename(closest_value[0], frame_start, frame_end_raw),
-            closest_value[0],
-            codec,
-            frame_start,
-            frame_end,
-            300,
+    if windows is None and not fast_probes and not streaming_probes:
+        # the probe of the winning CRF *is* the final chunk (same artifact, same scores)
+        if final_filepath is not None and not artifact_store.get_artifact_store().exists(
+            final_filepath
+        ):  # (eg the probe's score was from the cache, and its file has been deleted since)
+            profiling.count("final chunk: extra encode")
+            _ = task_scheduler.run_tasks(
+                [
+                    task_scheduler.Task(
+                        f"{scene_name}: final encode CRF {closest_value[0]}",
+                        lambda _: ffmpeg.run_ffmpeg_command(
+                            video,
+                            final_filepath,
+                            closest_value[0],
+                            codec,
+                            frame_start,
+                            frame_end_raw,
+                            300,
+                        ),
+                        final_encode_cost,
+                        category="final encode",
+                    )
+                ]
+            )
+        elif final_filepath is not None:
+            profiling.count("final chunk: winning probe promoted")
+        heuristic_throughout = probe_results[
+            closest_value[0], frame_start, frame_end_raw
+        ].throughout
+    else:  # (the one full encode, at the CRF the probes found, scored in the same pass)
+        profiling.count(
+            "final chunk: full encode after fast preset probes"
+            if fast_probes
+            else "final chunk: full encode after streaming probes"
+            if windows is None
+            else "final chunk: full encode after subclip probing"
         )
-
-    heuristic_throughout = heuristic.throughout_video(
-        video,
-        expect_str(
-            ffmpeg.run_ffmpeg_command(
-                video,
-                "get ffmpeg string",
-                closest_value[0],
-                codec,
-                frame_start,
-                frame_end_raw,
-                300,
+        final_result: ffmpeg_heuristics.scoredvideo = task_scheduler.run_tasks(
+            [
+                task_scheduler.Task(
+                    f"{scene_name}: final encode + {heuristic.NAME} CRF {closest_value[0]}",
+                    lambda _: heuristic.summary_of_encode(
+                        video,
+                        final_filepath,
+                        closest_value[0],
+                        codec,
+                        (frame_start, frame_end_raw),
+                        300,
+                        subsample=1,
+                    ),
+                    final_encode_cost,
+                    category="final encode",
+                )
+            ]
+        )[0]
+        print(
+            f"verification: {heuristic.NAME} {closest_value[1]} (probes) --> {final_result.score} (whole scene, final preset)"
+        )
+        closest_value = (closest_value[0], final_result.score)
+        heuristic_throughout = final_result.throughout
+
+    preset_score_offset = None
+    if probe_codec is not None and windows is None:
+        fast_probe = (
+            probe_results[closest_value[0], frame_start, frame_end_raw]
+            if fast_probes
+            else _render_for_certain_crf(  # (the one calibration probe)
+                closest_value[0], frame_start, frame_end_raw, probe_codec
             )
         )
-        if output_video_name is None
-        else temp_vid_filename(closest_value[0], frame_start, frame_end_raw),
-        source_start_end_frame=(frame_start, frame_end),
-        subsample=1,
-    )
+        if fast_probe.bound is None:  # (an estimate of a streaming probe would bias it)
+            preset_score_offset = closest_value[1] - fast_probe.score
+            print(f"preset calibration: score offset {preset_score_offset:.3f}")
 
     for filepath in all_temp_files:
-        if filepath == temp_vid_filename(closest_value[0], frame_start, frame_end_raw):
+        if filepath == final_filepath:
             continue
 
-        os.remove(filepath.resolve())
+        cache_gc.unpin(filepath)
+        # (may already be garbage collected, or be a probe from the cache)
+        artifact_store.get_artifact_store().remove(filepath)
         # except Exception:
         #     print("could not delete other temporary filepaths")
 
-    filepath = (
-        temp_vid_filename(closest_value[0], frame_start, frame_end_raw)
-        if output_video_name
-        else None
+    return compress_video_section_data(
+        *closest_value,
+        heuristic_throughout,
+        final_filepath,
+        probes_used,
+        probe_confidence,
+        preset_score_offset,
     )
-    return compress_video_section_data(*closest_value, heuristic_throughout, filepath)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,20 @@
 from hashlib import sha256
+import hashlib
+import json
 from dataclasses import dataclass
 from typing import Literal, override
 import ffmpeg
+import cache_gc
+import file_cache
+import media_catalog
 
 # import ffmpeg_heuristics
 from pathlib import Path
-import subprocess
+from collections import Counter
+import concurrent.futures
 import os
+import process_graph
+import profiling
 
 
 def calculate_sha(text: str | bytes) -> str:
@@ -17,11 +25,79 @@ def calculate_sha(text: str | bytes) -> str:
     return sha_value
 
 
+FAST_FINGERPRINT_BLOCK_SIZE = 1024 * 1024  # (per sampled block)
+
+type fingerprint_modes = Literal["full", "fast"]
+
+
+def calculate_file_sha(filename: Path) -> str:
+    """
+    Streamed through a bounded buffer (never loads the whole file into memory)
+    """
+    with profiling.span("sha256 of input", "hashing"), open(filename, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def calculate_fast_fingerprint(filename: Path) -> str:
+    """
+    size + modification time + blocks sampled from the start, middle and end of the file
+    (constant time, but only detects changes that touch the size, mtime or sampled blocks)
+    """
+    stat = filename.stat()
+    fingerprint = sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(filename, "rb") as f:
+        for position in (0, stat.st_size // 2, stat.st_size - FAST_FINGERPRINT_BLOCK_SIZE):
+            _ = f.seek(max(0, position))
+            fingerprint.update(f.read(FAST_FINGERPRINT_BLOCK_SIZE))
+    return f"fast-{fingerprint.hexdigest()}"
+
+
+def _sidecar_filename(filename: Path) -> Path:
+    return filename.with_name(f"{filename.name}.sha256")
+
+
+def input_fingerprint(filename: Path, fingerprint_mode: fingerprint_modes) -> str:
+    """
+    The full sha256 is stored in a sidecar file (`<input>.sha256`), so it is only
+    calculated once per file (recalculated if the size or modification time change)
+    """
+    stat = filename.stat()
+    try:
+        with open(_sidecar_filename(filename), "r") as f:
+            sidecar = json.load(f)
+        if sidecar["size"] == stat.st_size and sidecar["mtime_ns"] == stat.st_mtime_ns:
+            return sidecar["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if fingerprint_mode == "fast":
+        return calculate_fast_fingerprint(filename)
+
+    sha256_of_file = calculate_file_sha(filename)
+    try:
+        with open(_sidecar_filename(filename), "w") as f:
+            json.dump(
+                {
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "sha256": sha256_of_file,
+                },
+                f,
+            )
+    except OSError as e:
+        print(f"WARNING: unable to write the sha256 sidecar file: {e}")
+    return sha256_of_file
+
+
 @dataclass
 class vapoursynth_data:
     vapoursynth_script: str
     vapoursynth_seek_method: Literal["ffms2", "bs"]
     crop_black_bars: bool = True
+    crop_detection_windows: int = 6
+    crop_detection_method: Literal["cropdetect", "numpy"] = "cropdetect"
+    # each scene's filtered frames rendered once (lossless), instead of for every probe
+    prerender_scenes: bool = False
 
 
 type input_file_type = Path | ffmpeg.accurate_seek
@@ -33,6 +109,7 @@ class RawVideoData:
         input_filename: Path,
         output_filename: Path,
         vapoursynth_script: vapoursynth_data | None,
+        fingerprint_mode: fingerprint_modes = "full",
     ) -> None:
         # vapoursynth_seek: ffmpeg.accurate_seek | None = None
         # sha256_of_input: str | None = None
@@ -49,18 +126,33 @@ class RawVideoData:
         # self.crop_black_bars: bool = crop_black_bars
 
         # def __post_init__(self):
-        with open(self.input_filename, "rb") as f:
-            self.sha256_of_input = calculate_sha(f.read())
+        # ("fast" --> a different value than "full", so the caches aren't shared between them)
+        self.sha256_of_input: str = input_fingerprint(input_filename, fingerprint_mode)
 
         if isinstance(vapoursynth_script, vapoursynth_data):
             if vapoursynth_script.crop_black_bars:
-                vapoursynth_script.vapoursynth_script += f"\nclip = core.std.CropAbs(clip, {crop_black_bars_size(self.input_filename).split("=")[-1].replace(":",", ")})\n"
+                crop_size = media_catalog.get_or_calculate(
+                    self.sha256_of_input,
+                    f"crop ({vapoursynth_script.crop_detection_method}, {vapoursynth_script.crop_detection_windows} windows)",
+                    lambda: crop_black_bars_size(
+                        self.raw_input_filename,
+                        vapoursynth_script.crop_detection_windows,
+                        vapoursynth_script.crop_detection_method,
+                    ),
+                )
+                vapoursynth_script.vapoursynth_script += f"\nclip = core.std.CropAbs(clip, {crop_size.split("=")[-1].replace(":",", ")})\n"
 
             self.input_filename = ffmpeg.accurate_seek(
                 str(self.input_filename),
                 str(self.input_filename),
                 vapoursynth_script.vapoursynth_seek_method,
                 extra_commands=vapoursynth_script.vapoursynth_script,
+                index_filename=ffmpeg.FFMS2_INDEX_DIRECTORY
+                / f"{self.sha256_of_input}.ffindex",
+                prerender_directory=cache_gc.PRERENDER_DIRECTORY
+                if vapoursynth_script.prerender_scenes
+                else None,
+                input_fingerprint=self.sha256_of_input,
             )
 
     @override
@@ -68,39 +160,176 @@ class RawVideoData:
         return f"RawVideoData('{self.input_filename}', '{self.raw_input_filename}', '{self.output_filename}')"
 
 
-# def crop_black_bars_size(input_video_data: videodata.RawVideoData) -> str:
-def crop_black_bars_size(input_video: Path) -> str:
-    # source_video_path_data = ffmpeg.get_video_metadata(input_video_data)
+file_cache.register_fingerprint(
+    RawVideoData,
+    lambda x: f"RawVideoData({x.sha256_of_input},{file_cache.fingerprint(x.input_filename)},{x.raw_input_filename},{x.output_filename})",
+)
+
+
+@dataclass()
+class cropwindow:
+    width: int
+    height: int
+    x: int
+    y: int
+
+    def ffmpeg_crop(self) -> str:
+        return f"crop={self.width}:{self.height}:{self.x}:{self.y}"
+
+
+type crop_detection_methods = Literal["cropdetect", "numpy"]
+type crop_aggregations = Literal["max extent", "mode"]
+
+CROP_DETECTION_WINDOW_SECONDS: float = 2
+CROP_LUMA_THRESHOLD: int = 24  # (same as the cropdetect default `limit`)
+
+
+def _video_size_and_duration(input_video: Path) -> tuple[int, int, float]:
+    json_data = json.loads(
+        process_graph.run(
+            process_graph.Stage(
+                "ffprobe size and duration",
+                [
+                    "ffprobe", "-v", "quiet", "-print_format", "json",
+                    "-select_streams", "v:0",
+                    "-show_entries", "stream=width,height:format=duration",
+                    str(input_video),
+                ],
+            ),
+            capture_stdout=True,
+        ).stdout.decode()
+    )
+    return (
+        int(json_data["streams"][0]["width"]),
+        int(json_data["streams"][0]["height"]),
+        float(json_data["format"]["duration"]),
+    )
+
+
+def _cropdetect_window(input_video: Path, start_seconds: float) -> cropwindow | None:
+    ffmpeg_output = process_graph.run(
+        process_graph.Stage(
+            "ffmpeg cropdetect",
+            [
+                "ffmpeg", "-hide_banner",
+                "-ss", f"{start_seconds:.3f}",
+                "-t", str(CROP_DETECTION_WINDOW_SECONDS),
+                "-i", str(input_video),
+                "-vf", "cropdetect",
+                "-an", "-f", "null", "-",
+            ],
+        )
+    ).stderr
+
+    if not (data := [x for x in ffmpeg_output.splitlines() if "crop=" in x]):
+        return None
+    width, height, x, y = (
+        int(x) for x in data[-1].rsplit(maxsplit=1)[-1].split("=")[-1].split(":")
+    )
+    if width <= 0 or height <= 0:  # (completely black window)
+        return None
+    return cropwindow(width, height, x, y)
+
+
+def _luma_analysis_window(
+    input_video: Path, start_seconds: float, width: int, height: int, frames: int = 8
+) -> cropwindow | None:
+    """
+    Decodes a few frames (as gray) and finds the rows/columns that are brighter than black
+    """
+    import numpy as np
+
+    raw_frames = process_graph.run(
+        process_graph.Stage(
+            "ffmpeg luma frames",
+            [
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-ss", f"{start_seconds:.3f}",
+                "-i", str(input_video),
+                "-frames:v", str(frames),
+                "-vf", "format=gray",
+                "-f", "rawvideo", "-",
+            ],
+        ),
+        capture_stdout=True,
+    ).stdout
+
+    number_of_frames = len(raw_frames) // (width * height)
+    if number_of_frames == 0:
+        return None
+    luma = np.frombuffer(
+        raw_frames[: number_of_frames * width * height], dtype=np.uint8
+    ).reshape(number_of_frames, height, width)
+    brightest = luma.max(axis=0)
+
+    rows = np.flatnonzero(brightest.mean(axis=1) > CROP_LUMA_THRESHOLD)
+    columns = np.flatnonzero(brightest.mean(axis=0) > CROP_LUMA_THRESHOLD)
+    if len(rows) == 0 or len(columns) == 0:
+        return None
+    return cropwindow(
+        width=int(columns[-1] - columns[0] + 1),
+        height=int(rows[-1] - rows[0] + 1),
+        x=int(columns[0]),
+        y=int(rows[0]),
+    )
+
+
+def _aggregate_crop_windows(
+    windows: list[cropwindow], aggregation: crop_aggregations
+) -> cropwindow:
+    if aggregation == "mode":
+        most_common = Counter((x.width, x.height, x.x, x.y) for x in windows)
+        return cropwindow(*most_common.most_common(1)[0][0])
+
+    # max extent --> never crops away picture that is only visible in some windows
+    left = min(x.x for x in windows)
+    top = min(x.y for x in windows)
+    right = max(x.x + x.width for x in windows)
+    bottom = max(x.y + x.height for x in windows)
+    return cropwindow(
+        width=(right - left) // 2 * 2,  # (even, for chroma subsampling)
+        height=(bottom - top) // 2 * 2,
+        x=left,
+        y=top,
+    )
+
+
+@file_cache.store_cumulative_time
+def crop_black_bars_size(
+    input_video: Path,
+    number_of_windows: int = 6,
+    method: crop_detection_methods = "cropdetect",
+    aggregation: crop_aggregations = "max extent",
+) -> str:
+    """
+    Samples `number_of_windows` short windows spread evenly across the whole video (in parallel),
+    so that intros/logos/fades at the start don't decide the crop
+    - returns the ffmpeg crop string (crop=w:h:x:y)
+    """
+    number_of_windows = max(1, number_of_windows)  # (at least one window is sampled)
+    width, height, duration = _video_size_and_duration(input_video)
+    start_times = [
+        max(0, duration * (i + 0.5) / number_of_windows - CROP_DETECTION_WINDOW_SECONDS / 2)
+        for i in range(number_of_windows)
+    ]
 
     try:
-        # command = (
-        #     f'cat "{input_video_data.input_filename}"'
-        #     if isinstance(input_video_data.input_filename, Path)
-        #     else f"{input_video_data.input_filename}"
-        # )
-
-        ffmpeg_output = subprocess.run(
-            # f'ffmpeg -i <("{command}") -t 10 -vf cropdetect -f null -',
-            f"ffmpeg -i {input_video} -t 10 -vf cropdetect -f null -",
-            check=True,
-            shell=True,
-            capture_output=True,
-        ).stderr.decode()
-        # _ = input(ffmpeg_output.stdout.decode())
-        # _ = input(ffmpeg_output.stderr.decode())
+        with concurrent.futures.ThreadPoolExecutor(number_of_windows) as executor:
+            if method == "numpy":
+                results = executor.map(
+                    lambda x: _luma_analysis_window(input_video, x, width, height),
+                    start_times,
+                )
+            else:
+                results = executor.map(
+                    lambda x: _cropdetect_window(input_video, x), start_times
+                )
+            windows = [x for x in results if x is not None]
     except Exception as e:
         print("UNABLE TO FIND crop_black_bars_size DATA")
         raise e
-    # if isinstance(input_video_data.input_filename, str)
-    # else (
-    #     input_video_data.vapoursynth_accurate_seek.command(
-    #         None,
-    #         round(source_video_path_data.frame_rate * 20),  # 20 seconds in
-    #     )
-    #     + "ffmpeg -i - -vf cropdetect -f null -"
-    # )
-
-    data = [x for x in ffmpeg_output.splitlines() if "crop=" in x][-1]
-
-    # get the last data point? (does the crop size ever change?) --> Need to test
-    return data.rsplit(maxsplit=1)[-1]
+
+    if not windows:  # (the whole video is black?)
+        return cropwindow(width, height, 0, 0).ffmpeg_crop()
+
+    return _aggregate_crop_windows(windows, aggregation).ffmpeg_crop()